@@ -0,0 +1,125 @@
+"""
+Benchmark suite for document modeling hot paths.
+
+    python -m benchmarks run --output results.json             # in-process stand-in (memory backend)
+    python -m benchmarks run --connection-string mongodb://localhost:27017/ --output results.json
+    python -m benchmarks compare base.json results.json          # exit 1 if any case regressed over threshold
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import timeit
+import standin
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, "w")).strip()
+    except Exception:
+        return None
+
+
+def measure(fn, scale, repeat):
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run, ops = fn(scale)
+    timings = []
+    setup = getattr(run, 'setup', None)         # untimed, before every repeat
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        started = timeit.default_timer()
+        run()
+        timings.append(timeit.default_timer() - started)
+    timings.sort()
+    result = {
+        'name': fn.bench_name,
+        'ops': ops,
+        'repeat': repeat,
+        'best': timings[0],
+        'median': timings[len(timings) // 2],
+        'ops_per_sec': ops / timings[0] if timings[0] > 0 else None,
+        'peak_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+        'objects_retained': len(gc.get_objects()) - objects_before,
+    }
+    result.update(getattr(run, 'extra', {}))
+    return result
+
+
+def run(args):
+    # prints of models (registration) go to stderr, stdout is kept for the report
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        standin.install(args.connection_string)
+        import suite
+        results = []
+        for fn in suite.CASES:
+            if args.only and fn.bench_name not in args.only:
+                continue
+            results.append(measure(fn, args.scale, args.repeat))
+            sys.stderr.write('%s\n' % json.dumps(results[-1], sort_keys=True))
+    finally:
+        sys.stdout = stdout
+
+    report = {
+        'revision': git_revision(),
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'standin': 'mongodb' if args.connection_string else 'memory',
+        'scale': args.scale,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+def compare(args):
+    base = dict((r['name'], r) for r in json.load(open(args.base))['results'] if 'best' in r)
+    head = dict((r['name'], r) for r in json.load(open(args.head))['results'] if 'best' in r)
+    regressed = False
+    for name in sorted(set(base) & set(head)):
+        ratio = head[name]['best'] / base[name]['best'] if base[name]['best'] > 0 else 1.0
+        flag = ''
+        if ratio > 1.0 + args.threshold:
+            flag = '  << REGRESSION'
+            regressed = True
+        print '%-28s %10.4fs %10.4fs %7.2fx%s' % (name, base[name]['best'], head[name]['best'], ratio, flag)
+    sys.exit(1 if regressed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    commands = parser.add_subparsers()
+
+    p = commands.add_parser('run')
+    p.add_argument('--scale', type=int, default=10, help='10 = 100k model construction, 1k documents per case')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--only', nargs='*')
+    p.add_argument('--connection-string', default=None)
+    p.add_argument('--output', default=None)
+    p.set_defaults(func=run)
+
+    p = commands.add_parser('compare')
+    p.add_argument('base')
+    p.add_argument('head')
+    p.add_argument('--threshold', type=float, default=0.1, help='allowed slow down ratio')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark models, import after standin.install()
+"""
+from pymongo_document import documents as doc
+import datetime
+
+WIDE_SCALARS = 20
+WIDE_LISTS = 10
+WIDE_DICTS = 5
+
+
+class SmallDocument(doc.Doc):
+    int_val = doc.FieldNumeric()
+    str_val = doc.FieldString(default="default_value_of_string")
+
+    class Meta:
+        collection_name = 'bench_small_document'
+
+
+def _wide_fields():
+    fields = {}
+    for i in range(WIDE_SCALARS):
+        fields['int_%d' % i] = doc.FieldNumeric(default=0)
+        fields['str_%d' % i] = doc.FieldString()
+    for i in range(WIDE_LISTS):
+        fields['list_%d' % i] = doc.FieldList(doc.FieldNumeric())
+    for i in range(WIDE_DICTS):
+        fields['dict_%d' % i] = doc.FieldDict(default={})
+    fields['Meta'] = type('Meta', (object,), {'collection_name': 'bench_wide_document'})
+    return fields
+
+WideDocument = type('WideDocument', (doc.Doc,), _wide_fields())
+
+
+class NestedItem(doc.FieldSpecAware):
+    code = doc.FieldString()
+    amount = doc.FieldNumeric(default=0)
+    created = doc.FieldDateTime()
+
+
+class NestedDocument(doc.Doc):
+    header = doc.FieldNested(NestedItem)
+    items = doc.FieldList(doc.FieldNested(NestedItem))
+    pairs = doc.FieldList(doc.FieldTuple(doc.FieldString(), doc.FieldNumeric()))
+
+    class Meta:
+        collection_name = 'bench_nested_document'
+
+
+class HolderDocument(doc.Doc):
+    refs = doc.FieldList(doc.FieldDoc(SmallDocument))
+
+    class Meta:
+        collection_name = 'bench_holder_document'
+
+
+def wide_raw(i):
+    raw = {'_id': doc.ObjectId()}
+    for n in range(WIDE_SCALARS):
+        raw['int_%d' % n] = i + n
+        raw['str_%d' % n] = u'value %d' % n
+    for n in range(WIDE_LISTS):
+        raw['list_%d' % n] = range(n) if i % 2 else []
+    for n in range(WIDE_DICTS):
+        raw['dict_%d' % n] = {'k': n, 'nested': {'v': [1, 2, 3]}} if i % 2 else {}
+    return raw
+
+
+def wide_sparse_raw(i):
+    """
+    Wide document whose list and dict fields are absent (read as defaults)
+    """
+    raw = {'_id': doc.ObjectId()}
+    for n in range(WIDE_SCALARS):
+        raw['int_%d' % n] = i + n
+    return raw
+
+
+def nested_raw(i, items=20):
+    def item(n):
+        return {'code': u'item-%d' % n, 'amount': n * i, 'created': datetime.datetime(2016, 1, 1)}
+    return {
+        '_id': doc.ObjectId(),
+        'header': item(0),
+        'items': map(item, range(items)),
+        'pairs': map(lambda n: [u'pair-%d' % n, n], range(items)),
+    }
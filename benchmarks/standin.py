@@ -0,0 +1,16 @@
+"""
+Database stand-in for benchmarks. Must be installed before any model module is imported,
+as managers are bound to their connection at class creation.
+"""
+from pymongo_document import conf
+
+
+def install(connection_string=None):
+    """
+    :param connection_string: benchmark against real MongoDB, if None in-process memory backend is used.
+    """
+    if connection_string is None:
+        default = {'backend': 'memory', 'database_name': 'pymongo_document_benchmarks'}
+    else:
+        default = {'connection_string': connection_string, 'database_name': 'pymongo_document_benchmarks'}
+    conf.Configuration.CONF = {'default': default}
@@ -0,0 +1,165 @@
+"""
+Benchmark cases, each case is a function(scale) which prepares data and returns the callable to be timed.
+"""
+import imp
+import os
+import threading
+import models
+
+
+CASES = []
+
+
+def case(name):
+    def register(fn):
+        fn.bench_name = name
+        CASES.append(fn)
+        return fn
+    return register
+
+
+@case('construct_models')
+def construct_models(scale):
+    n = 100000 * scale // 10
+
+    def run():
+        for i in xrange(n):
+            models.SmallDocument()
+    return run, n
+
+
+@case('inflate_wide')
+def inflate_wide(scale):
+    raws = map(models.wide_raw, range(1000 * scale // 10))
+
+    def run():
+        for raw in raws:
+            models.WideDocument().inflate(raw)
+    return run, len(raws)
+
+
+@case('inflate_nested')
+def inflate_nested(scale):
+    raws = map(models.nested_raw, range(1000 * scale // 10))
+
+    def run():
+        for raw in raws:
+            models.NestedDocument().inflate(raw)
+    return run, len(raws)
+
+
+@case('document_validate_wide')
+def document_validate_wide(scale):
+    docs = []
+    for raw in map(models.wide_raw, range(1000 * scale // 10)):
+        o = models.WideDocument()
+        o.inflate(raw)
+        docs.append(o)
+
+    def run():
+        for o in docs:
+            o.validate()
+            o.document()
+    return run, len(docs)
+
+
+@case('read_wide_fields')
+def read_wide_fields(scale):
+    docs = []
+    for raw in map(models.wide_raw, range(1000 * scale // 10)):
+        o = models.WideDocument()
+        o.inflate(raw)
+        docs.append(o)
+    names = filter(lambda k: k.startswith('list_') or k.startswith('dict_'), docs[0].fields.keys())
+
+    def run():
+        for o in docs:
+            for name in names:
+                getattr(o, name)
+    return run, len(docs)
+
+
+@case('read_sparse_wide')
+def read_sparse_wide(scale):
+    raws = map(models.wide_sparse_raw, range(1000 * scale // 10))
+    names = filter(lambda k: k.startswith('list_') or k.startswith('dict_'), models.WideDocument.__dict__.keys())
+
+    def run():
+        for raw in raws:
+            o = models.WideDocument()
+            o.inflate(raw)
+            for name in names:
+                getattr(o, name)
+            o.document()
+    return run, len(raws)
+
+
+@case('bulk_save')
+def bulk_save(scale):
+    n = 1000 * scale // 10
+
+    def run():
+        for i in xrange(n):
+            o = models.SmallDocument()
+            o.int_val = i
+            o.save()
+    run.setup = models.SmallDocument.manager.delete     # every repeat saves into an empty collection
+    return run, n
+
+
+@case('populate_fanout')
+def populate_fanout(scale):
+    fanout = 20
+    models.SmallDocument.manager.delete()
+    models.HolderDocument.manager.delete()
+    holders = []
+    for i in xrange(100 * scale // 10):
+        refs = []
+        for n in xrange(fanout):
+            o = models.SmallDocument()
+            o.int_val = n
+            o.save()
+            refs.append(o.object_id)
+        h = models.HolderDocument()
+        h.refs = refs
+        h.save()
+        holders.append(h.object_id)
+
+    def run():
+        for object_id in holders:
+            models.HolderDocument(object_id).populate('refs')
+    return run, len(holders) * fanout
+
+
+@case('find_inflate')
+def find_inflate(scale):
+    n = 1000 * scale // 10
+    models.SmallDocument.manager.delete()
+    models.SmallDocument.manager.o.insert_many(map(lambda i: {'int_val': i, 'str_val': u'x'}, range(n)))
+
+    def run():
+        for o in models.SmallDocument.manager.find({}):
+            pass
+    return run, n
+
+
+@case('running_number_contention')
+def running_number_contention(scale):
+    path = os.path.join(os.path.dirname(models.doc.__file__), 'running-number.py')
+    rn = imp.load_source('pymongo_document.running_number', path.replace('.pyc', '.py'))
+    rn.RunningNumberCenter.register_policy('bench', rn.RunningNumberPolicy())
+    rn.RunningNumberCenter.manager.delete()
+    threads, calls = 8, 10 * scale
+    issued = []
+
+    def worker():
+        for i in xrange(calls):
+            issued.append(rn.RunningNumberCenter.new_number('bench'))
+
+    def run():
+        del issued[:]
+        pool = [threading.Thread(target=worker) for t in range(threads)]
+        map(lambda t: t.start(), pool)
+        map(lambda t: t.join(), pool)
+        run.extra = {'duplicates': len(issued) - len(set(issued))}
+    return run, threads * calls
@@ -0,0 +1,102 @@
+from bson.son import SON
+import documents as doc
+
+
+class Pipeline(object):
+    """
+    Aggregation pipeline builder, understand model's field names.
+
+    Field names are translated to document keys (FieldSpec.key) until the document shape is changed
+    by $group, $project, $replaceRoot stage. Stages added after that are passed through as is.
+
+    Usage:
+        Pipeline(SimpleDocument).match(int_val={'$gt': 5}).sort(('int_val', -1)).limit(10).run()
+    """
+
+    def __init__(self, doc_class):
+        super(Pipeline, self).__init__()
+        self.doc_class = doc_class
+        self.stages = []
+        self.model_shaped = True
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def key(self, path):
+        return doc.document_path(self.doc_class, path) if self.model_shaped else path
+
+    def condition(self, cond):
+        """
+        Translate query condition, e.g. {'object_id': x, '$or': [{'int_val': 3}]} => {'_id': x, '$or': [{'int_val': 3}]}
+        """
+        if isinstance(cond, (list, tuple)):
+            return map(self.condition, cond)
+        if not isinstance(cond, dict):
+            return cond
+        return dict(map(lambda (k, v): (k, self.condition(v)) if k.startswith('$') else (self.key(k), v),
+                        cond.iteritems()))
+
+    def expression(self, expr):
+        """
+        Translate aggregation expression, field reference '$field_name' => '$document_key'. '$$variables' are untouched.
+        """
+        if isinstance(expr, basestring) and expr.startswith('$') and not expr.startswith('$$'):
+            return '$' + self.key(expr[1:])
+        if isinstance(expr, (list, tuple)):
+            return map(self.expression, expr)
+        if isinstance(expr, dict):
+            return dict(map(lambda (k, v): (k, self.expression(v)), expr.iteritems()))
+        return expr
+
+    def stage(self, raw_stage):
+        """
+        Append raw stage, no translation applied.
+        """
+        self.stages.append(raw_stage)
+        return self
+
+    def match(self, cond=None, **kwargs):
+        cond = dict(cond or {}, **kwargs)
+        return self.stage({'$match': self.condition(cond)})
+
+    def sort(self, *pairs):
+        """
+        :param pairs: tuple of (field_name, direction)
+        """
+        return self.stage({'$sort': SON(map(lambda (k, d): (self.key(k), d), pairs))})
+
+    def skip(self, n):
+        return self.stage({'$skip': n})
+
+    def limit(self, n):
+        return self.stage({'$limit': n})
+
+    def unwind(self, path, **options):
+        options['path'] = '$' + self.key(path)
+        return self.stage({'$unwind': options})
+
+    def project(self, spec=None, **kwargs):
+        spec = dict(spec or {}, **kwargs)
+        projection = dict(map(lambda (k, v): (self.key(k), self.expression(v)), spec.iteritems()))
+        self.model_shaped = False
+        return self.stage({'$project': projection})
+
+    def group(self, _id, **accumulators):
+        group = {'_id': self.expression(_id)}
+        group.update(dict(map(lambda (k, v): (k, self.expression(v)), accumulators.iteritems())))
+        self.model_shaped = False
+        return self.stage({'$group': group})
+
+    def replace_root(self, expr):
+        self.stage({'$replaceRoot': {'newRoot': self.expression(expr)}})
+        self.model_shaped = False
+        return self
+
+    def run(self, inflate=True, **kwargs):
+        """
+        Execute pipeline against doc_class's manager, see Docs.aggregate
+        """
+        return self.doc_class.manager.aggregate(self, inflate=inflate, **kwargs)
@@ -0,0 +1,142 @@
+"""
+Compression codecs of FieldCompressed, and wire compressors of connections (see conf.client_options).
+
+zlib is always available, snappy requires `python-snappy`, zstd requires `zstandard`.
+"""
+from bson import BSON, Binary
+from errors import DeveloperFault
+import threading
+import zlib
+
+BINARY_SUBTYPE = 0x80           # user defined binary subtype of compressed values
+WIRE_COMPRESSORS = ('zstd', 'snappy', 'zlib')
+
+
+def _zlib():
+    return zlib.compress, zlib.decompress
+
+
+def _snappy():
+    import snappy
+    return snappy.compress, snappy.decompress
+
+
+def _zstd():
+    import zstandard
+    return zstandard.compress, zstandard.decompress
+
+
+# codec name => (marker, loader), marker is the first byte of stored value, values are decompressed by it
+_codecs = {
+    'zlib': ('\x01', _zlib),
+    'snappy': ('\x02', _snappy),
+    'zstd': ('\x03', _zstd),
+}
+_loaded = {}                    # marker => (name, compress, decompress)
+
+
+class Codec(object):
+
+    def __init__(self, name, marker, compress):
+        super(Codec, self).__init__()
+        self.name = name
+        self.marker = marker
+        self.compress = compress
+
+
+def _load(name, marker, loader):
+    if marker not in _loaded:
+        try:
+            compress, decompress = loader()
+        except ImportError as e:
+            raise DeveloperFault('Compression codec "%s" is not available: %s' % (name, e))
+        _loaded[marker] = (name, compress, decompress)
+    return _loaded[marker]
+
+
+def codec(name):
+    """
+    :param name: 'zlib', 'snappy' or 'zstd'
+    :return: Codec, DeveloperFault if it is unknown or its module is not installed.
+    """
+    if name not in _codecs:
+        raise DeveloperFault('Unknown compression codec "%s", expected one of %s' % (name, sorted(_codecs)))
+    marker, loader = _codecs[name]
+    return Codec(name, marker, _load(name, marker, loader)[1])
+
+
+def is_compressed(value):
+    return isinstance(value, Binary) and value.subtype == BINARY_SUBTYPE
+
+
+class Packed(Binary):
+    """
+    Binary of a value packed by this process, stored as a plain Binary. `raw_size` is its uncompressed size.
+    """
+
+    def __new__(cls, data, raw_size):
+        self = Binary.__new__(cls, data, BINARY_SUBTYPE)
+        self.raw_size = raw_size
+        return self
+
+
+def encode(value):
+    """
+    :param value: document value (BSON encodable)
+    :return: uncompressed bytes of value, its size is compared with min_size before it is packed
+    """
+    return BSON.encode({'v': value})
+
+
+def pack(data, codec):
+    """
+    :param data: bytes of encode()
+    :return: Packed
+    """
+    return Packed(codec.marker + codec.compress(data), len(data))
+
+
+def unpack(binary):
+    """
+    Reverse of pack, codec is read from the stored value.
+    """
+    marker = binary[:1]
+    entry = next(((name, m, loader) for name, (m, loader) in _codecs.iteritems() if m == marker), None)
+    if entry is None:
+        raise DeveloperFault('Unknown compression codec of stored value, marker=%r' % marker)
+    decompress = _load(*entry)[2]
+    return BSON(decompress(binary[1:])).decode()['v']
+
+
+class Stats(object):
+    """
+    Size savings of a FieldCompressed, see FieldCompressed.savings()
+    """
+
+    def __init__(self):
+        super(Stats, self).__init__()
+        self.lock = threading.Lock()
+        self.packed = 0
+        self.unpacked = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    def add_packed(self, raw_bytes, stored_bytes):
+        with self.lock:
+            self.packed += 1
+            self.raw_bytes += raw_bytes
+            self.stored_bytes += stored_bytes
+
+    def add_unpacked(self):
+        with self.lock:
+            self.unpacked += 1
+
+    def report(self):
+        return {
+            'packed': self.packed,
+            'unpacked': self.unpacked,
+            'raw_bytes': self.raw_bytes,
+            'stored_bytes': self.stored_bytes,
+            'saved_bytes': self.raw_bytes - self.stored_bytes,
+            'ratio': float(self.stored_bytes) / self.raw_bytes if self.raw_bytes else None,
+        }
@@ -1,7 +1,120 @@
 import os
 import configparser
 import pymongo
+import storage
+import threading
+from compression import WIRE_COMPRESSORS
 from errors import DeveloperFault
+from pymongo import read_preferences
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+
+_read_preference_modes = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest,
+}
+
+
+def parse_read_preference(value, tag_sets=None, max_staleness=-1):
+    """
+    Create pymongo's read preference.
+
+    e.g. 'secondaryPreferred', {'mode': 'secondary', 'tag_sets': [{'use': 'reporting'}], 'max_staleness': 120}
+
+    :param value: mode name, dict of (mode, tag_sets, max_staleness), or pymongo's read preference (returned as is)
+    :param tag_sets: list of tag dict, or string 'dc:east,use:reporting;dc:west' (';' separates tag sets)
+    :param max_staleness: seconds, -1 means no maximum
+    :return: pymongo's read preference
+    """
+    if isinstance(value, dict):
+        return parse_read_preference(value.get('mode', 'primary'), value.get('tag_sets'), value.get('max_staleness', -1))
+    if not isinstance(value, basestring):
+        return value
+    if value not in _read_preference_modes:
+        raise DeveloperFault('Unknown read preference: "%s", expected one of %s' % (value, sorted(_read_preference_modes)))
+    if isinstance(tag_sets, basestring):
+        tag_sets = map(lambda tag_set: dict(map(lambda tag: tuple(map(lambda t: t.strip(), tag.split(':', 1))),
+                                                filter(None, tag_set.split(',')))),
+                       tag_sets.split(';'))
+    if value == 'primary':
+        if tag_sets or max_staleness != -1:
+            raise DeveloperFault('Read preference "primary" cannot be combined with tag_sets, max_staleness')
+        return read_preferences.Primary()
+    return _read_preference_modes[value](tag_sets=tag_sets or None, max_staleness=int(max_staleness))
+
+
+def connection_options(cnf):
+    """
+    Read preference, read concern and write concern of connection configuration.
+
+    Supported keys: read_preference, read_preference_tags, max_staleness_seconds, read_concern,
+    write_concern (w: number or tag e.g. majority), write_concern_timeout_ms, journal
+
+    :return: dict of options accepted by pymongo's get_database / with_options
+    """
+    options = {}
+    if 'read_preference' in cnf:
+        options['read_preference'] = parse_read_preference(cnf['read_preference'], cnf.get('read_preference_tags'),
+                                                           cnf.get('max_staleness_seconds', -1))
+    if 'read_concern' in cnf:
+        options['read_concern'] = ReadConcern(cnf['read_concern'])
+    if 'write_concern' in cnf or 'write_concern_timeout_ms' in cnf or 'journal' in cnf:
+        w = cnf.get('write_concern')
+        timeout = cnf.get('write_concern_timeout_ms')
+        journal = cnf.get('journal')
+        options['write_concern'] = WriteConcern(w=int(w) if w is not None and w.isdigit() else w,
+                                                wtimeout=int(timeout) if timeout is not None else None,
+                                                j=journal.lower() in ('1', 'true', 'yes', 'on') if journal is not None else None)
+    return options
+
+
+def client_options(cnf):
+    """
+    MongoClient options of connection configuration.
+
+    Supported keys: compressors (wire compression, comma separated in order of preference e.g. zstd,snappy,zlib,
+    negotiated with server, snappy requires python-snappy, zstd requires zstandard), zlib_compression_level (-1..9)
+
+    :return: dict of options accepted by pymongo's MongoClient
+    """
+    options = {}
+    if 'compressors' in cnf:
+        compressors = filter(None, map(lambda c: c.strip(), cnf['compressors'].split(',')))
+        unknown = filter(lambda c: c not in WIRE_COMPRESSORS, compressors)
+        if unknown:
+            raise ValueError('unknown compressors %s, expected %s' % (unknown, list(WIRE_COMPRESSORS)))
+        options['compressors'] = ','.join(compressors)
+    if 'zlib_compression_level' in cnf:
+        level = int(cnf['zlib_compression_level'])
+        if not -1 <= level <= 9:
+            raise ValueError('zlib_compression_level must be within -1..9')
+        options['zlibCompressionLevel'] = level
+    return options
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client(connection_string, **options):
+    """
+    Shared MongoClient per connection string and client options (and per process, MongoClient is not fork safe).
+    Models, connections, and routes pointing to the same cluster share one connection pool.
+    """
+    key = (connection_string, tuple(sorted(options.items())), os.getpid())
+    if key not in _clients:
+        with _clients_lock:
+            if key not in _clients:
+                _clients[key] = pymongo.MongoClient(connection_string, **options)
+    return _clients[key]
+
+
+def _mongodb(cnf, database_name):
+    return client(cnf['connection_string'], **client_options(cnf)).get_database(database_name,
+                                                                                **connection_options(cnf))
 
 
 # default config - will be override by settings module
@@ -14,6 +127,16 @@ class Configuration(object):
         }
     }
 
+    # backend name => factory(connection_name, connection_config, database_name) returns database object
+    BACKENDS = {
+        'mongodb': lambda connection_name, cnf, database_name: _mongodb(cnf, database_name),
+        'memory': storage.factory,
+    }
+
+    # collection_name => dotted import path of model ('package.module' or 'package.module:ClassName'),
+    # given by [models] section, imported on first use (see documents.Docs.factory_doc)
+    MODELS = {}
+
 
 def update_config(config_path):
 
@@ -31,22 +154,42 @@ def update_config(config_path):
         # Validate config file
         def validate_configuration(pair):
             name, conf = pair
-            if 'connection_string' not in conf:
+            if 'connection_string' not in conf and ('backend' not in conf or conf['backend'] == 'mongodb'):
                 raise DeveloperFault('Bad configuration: "connection_string" is missing from "%s" connection.' % name)
+            try:
+                connection_options(conf)
+                client_options(conf)
+            except (ValueError, TypeError, pymongo.errors.ConfigurationError) as e:
+                raise DeveloperFault('Bad configuration: "%s" connection, %s' % (name, e))
 
         if 'default' not in config:
             raise DeveloperFault('Bad configuration: "default" connection is required.')
 
-        map(validate_configuration, filter(lambda o: o[0] != 'DEFAULT', config.iteritems()))
+        map(validate_configuration, filter(lambda o: o[0] not in ('DEFAULT', 'models'), config.iteritems()))
 
         Configuration.CONF = config
+        Configuration.MODELS = dict(config['models']) if 'models' in config else {}
 
 
 # internal connector method.
 def get_connection(connection_name='default'):
-    if connection_name not in Configuration.CONF:
+    if connection_name not in Configuration.CONF or connection_name == 'models':
         raise DeveloperFault('Unknown connection_name: "%s"' % connection_name)
 
     cnf = Configuration.CONF[connection_name]
     database_name = cnf['database_name'] if 'database_name' in cnf else 'default_database'
-    return pymongo.MongoClient(cnf['connection_string']).__getattr__(database_name)
+    backend = cnf['backend'] if 'backend' in cnf else 'mongodb'
+    if backend not in Configuration.BACKENDS:
+        raise DeveloperFault('Unknown backend: "%s" of "%s" connection' % (backend, connection_name))
+    return Configuration.BACKENDS[backend](connection_name, cnf, database_name)
+
+
+def register_backend(name, factory):
+    """
+    Register storage backend, selectable by `backend = name` in connection's configuration.
+
+    :param name: backend name
+    :param factory: callable(connection_name, connection_config, database_name) returns database object,
+        database['collection_name'] must behave like pymongo's Collection.
+    """
+    Configuration.BACKENDS[name] = factory
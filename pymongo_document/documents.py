@@ -1,36 +1,164 @@
 from bson import ObjectId
-from conf import get_connection
+from bson.binary import Binary
+from bson.son import SON
+from collections import OrderedDict
+from conf import Configuration, get_connection, parse_read_preference
 from errors import DeveloperFault, DocumentValidationError, FieldValidationError
+from instruments import OperationEvent
+from resultcache import ResultCache
+from routing import ScatterCursor
+from timeseries import BucketCursor, Bucketing
+from writebehind import WriteBehindWriter
 from pymongo.cursor import Cursor
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.operations import ReplaceOne, UpdateMany, UpdateOne
+import compression
+import files
 import helpers as helper
+import query
 import gettext as _
 import datetime, time
+import importlib
 import inspect
+import itertools
 import six
 import re
 import copy
+import threading
 
 __author__ = "peatiscoding"
 
 
-class MaskedCursor(Cursor):
+class _MaskedCursor(object):
     """
-    Cursor
+    Inflating cursor behaviour, mixed into storage backend's cursor class (see masked_cursor_class)
     """
     def __init__(self, *args, **kwargs):
-        super(MaskedCursor, self).__init__(*args, **kwargs)
+        super(_MaskedCursor, self).__init__(*args, **kwargs)
         self.inflate_callback = None
+        self.manager = None
+        self.iterated = 0
+        self.exhausted = False
+        self.emitted = False
+        self.length = None          # known once cursor is exhausted
+        self.fetch_time = 0.0
+        self.inflate_time = 0.0
+
+    def _emit(self):
+        """
+        Emit find event once cursor is exhausted or closed, never iterated cursors are not emitted.
+        """
+        if getattr(self, 'manager', None) is None or self.emitted or not (self.iterated or self.exhausted):
+            return
+        self.emitted = True
+        self.manager.emit('find', self._Cursor__spec, self.fetch_time + self.inflate_time, returned=self.iterated,
+                          inflate_time=self.inflate_time, read_preference=self._read_preference())
+
+    def _read_preference(self):
+        return getattr(self.collection, 'read_preference', None)
 
     def next(self):
-        o = super(MaskedCursor, self).next()
-        return self.inflate_callback(o) if self.inflate_callback else o
+        started = time.time()
+        try:
+            o = super(_MaskedCursor, self).next()
+        except StopIteration:
+            if not self.exhausted:
+                self.exhausted = True
+                self.fetch_time += time.time() - started
+                if not self._Cursor__skip and not self._Cursor__limit:
+                    self.length = self.iterated
+                self._emit()
+            raise
+        fetched = time.time()
+        self.fetch_time += fetched - started
+        self.iterated += 1
+        if self.inflate_callback:
+            o = self.inflate_callback(o)
+            self.inflate_time += time.time() - fetched
+        return o
+
+    def close(self):
+        self._emit()
+        return super(_MaskedCursor, self).close()
+
+    def rewind(self):
+        self._emit()
+        self.iterated = 0
+        self.exhausted = False
+        self.emitted = False
+        self.length = None
+        self.fetch_time = self.inflate_time = 0.0
+        return super(_MaskedCursor, self).rewind()
 
     def __len__(self):
-        return self.count()
+        """
+        Number of documents matching cursor's condition (skip, limit are ignored).
+        No round trip is made once cursor has been exhausted.
+        """
+        if self.length is not None:
+            return self.length
+        if self.manager is not None:
+            return self.manager.count(self._Cursor__spec)
+        return self.collection.count_documents(self._Cursor__spec)
 
     def __getitem__(self, item):
-        o = super(MaskedCursor, self).__getitem__(item)
-        return self.inflate_callback(o) if isinstance(o, dict) and self.inflate_callback else o
+        started = time.time()
+        try:
+            o = super(_MaskedCursor, self).__getitem__(item)
+        except IndexError:
+            if self.manager is not None:
+                self.manager.emit('find', self._Cursor__spec, time.time() - started, returned=0,
+                                  read_preference=self._read_preference())
+            raise
+        if not isinstance(o, dict):
+            return o        # slice, cursor itself
+        fetched = time.time()
+        if self.inflate_callback:
+            o = self.inflate_callback(o)
+        if self.manager is not None:
+            self.manager.emit('find', self._Cursor__spec, time.time() - started, returned=1,
+                              inflate_time=time.time() - fetched, read_preference=self._read_preference())
+        return o
+
+    def populate(self, *paths):
+        """
+        Server side population of FieldDoc, FieldList(FieldDoc) fields. Cursor's condition, sort, skip and limit
+        are compiled into single aggregation with $lookup.
+
+        :param paths: field name paths to be populated, e.g. 'list_of_docs'
+        :return: iterator of populated Doc
+        """
+        return self.manager.lookup(paths,
+                                   cond=self._Cursor__spec,
+                                   projection=self._Cursor__projection,
+                                   sort=self._Cursor__ordering,
+                                   skip=self._Cursor__skip,
+                                   limit=self._Cursor__limit)
+
+
+class MaskedCursor(_MaskedCursor, Cursor):
+    """
+    Cursor
+    """
+
+
+_masked_cursor_classes = {Cursor: MaskedCursor}
+
+# Registries (Docs.installed, Docs.subtypes, Docs._on_delete, Docs.listeners, ...) are copy-on-write:
+# writers build a new dict/list under this lock and rebind it, readers never lock.
+_registry_lock = threading.RLock()
+_write_versions = itertools.count(1)
+_count_cache_lock = threading.Lock()       # Docs.count_caches entries are LRU ordered
+
+
+def masked_cursor_class(cursor_class):
+    """
+    Inflating cursor class of given storage backend's cursor class
+    """
+    if cursor_class not in _masked_cursor_classes:
+        _masked_cursor_classes.setdefault(cursor_class, type('Masked%s' % cursor_class.__name__,
+                                                             (_MaskedCursor, cursor_class), {}))
+    return _masked_cursor_classes[cursor_class]
 
 
 class Docs(object):
@@ -38,9 +166,22 @@ class Docs(object):
     Database Manager
     """
     installed = {}
+    subtypes = {}           # db_name => {_subtype (None for parent's rows): doc_class}, used to dispatch raw rows
+    listeners = []
     _on_delete = {}
-
-    def __init__(self, collection_name, connection_name='default'):
+    _on_save = {}           # db_name => list of (manager, path, is_list, FieldDoc) embedding its documents
+    write_versions = {}     # db_name => write version, bumped by invalidate(), see Meta.result_cache
+    count_caches = {}       # db_name => OrderedDict of count key => (expire time, count), dropped by invalidate()
+    lazy = {}               # collection_name => dotted import path of model, see declare()
+    lazy_loaded = []        # report of models imported on first use, see factory_doc()
+    entry_point_group = 'pymongo_document.models'
+    _entry_points = None
+
+    count_cache_size = 1024
+    duplicate_id_retries = 3    # pre-allocated ObjectId is re-allocated this many times when it collides
+
+    def __init__(self, collection_name, connection_name='default', count_cache_ttl=0, write_behind=None,
+                 read_preference=None, router=None, bucket=None, result_cache=None):
         super(Docs, self).__init__()
         db_name, sub_name = collection_name.split(":", 1) if ":" in collection_name else (collection_name, None)
         self.collection_name = collection_name
@@ -51,15 +192,221 @@ class Docs(object):
 
         if db_name is None:
             raise DeveloperFault("Unable to create empty database name document manager")
+        self.connection_name = connection_name
+        self.read_preference = parse_read_preference(read_preference) if read_preference is not None else None
+        self.router = router                    # routing.Router, picks connection per operation (Meta.router)
         self.o = self.db[db_name]
-
-    def write(self, document, **kwargs):
-        document['_id'] = kwargs.get('object_id', document['_id'] or None)
+        if self.read_preference is not None:
+            self.o = self.o.with_options(read_preference=self.read_preference)
+        self._collections = {}                  # (connection_name, read preference document) => collection
+        self._buckets = {}                      # bucket name => files.Bucket
+        self.file_fields = []                   # list of (field name, document key, FieldFile), see register
+        self.compressed_fields = []             # list of (document key, FieldCompressed), see register
+        self.count_cache_ttl = count_cache_ttl
+        self.result_cache = ResultCache(**result_cache) if result_cache else None
+        self.indices = []
+        self.scoped_subtypes = (None, None)     # (Docs.subtypes[db_name] it was computed from, subtypes)
+        self.writer = WriteBehindWriter(self, **write_behind) if write_behind else None
+        # timeseries.Bucketing, readings are appended into bucket documents (Meta.bucket)
+        self.bucketing = Bucketing(**bucket) if bucket else None
+        if self.bucketing is not None and (sub_name is not None or write_behind):
+            raise DeveloperFault('Meta.bucket cannot be combined with sub collection, or write_behind')
+
+    def write(self, document, insert=False, reassign_id=False, upsert=False, **kwargs):
+        """
+        Insert new document (insert_one), or replace existing document (replace_one).
+
+        :param document: validated document
+        :param insert: document is new
+        :param upsert: replace, or insert when there is no document of `_id` (caller supplied `_id`)
+        :param reassign_id: `_id` was pre-allocated (Doc.load), when it collides (e.g. pre-forked workers sharing
+            ObjectId counter) a new ObjectId is allocated and insert is retried, see `duplicate_id_retries`.
+        :return: object_id
+        """
+        document['_id'] = kwargs.get('object_id', document.get('_id') or None)
         if document['_id'] is None:
             document.pop("_id")
         if self.sub_collection_name is not None:
             document['_subtype'] = self.sub_collection_name
-        return self.o.save(document)
+        if self.writer is not None:
+            self.writer.flush()
+        self.invalidate()
+        started = time.time()
+        collection = self.routes_of([document])[0][0]
+        if self.bucketing is not None:
+            self._write_reading(collection, document, insert, upsert)
+        elif insert:
+            self._insert(collection, document, reassign_id)
+        elif '_id' not in document:
+            raise DeveloperFault('Unable to replace document without _id')
+        elif collection.replace_one({'_id': document['_id']}, document, upsert=upsert).matched_count == 0 \
+                and not upsert:
+            raise DocumentValidationError('Failed to save document, unknown document_id=%s' % document['_id'])
+        self._record_written([document])
+        self.invalidate()
+        self.emit('write', {'_id': document['_id']}, time.time() - started, returned=1)
+        return document['_id']
+
+    def _insert(self, collection, document, reassign_id):
+        for attempt in itertools.count():
+            try:
+                return collection.insert_one(document)
+            except DuplicateKeyError as e:
+                if not reassign_id or attempt >= self.duplicate_id_retries or not helper.is_duplicate_id(e.details):
+                    raise
+                document['_id'] = ObjectId()
+
+    def _write_reading(self, collection, document, insert, upsert=False):
+        bucket = None
+        if not insert:
+            bucket = collection.find_one({'items._id': document['_id']}, {self.bucketing.key: 1, 'start': 1})
+            if bucket is None and not upsert:
+                raise DocumentValidationError('Failed to save reading, unknown document_id=%s' % document['_id'])
+        operation = self.bucketing.replace_operation(document, bucket) if bucket is not None else None
+        if operation is None:
+            # appended into bucket, with a single upsert
+            cond, update = self.bucketing.appends([document])[0]
+            collection.update_one(cond, update, upsert=True)
+            if bucket is not None:
+                # key or span changed, moved out of its bucket once appended to the other one
+                cond, update = self.bucketing.pull_operation(document['_id'], bucket)
+                collection.update_one(cond, update)
+                collection.delete_one({'_id': bucket['_id'], 'count': 0})     # emptied bucket
+            return
+        cond, update, array_filters = operation
+        if collection.update_one(cond, update, array_filters=array_filters).matched_count == 0:
+            raise DocumentValidationError('Failed to save reading, document_id=%s was removed from its bucket'
+                                          % document['_id'])
+
+    def write_many(self, objects):
+        """
+        Insert new Doc instances with insert_many (unordered), colliding pre-allocated ObjectIds are re-allocated
+        and retried as in `write`.
+
+        :param objects: new Doc instances
+        :return: list of object_id
+        """
+        objects = list(objects)
+        if not all(map(lambda o: o.is_new(), objects)):
+            raise DeveloperFault('write_many only inserts new documents, use save() instead')
+        map(lambda o: o.validate(), objects)
+        documents = map(lambda o: o.document(), objects)
+        if self.sub_collection_name is not None:
+            map(lambda d: d.__setitem__('_subtype', self.sub_collection_name), documents)
+        if self.writer is not None:
+            self.writer.flush()
+        self.invalidate()
+        started = time.time()
+        if self.bucketing is not None:
+            map(lambda (collection, routed): collection.bulk_write(
+                map(lambda (c, u): UpdateOne(c, u, upsert=True), self.bucketing.appends(routed)), ordered=False),
+                self.routes_of(documents))
+        else:
+            map(lambda (collection, routed): self._insert_many(collection, routed), self.routes_of(documents))
+        for o, document in zip(objects, documents):
+            o.object_id = document['_id']
+            o._injected_object_id = None
+        ids = map(lambda d: d['_id'], documents)
+        self._record_written(documents)
+        self.invalidate()
+        self.emit('write', {'_id': {'$in': ids}}, time.time() - started, returned=len(ids))
+        return ids
+
+    def _insert_many(self, collection, documents):
+        pending = documents
+        for attempt in itertools.count():
+            if not pending:
+                break
+            try:
+                collection.insert_many(pending, ordered=False)
+                break
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                if attempt >= self.duplicate_id_retries or e.details.get('writeConcernErrors') \
+                        or not all(map(helper.is_duplicate_id, errors)):
+                    raise
+                pending = map(lambda error: pending[error['index']], errors)
+                map(lambda d: d.__setitem__('_id', ObjectId()), pending)
+
+    def replace_many(self, documents, upsert=True):
+        """
+        Replace documents by `_id` with bulk_write (unordered), one per route. Documents which do not exist yet are
+        inserted (upsert), e.g. bulk import.
+
+        :param documents: validated documents with `_id`
+        :param upsert: insert documents which do not exist yet
+        :return: number of documents matched or upserted
+        """
+        if not documents:
+            return 0
+        self._assert_not_bucketed('use write_many instead')
+        if not all(map(lambda d: d.get('_id') is not None, documents)):
+            raise DeveloperFault('Unable to replace document without _id')
+        if self.sub_collection_name is not None:
+            map(lambda d: d.__setitem__('_subtype', self.sub_collection_name), documents)
+        if self.writer is not None:
+            self.writer.flush()
+        self.invalidate()
+        started = time.time()
+        written = 0
+        for collection, routed in self.routes_of(documents):
+            requests = map(lambda d: ReplaceOne({'_id': d['_id']}, d, upsert=upsert), routed)
+            result = collection.bulk_write(requests, ordered=False)
+            written += result.matched_count + result.upserted_count
+        self._record_written(documents)
+        self.invalidate()
+        self.emit('write', {'_id': {'$in': map(lambda d: d['_id'], documents)}}, time.time() - started,
+                  returned=written)
+        return written
+
+    def _record_written(self, documents):
+        """
+        Count compressed values of written documents, see FieldCompressed.savings()
+        """
+        for key, fs in self.compressed_fields:
+            map(lambda d: fs.record(d.get(key)), documents)
+
+    def _assert_not_bucketed(self, alternative):
+        """
+        Operations of bucket documents are refused on bucketed models (Meta.bucket), they would not see readings.
+        """
+        if self.bucketing is not None:
+            raise DeveloperFault('"%s" is bucketed (Meta.bucket), %s' % (self.collection_name, alternative))
+
+    def write_behind(self, document):
+        """
+        Queue new document to be inserted by background writer (Meta.write_behind), return at once.
+
+        :param document: validated document, with pre-assigned `_id`
+        :return: object_id
+        """
+        if self.writer is None:
+            raise DeveloperFault('"%s" is not configured with Meta.write_behind' % self.collection_name)
+        if self.sub_collection_name is not None:
+            document['_subtype'] = self.sub_collection_name
+        self.writer.put(document)
+        self._record_written([document])
+        return document['_id']
+
+    def flush(self):
+        """
+        Block until queued documents (Meta.write_behind) are written
+        """
+        if self.writer is not None:
+            self.writer.flush()
+
+    def invalidate(self):
+        """
+        Drop cached results of this collection, called before and after each write (results read while the write
+        was in flight are dropped too), and by watcher.ChangeWatcher for writes of other processes.
+        Bumps the write version shared by every model of the collection, stale Meta.result_cache entries are missed.
+        """
+        Docs.count_caches.pop(self.db_name, None)
+        Docs.write_versions[self.db_name] = next(_write_versions)
+
+    @property
+    def write_version(self):
+        return Docs.write_versions.get(self.db_name, 0)
 
     def delete(self, cond=None, verbose=False):
         """
@@ -69,21 +416,33 @@ class Docs(object):
         :param verbose:
         :return:
         """
-        cond = {} if cond is None else cond
-        on_delete = self._on_delete[self.db_name] if self.db_name in self._on_delete else []
+        cond = self.scope(cond)
+        on_delete = Docs._on_delete.get(self.db_name, [])
         if verbose:
             print 'Deleting "%s": %s' % (self.db_name, cond)
 
+        collections = self.collections_for(cond)
         # If there are listeners
         if len(on_delete) > 0:
             # Calculate ids - and delete them.
-            ids = self.o.find(cond).distinct('_id')
+            if self.bucketing is not None:
+                ids = map(lambda raw: raw['_id'], BucketCursor(self, cond).raws())
+            else:
+                ids = reduce(lambda ids, c: ids + c.find(cond).distinct('_id'), collections, [])
             map(lambda de: de(ids, verbose), on_delete)
-        self.o.delete_many(cond)
+        self.invalidate()
+        started = time.time()
+        if self.bucketing is not None:
+            deleted = sum(map(lambda c: self.bucketing.remove(c, cond), collections))
+        else:
+            deleted = sum(map(lambda c: c.delete_many(cond).deleted_count, collections))
+        self.invalidate()
+        self.emit('delete', cond, time.time() - started, returned=deleted)
 
     def update(self, cond, update, **kwargs):
         """
         Call pymongo update_many directly, (upsert=False) - no field validation will be applied.
+        Snapshots embedded by other collections are not refreshed (see refresh_embedded).
 
         Use this method at your own risk.
 
@@ -92,53 +451,685 @@ class Docs(object):
         :param kwargs:
         :return:
         """
-        if cond is None:
-            cond = {}
+        self._assert_not_bucketed('update readings with save() instead')
+        cond = self.scope(cond)
         if update is None:
             raise DeveloperFault('update cannot be none')
         verbose = kwargs.pop('verbose', False)
         if verbose:
             print 'Updating "%s": %s' % (self.db_name, cond)
-        self.o.update_many(cond, update, upsert=False)
+        self.invalidate()
+        started = time.time()
+        modified = sum(map(lambda c: c.update_many(cond, update, upsert=False).modified_count, self.collections_for(cond)))
+        self.invalidate()
+        self.emit('update', cond, time.time() - started, returned=modified)
 
-    def find(self, *args, **kwargs):
+    def update_fields(self, cond=None, set=None, inc=None, unset=None, updates=None, **kwargs):
+        """
+        Validated update. Field names are translated to document keys (FieldSpec.key), values are passed through
+        field's from_python, validate and to_document. All updates are sent in a single bulk_write.
+        Snapshots embedded by other collections are not refreshed (see refresh_embedded).
+
+        Usage:
+            SimpleDocument.manager.update_fields({'int_val': 5}, set={'str_val': 'x'}, inc={'int_val': 1})
+            SimpleDocument.manager.update_fields(updates=[
+                ({'_id': a}, {'set': {'str_val': 'a'}}),
+                ({'_id': b}, {'inc': {'int_val': 2}, 'unset': ['str_val']}),
+            ])
+
+        :param cond: condition (document keys) of update given by set, inc and unset
+        :param set: {field_name: value}, dotted path of nested fields are allowed
+        :param inc: {field_name: number}, only numeric fields
+        :param unset: list of field names, fields must accept None
+        :param updates: list of (cond, {'set': ..., 'inc': ..., 'unset': ...}) for per-document updates
+        :return: number of modified documents
+        """
+        self._assert_not_bucketed('update readings with save() instead')
+        verbose = kwargs.pop('verbose', False)
+        cond = query.condition(cond)
+        requests = map(lambda (c, u): (query.condition(c), u), updates or [])
+        if set or inc or unset:
+            requests.insert(0, (cond, {'set': set, 'inc': inc, 'unset': unset}))
+        if not requests:
+            raise DeveloperFault('update_fields requires set, inc, unset or updates')
+        doc_class = Docs.factory_doc(self.collection_name)
+        routes = []             # list of (collection, operations), in order of first appearance
+        for c, u in requests:
+            operation = UpdateMany(self.scope(c), self._compile_update(doc_class, **u))
+            for collection in self.collections_for(operation._filter):
+                route = next((r for r in routes if r[0] is collection), None)
+                if route is None:
+                    route = (collection, [])
+                    routes.append(route)
+                route[1].append(operation)
+        if verbose:
+            print 'Updating "%s": %s' % (self.db_name, map(lambda (c, u): c, requests))
+        self.invalidate()
+        started = time.time()
+        modified = sum(map(lambda (collection, operations): collection.bulk_write(operations, ordered=False).modified_count,
+                           routes))
+        self.invalidate()
+        self.emit('update', cond if len(requests) == 1 else {'$or': map(lambda (c, u): c or {}, requests)},
+                  time.time() - started, returned=modified)
+        return modified
+
+    @staticmethod
+    def _compile_update(doc_class, set=None, inc=None, unset=None):
+        def spec_of(path):
+            fs = field_spec_at(doc_class, path)
+            if fs is None:
+                raise DeveloperFault('"%s" has no field "%s"' % (doc_class.__name__, path))
+            return fs
+
+        update = {}
+        for path, value in (set or {}).iteritems():
+            fs = spec_of(path)
+            value = fs.from_python(value)
+            fs.validate(value, path)
+            update.setdefault('$set', {})[document_path(doc_class, path)] = fs.to_document(value)
+        for path, value in (inc or {}).iteritems():
+            if not isinstance(spec_of(path), FieldNumeric) or isinstance(value, bool) \
+                    or not isinstance(value, (int, long, float)):
+                raise FieldValidationError(value, 'Invalid data type.', path)
+            update.setdefault('$inc', {})[document_path(doc_class, path)] = value
+        for path in unset or []:
+            spec_of(path).validate(None, path)
+            update.setdefault('$unset', {})[document_path(doc_class, path)] = ''
+        if not update:
+            raise DeveloperFault('update_fields requires set, inc or unset')
+        return update
+
+    @classmethod
+    def add_listener(cls, listener):
+        """
+        Register instrumentation listener, listener is called with instruments.OperationEvent after each
+        find (once cursor is exhausted or closed), count, aggregate, lookup, write, update and delete.
+        Listeners are called by the thread running the operation, never by garbage collection.
+
+        :param listener: callable(event), e.g. instruments.LatencyAggregator, instruments.ExplainSampler
+        """
+        with _registry_lock:
+            Docs.listeners = Docs.listeners + [listener]
+
+    @classmethod
+    def remove_listener(cls, listener):
+        with _registry_lock:
+            Docs.listeners = filter(lambda l: l is not listener, Docs.listeners)
+
+    def emit(self, operation, cond, duration, returned=None, inflate_time=0.0, read_preference=None):
+        listeners = Docs.listeners
+        if not listeners:
+            return
+        event = OperationEvent(self, operation, cond, duration, returned, inflate_time, read_preference)
+        map(lambda listener: listener(event), listeners)
+
+    def _inflater(self):
+        """
+        Create inflate callback which turn raw document into registered Doc instance, dispatched via `_subtype`.
+
+        :return: callback(raw_document) -> Doc, raw documents with same `_id` yield the same instance.
+        """
         cache = {}
+        classes = Docs.subtypes.get(self.db_name, {})
 
         def inflate(doc):
             key = str(doc['_id'])
             if key not in cache:
-                doc_key = self.collection_name
-                if '_subtype' in doc:
-                    subtype = doc.pop('_subtype')
-                    doc_key = "%s:%s" % (self.db_name, subtype)
-                if doc_key not in Docs.installed:
-                    raise DeveloperFault("Unknown document type:%s" % doc_key)
-                o = Docs.installed[doc_key]()
+                subtype = doc.pop('_subtype', None)
+                if subtype not in classes:
+                    raise DeveloperFault("Unknown document type:%s:%s" % (self.db_name, subtype))
+                o = classes[subtype]()
                 o.inflate(doc)
                 cache[key] = o
             return cache[key]
 
-        r = MaskedCursor(self.o, *args, **kwargs)
-        r.inflate_callback = inflate
+        return inflate
+
+    def scope(self, cond=None):
+        """
+        Restrict condition to documents of this sub collection's class tree (`_subtype` of the class and its
+        subclasses). Parent's manager and conditions which already specify `_subtype` are not restricted.
+
+        :param cond: condition, query.Query or query.Template, None means every document.
+        :return: condition
+        """
+        cond = {} if cond is None else query.condition(cond)
+        if self.sub_collection_name is None or '_subtype' in cond:
+            return cond
+        classes, subtypes = self.scoped_subtypes
+        if classes is not Docs.subtypes.get(self.db_name):
+            classes = Docs.subtypes.get(self.db_name, {})
+            doc_class = Docs.installed[self.collection_name]
+            subtypes = sorted(subtype for subtype, c in classes.iteritems()
+                              if subtype is not None and issubclass(c, doc_class))
+            self.scoped_subtypes = (classes, subtypes)
+        cond = copy.copy(cond)
+        cond['_subtype'] = subtypes[0] if len(subtypes) == 1 else {'$in': subtypes}
+        return cond
+
+    def collection(self, read_preference=None, connection_name=None):
+        """
+        :param read_preference: see conf.parse_read_preference, None means model's read preference (Meta.read_preference)
+        :param connection_name: connection (route) of the collection, None means model's connection_name
+        :return: pymongo's collection with given read preference
+        """
+        if connection_name == self.connection_name:
+            connection_name = None
+        if read_preference is None and connection_name is None:
+            return self.o
+        read_preference = self.read_preference if read_preference is None else parse_read_preference(read_preference)
+        key = (connection_name, read_preference and helper.canonical(read_preference.document))
+        if key not in self._collections:
+            collection = self.o if connection_name is None else get_connection(connection_name)[self.db_name]
+            if read_preference is not None:
+                collection = collection.with_options(read_preference=read_preference)
+            self._collections.setdefault(key, collection)
+        return self._collections[key]
+
+    def bucket(self, name='fs'):
+        """
+        File bucket (GridFS layout) in model's database, see FieldFile
+        """
+        if name not in self._buckets:
+            self._buckets.setdefault(name, files.Bucket(self.db, name))
+        return self._buckets[name]
+
+    def collections_for(self, cond, read_preference=None):
+        """
+        Collections (one per route, see Meta.router) to be queried by given condition
+        """
+        if self.router is None:
+            return [self.collection(read_preference)]
+        return map(lambda c: self.collection(read_preference, c), self.router.for_condition(cond))
+
+    def routes_of(self, documents):
+        """
+        Group raw documents by their route (see Meta.router)
+
+        :return: list of (collection, documents)
+        """
+        if self.router is None:
+            return [(self.o, documents)] if documents else []
+        routes = {}
+        map(lambda d: routes.setdefault(self.router.for_document(d), []).append(d), documents)
+        return map(lambda (c, routed): (self.collection(connection_name=c), routed), sorted(routes.items()))
+
+    def load_raw(self, object_id):
+        """
+        Raw document by `_id`, every route is looked up until it is found (see Meta.router).
+        """
+        started = time.time()
+        raw = None
+        if self.bucketing is not None:
+            raw = next(iter(BucketCursor(self, {'_id': object_id}).raws()), None)
+        else:
+            for collection in self.collections_for({'_id': object_id}):
+                raw = collection.find_one({'_id': object_id})
+                if raw is not None:
+                    break
+        self.emit('find', {'_id': object_id}, time.time() - started, returned=int(raw is not None))
+        return raw
+
+    def find(self, *args, **kwargs):
+        """
+        pymongo's find, returned cursor inflates documents.
+
+        :param read_preference: keyword only, route this query, e.g. 'secondaryPreferred' (see collection())
+        :return: cursor, or routing.ScatterCursor when condition is routed to more than one connection (Meta.router),
+            or timeseries.BucketCursor of readings of bucketed model (Meta.bucket)
+        """
+        read_preference = kwargs.pop('read_preference', None)
+        if 'filter' in kwargs:
+            kwargs['filter'] = cond = self.scope(kwargs['filter'])
+        else:
+            args = (self.scope(args[0] if args else None),) + args[1:]
+            cond = args[0]
+        if self.bucketing is not None:
+            if len(args) > 1 or set(kwargs) - {'filter'}:
+                raise DeveloperFault('"%s" is bucketed (Meta.bucket), find only accepts condition'
+                                     % self.collection_name)
+            return BucketCursor(self, cond)
+        collections = self.collections_for(cond, read_preference)
+        if len(collections) > 1:
+            return ScatterCursor(self, map(lambda c: c.find(*args, **kwargs), collections), cond)
+        collection = collections[0]
+        r = masked_cursor_class(getattr(type(collection), 'cursor_class', Cursor))(collection, *args, **kwargs)
+        r.inflate_callback = self._inflater()
+        r.manager = self
         return r
 
-    def count(self, cond, **kwargs):
-        if cond is None:
-            cond = {}
-        cond.update(kwargs)
-        return self.o.find(cond, []).count()
+    def find_cached(self, cond=None, sort=None, skip=0, limit=0, projection=None):
+        """
+        Find through the result cache (Meta.result_cache), results are cached until the next write of the collection.
+
+        :param cond: condition, query.Query or query.Template
+        :param sort: list of (key, direction), or key
+        :param projection: find projection
+        :return: list of Doc
+        """
+        if self.result_cache is None:
+            raise DeveloperFault('"%s" has no Meta.result_cache' % self.collection_name)
+        cond = self.scope(cond)
+        sort = [(sort, 1)] if isinstance(sort, basestring) else map(tuple, sort or [])
+        key = helper.canonical(('find', cond, sort, skip, limit, projection))
+        version = self.write_version
+        hit, cached = self.result_cache.get(key, version)
+        if hit and self.result_cache.store == 'raw':
+            return map(self._inflater(), copy.deepcopy(cached))
+        if hit:
+            started = time.time()
+            raws = list(self._find_raws({'_id': {'$in': cached}}, projection=projection))
+            self.emit('find', {'_id': {'$in': cached}}, time.time() - started, returned=len(raws))
+            by_id = dict(map(lambda raw: (raw['_id'], raw), raws))
+            return map(self._inflater(), filter(None, map(by_id.get, cached)))
+        started = time.time()
+        raws = list(self._find_raws(cond, sort, skip, limit, projection))
+        self.emit('find', cond, time.time() - started, returned=len(raws))
+        if self.result_cache.store == 'raw':
+            self.result_cache.put(key, version, copy.deepcopy(raws))
+        else:
+            self.result_cache.put(key, version, map(lambda raw: raw['_id'], raws))
+        return map(self._inflater(), raws)
+
+    def _find_raws(self, cond, sort=None, skip=0, limit=0, projection=None):
+        """
+        Raw documents of condition from every route, or readings of bucketed model (Meta.bucket).
+        """
+        if self.bucketing is not None:
+            if projection is not None:
+                raise DeveloperFault('"%s" is bucketed (Meta.bucket), projection is not supported'
+                                     % self.collection_name)
+            cursor = BucketCursor(self, cond)
+        else:
+            cursors = map(lambda c: c.find(cond, projection), self.collections_for(cond))
+            cursor = cursors[0] if len(cursors) == 1 else ScatterCursor(self, cursors, cond)
+        if sort:
+            cursor.sort(sort)
+        cursor.skip(skip).limit(limit)
+        return cursor.raws() if isinstance(cursor, (BucketCursor, ScatterCursor)) else cursor
+
+    def aggregate(self, pipeline, inflate=True, allow_disk_use=True, batch_size=None, read_preference=None, **kwargs):
+        """
+        Call pymongo's aggregate, results are streamed from server side cursor.
+
+        :param pipeline: list of stages, or aggregation.Pipeline (any iterable of stages)
+        :param inflate: inflate result documents into registered Doc classes (requires `_id`).
+        :param allow_disk_use: allow server to spill large stages to disk.
+        :param batch_size: number of documents per server round trip.
+        :param read_preference: route this aggregation, e.g. 'secondary' (see collection()). Routed models
+            (Meta.router) are aggregated on the route given by leading $match.
+        :param kwargs: other options passed to pymongo's aggregate
+        :return: iterator of Doc instances (inflate=True) or raw dict
+        """
+        cond, cursor = self._aggregate(pipeline, allow_disk_use, batch_size, read_preference, **kwargs)
+        cursor = self._emitting('aggregate', cond, cursor, read_preference)
+        if not inflate:
+            return cursor
+        return itertools.imap(self._inflater(), cursor)
+
+    def _aggregate(self, pipeline, allow_disk_use=True, batch_size=None, read_preference=None, **kwargs):
+        """
+        :return: tuple of (leading $match, pymongo's aggregate cursor), see aggregate
+        """
+        kwargs['allowDiskUse'] = allow_disk_use
+        if batch_size is not None:
+            kwargs['batchSize'] = batch_size
+        pipeline = list(pipeline)
+        if self.sub_collection_name is not None:
+            pipeline.insert(0, {'$match': self.scope()})
+        # routed by leading $match (Meta.router), results of several routes cannot be merged
+        cond = pipeline[0]['$match'] if pipeline and '$match' in pipeline[0] else None
+        collections = self.collections_for(cond, read_preference)
+        if len(collections) > 1:
+            raise DeveloperFault('"%s" is routed to %d connections, aggregate requires a leading $match of a single '
+                                 'route' % (self.collection_name, len(collections)))
+        return cond, collections[0].aggregate(pipeline, **kwargs)
+
+    def _emitting(self, operation, cond, cursor, read_preference=None):
+        """
+        Iterate cursor, emit event of operation once it is exhausted. Duration is the time spent in fetching
+        documents.
+        """
+        cursor = iter(cursor)
+        end = object()
+        duration = 0.0
+        returned = 0
+        while True:
+            started = time.time()
+            o = next(cursor, end)
+            duration += time.time() - started
+            if o is end:
+                break
+            returned += 1
+            yield o
+        self.emit(operation, cond, duration, returned=returned, read_preference=read_preference)
+
+    def paginate(self, cond=None, sort=None, after=None, limit=20):
+        """
+        Keyset (seek) pagination, every page is an index seek instead of walking skipped documents.
+
+        `_id` is appended to sort as tie breaker. An index (Meta.indices) led by the sort keys is required.
+
+        :param cond: find condition
+        :param sort: list of (field_name, direction), default is [('object_id', 1)]
+        :param after: continuation token returned from previous page, None for first page
+        :param limit: page size
+        :return: tuple of (list of Doc, continuation token or None when there is no more page)
+        """
+        self._assert_not_bucketed('use find().sort().limit() instead')
+        doc_class = Docs.installed[self.collection_name]
+        sort = map(lambda (k, d): (document_path(doc_class, k), d), sort or [('_id', 1)])
+        if sort[-1][0] != '_id':
+            sort.append(('_id', sort[-1][1]))
+        sort_keys = map(lambda (k, d): k, sort)
+        if not self.has_index_for(sort[:-1]):
+            raise DeveloperFault('No index in Meta.indices supports sort %s' % sort[:-1])
+
+        cond = self.scope(cond)
+        if after is not None:
+            try:
+                token = helper.decode_token(after)
+                keys, values = token['k'], token['v']
+            except Exception:
+                raise DeveloperFault('Malformed continuation token')
+            if keys != sort_keys or not isinstance(values, list) or len(values) != len(sort_keys):
+                raise DeveloperFault('Continuation token does not match sort %s' % sort_keys)
+            # (k1 > v1) or (k1 == v1 and k2 > v2) or ...
+            # null (or missing) sorts first, and comparison operators never match it
+            seek = []
+            for i, (k, d) in enumerate(sort):
+                c = dict(zip(sort_keys[:i], values[:i]))
+                if d > 0:
+                    c[k] = {'$ne': None} if values[i] is None else {'$gt': values[i]}
+                elif values[i] is None:
+                    continue        # nothing sorts after null in descending order
+                else:
+                    c['$or'] = [{k: {'$lt': values[i]}}, {k: None}]
+                seek.append(c)
+            cond = {'$and': [cond, {'$or': seek}]}
+
+        inflate = self._inflater()
+        started = time.time()
+        raws = list(self._find_raws(cond, sort, limit=limit))
+        self.emit('find', cond, time.time() - started, returned=len(raws))
+        next_token = None
+        if len(raws) == limit and limit > 0:
+            next_token = helper.encode_token({'k': sort_keys, 'v': map(lambda k: helper.value_at(raws[-1], k), sort_keys)})
+        return map(inflate, raws), next_token
+
+    def has_index_for(self, sort):
+        """
+        Check if any index in Meta.indices (including parent's collection indices) is led by given sort keys,
+        in same direction or totally reversed.
+
+        :param sort: list of (document_key, direction)
+        :return:
+        """
+        if len(sort) == 0:
+            return True
+        indices = self.indices
+        if self.sub_collection_name is not None and self.db_name in Docs.installed:
+            indices = indices + Docs.installed[self.db_name].manager.indices
+        reverse = map(lambda (k, d): (k, -d), sort)
+        for key, options in indices:
+            key = [(key, 1)] if isinstance(key, basestring) else map(tuple, key)
+            if key[:len(sort)] in (sort, reverse):
+                return True
+        return False
+
+    def lookup(self, paths, cond=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+        """
+        Find documents and populate FieldDoc, FieldList(FieldDoc) fields in a single round trip using $lookup.
+
+        Only first segment of each path is joined by server, the rest of path is populated by Doc.populate.
+
+        :param paths: list of field name paths to be populated
+        :param cond: find condition
+        :param projection: find projection
+        :param sort: list of (key, direction)
+        :param skip:
+        :param limit: 0 means no limit
+        :param kwargs: other options passed to aggregate
+        :return: iterator of populated Doc
+        """
+        self._assert_not_bucketed('use find() and Doc.populate instead')
+        fields = _field_specs(Docs.installed[self.collection_name])[0]
+        pipeline = [{'$match': self.scope(cond)}]
+        if sort:
+            pipeline.append({'$sort': SON(sort)})
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        if projection is not None:
+            pipeline.append({'$project': projection})
+
+        joins = []
+        for path in paths:
+            field_name, sp, next_path = path.partition('.')
+            fs = fields.get(field_name)
+            element_fs = fs.element_fieldspecs if isinstance(fs, FieldList) else fs
+            if not isinstance(element_fs, FieldDoc):
+                raise DeveloperFault('Unable to lookup "%s", FieldDoc or FieldList(FieldDoc) is required' % path)
+            target = element_fs.doc_clz().manager
+            alias = '_lookup_%s' % field_name
+            pipeline.append({'$lookup': {
+                'from': target.db_name,
+                'localField': (fs.key or field_name) + ('._id' if element_fs.embed else ''),
+                'foreignField': '_id',
+                'as': alias
+            }})
+            joins.append((field_name, next_path, alias, isinstance(fs, FieldList), target._inflater()))
+
+        inflate = self._inflater()
+
+        def populate(raw):
+            joined = map(lambda j: (j, raw.pop(j[2], [])), joins)
+            o = inflate(raw)
+            for (field_name, next_path, alias, many, target_inflate), raws in joined:
+                by_id = dict(map(lambda r: (r['_id'], target_inflate(r)), raws))
+                value = o.dox.get(field_name)
+                if many:
+                    o.dox[field_name] = filter(lambda v: v is not None, map(by_id.get, value or []))
+                    populated = o.dox[field_name]
+                else:
+                    o.dox[field_name] = by_id.get(value)
+                    populated = filter(lambda v: v is not None, [o.dox[field_name]])
+                if next_path:
+                    map(lambda v: v.populate(next_path), populated)
+            return o
+
+        cond, cursor = self._aggregate(pipeline, **kwargs)
+        return itertools.imap(populate, self._emitting('lookup', cond, cursor, kwargs.get('read_preference')))
+
+    def count(self, cond=None, hint=None, limit=None, read_preference=None, **kwargs):
+        """
+        Call pymongo's count_documents, results are cached for `count_cache_ttl` seconds (Meta.count_cache_ttl)
+
+        :param cond:
+        :param hint: index to use
+        :param limit: maximum number of documents to count
+        :param read_preference: route this count (see collection())
+        :param kwargs: merged into cond
+        :return:
+        """
+        cond = self.scope(dict(query.condition(cond) or {}, **kwargs))
+        options = {}
+        if hint is not None:
+            options['hint'] = hint
+        if limit:
+            options['limit'] = limit
+        if read_preference is not None:
+            options['read_preference'] = read_preference
+        # counts read from secondaries are not served to primary reads
+        preference = read_preference and parse_read_preference(read_preference).document
+        if self.result_cache is not None:
+            key = helper.canonical(('count', cond, hint, limit, preference))
+            version = self.write_version
+            hit, n = self.result_cache.get(key, version)
+            if not hit:
+                n = self._count_documents(cond, **options)
+                self.result_cache.put(key, version, n)
+            return n
+        if self.count_cache_ttl <= 0:
+            return self._count_documents(cond, **options)
+
+        # LRU shared by every model of the collection (cond is scoped), a write in flight drops the cache read here
+        key = helper.canonical((cond, hint, limit, preference))
+        now = time.time()
+        with _count_cache_lock:
+            cache = Docs.count_caches.get(self.db_name)
+            if cache is None:
+                cache = Docs.count_caches[self.db_name] = OrderedDict()
+            cached = cache.pop(key, None)
+            if cached is not None and cached[0] > now:
+                cache[key] = cached
+                return cached[1]
+        n = self._count_documents(cond, **options)
+        with _count_cache_lock:
+            cache[key] = (now + self.count_cache_ttl, n)
+            while len(cache) > self.count_cache_size:
+                cache.popitem(last=False)
+        return n
+
+    def _count_documents(self, cond, read_preference=None, **options):
+        started = time.time()
+        if self.bucketing is not None:
+            n = self.bucketing.count(self.collections_for(cond, read_preference), cond)
+        else:
+            n = sum(map(lambda c: c.count_documents(cond, **options), self.collections_for(cond, read_preference)))
+        self.emit('count', cond, time.time() - started, returned=n, read_preference=read_preference)
+        return n
+
+    def estimated_count(self):
+        """
+        Call pymongo's estimated_document_count (collection metadata, no scan). Condition is not supported.
+        Sub collection cannot be estimated, count by `_subtype` instead.
+
+        :return:
+        """
+        if self.sub_collection_name is not None or self.bucketing is not None:
+            return self.count()
+        return sum(map(lambda c: c.estimated_document_count(), self.collections_for(None)))
 
     def _create_index(self, key, options):
-        index_name = self.o.create_index(key, **options)
+        index_name = map(lambda c: c.create_index(key, **options), self.collections_for(None))[0]
         print("\t=> Created index %s %s = %s" % (key, options, index_name))
         return index_name
 
     def _add_delete_trigger(self, trigger_source_db_name, reference_field):
-        if trigger_source_db_name not in self._on_delete:
-            self._on_delete[trigger_source_db_name] = []
-        self._on_delete[trigger_source_db_name].append(lambda ids, v: self.delete({reference_field: {'$in': ids}}, v))
+        trigger = lambda ids, v: self.delete({reference_field: {'$in': ids}}, v)
+        with _registry_lock:
+            on_delete = dict(Docs._on_delete)
+            on_delete[trigger_source_db_name] = on_delete.get(trigger_source_db_name, []) + [trigger]
+            Docs._on_delete = on_delete
         print("\t=> Created delete trigger: '%s' will chain delete collection='%s', field='%s'" % (trigger_source_db_name, self.db_name, reference_field))
 
+    def _unreferenced_files(self, bucket_name, file_ids, excluded_ids):
+        """
+        Files of bucket which are not referred by any document (FieldFile of any installed model of the same
+        database), except documents of excluded_ids (being deleted, or replacing their file).
+        """
+        referenced = set()
+        seen = set()
+        for doc_class in Docs.installed.values():
+            manager = doc_class.manager
+            if manager.db.name != self.db.name:
+                continue
+            for name, key, fs in manager.file_fields:
+                if fs.bucket != bucket_name or (manager.db_name, key) in seen:
+                    continue
+                seen.add((manager.db_name, key))
+                cond = {key: {'$in': file_ids}, '_id': {'$nin': excluded_ids}}
+                referenced.update(reduce(lambda a, c: a + c.find(cond).distinct(key),
+                                         manager.collections_for(cond), []))
+        return filter(lambda file_id: file_id not in referenced, file_ids)
+
+    def release_files(self, previous, document):
+        """
+        Delete files replaced by saved document (previous raw document), unless other documents still refer them.
+        """
+        for name, key, fs in self.file_fields:
+            replaced = previous.get(key)
+            if replaced is not None and replaced != document.get(key):
+                unreferenced = self._unreferenced_files(fs.bucket, [replaced], [document['_id']])
+                self.bucket(fs.bucket).delete_many(unreferenced)
+
+    def _add_file_trigger(self, key, field_file):
+        def trigger(ids, verbose):
+            # files of deleted documents (not referred by other documents), looked up and deleted in batches
+            bucket = self.bucket(field_file.bucket)
+            for i in range(0, len(ids), files.DELETE_BATCH_SIZE):
+                batch = ids[i:i + files.DELETE_BATCH_SIZE]
+                cond = {'_id': {'$in': batch}, key: {'$ne': None}}
+                file_ids = reduce(lambda a, c: a + c.find(cond).distinct(key), self.collections_for(cond), [])
+                if file_ids:
+                    file_ids = self._unreferenced_files(field_file.bucket, file_ids, batch)
+                deleted = bucket.delete_many(file_ids)
+                if verbose:
+                    print 'Deleting %d files of "%s" from bucket "%s"' % (deleted, self.db_name, bucket.name)
+        trigger.file_key = (field_file.bucket, key)
+        with _registry_lock:
+            triggers = Docs._on_delete.get(self.db_name, [])
+            if any(getattr(t, 'file_key', None) == trigger.file_key for t in triggers):
+                return          # inherited by sub collection, parent's trigger covers it
+            on_delete = dict(Docs._on_delete)
+            on_delete[self.db_name] = triggers + [trigger]
+            Docs._on_delete = on_delete
+        print("\t=> Created file trigger: '%s' will delete files of field='%s' from bucket='%s'"
+              % (self.db_name, key, field_file.bucket))
+
+    def _add_embed_trigger(self, path, is_list, field_doc):
+        target_db_name = field_doc.target_db_name()
+        with _registry_lock:
+            triggers = Docs._on_save.get(target_db_name, [])
+            if any(m.db_name == self.db_name and p == path for m, p, l, f in triggers):
+                return          # inherited by sub collection, parent's trigger covers it
+            on_save = dict(Docs._on_save)
+            on_save[target_db_name] = triggers + [(self, path, is_list, field_doc)]
+            Docs._on_save = on_save
+        print("\t=> Created embed trigger: '%s' will refresh collection='%s', field='%s'"
+              % (target_db_name, self.db_name, path))
+
+    def refresh_embedded(self, document, previous=None):
+        """
+        Refresh snapshots of saved document embedded by referencing collections (FieldDoc embed), one bulk_write of
+        update_many per referencing collection.
+
+        :param document: saved raw document
+        :param previous: raw document before save, only changed embedded fields are refreshed, None means every one.
+        :return: number of modified referencing documents
+        """
+        requests = []           # list of (manager, operations)
+        object_id = document['_id']
+        for manager, path, is_list, field_doc in Docs._on_save.get(self.db_name, []):
+            keys = map(lambda (name, key): key, field_doc.embedded_keys())
+            changed = filter(lambda k: previous is None or previous.get(k) != document.get(k), keys)
+            if not changed:
+                continue
+            cond = manager.scope({'%s._id' % path: object_id})
+            if is_list:
+                updates = dict(('%s.$[ref].%s' % (path, k), document.get(k)) for k in changed)
+                operation = UpdateMany(cond, {'$set': updates}, array_filters=[{'ref._id': object_id}])
+            else:
+                updates = dict(('%s.%s' % (path, k), document.get(k)) for k in changed)
+                operation = UpdateMany(cond, {'$set': updates})
+            route = next((r for r in requests if r[0] is manager), None)
+            if route is None:
+                route = (manager, [])
+                requests.append(route)
+            route[1].append(operation)
+        modified = 0
+        for manager, operations in requests:
+            manager.invalidate()
+            started = time.time()
+            collections = manager.collections_for(None)
+            n = sum(map(lambda c: c.bulk_write(operations, ordered=False).modified_count, collections))
+            manager.invalidate()
+            manager.emit('update', {'$or': map(lambda o: o._filter, operations)}, time.time() - started, returned=n)
+            modified += n
+        return modified
+
     @classmethod
     def register(cls, doc_class, indices=[], references=[]):
         """
@@ -149,36 +1140,132 @@ class Docs(object):
         :return:
         """
 
-        # if sub_name exists Let's validate if the class is an extension of its parent
-        if doc_class.manager.sub_collection_name is not None and not issubclass(doc_class, Docs.installed[doc_class.manager.db_name]):
-            raise DeveloperFault("Extension of collection must be extension of same class hierarchy.")
-
-        Docs.installed[doc_class.manager.collection_name] = doc_class
+        with _registry_lock:
+            # if sub_name exists Let's validate if the class is an extension of its parent
+            if doc_class.manager.sub_collection_name is not None and not issubclass(doc_class, Docs.installed[doc_class.manager.db_name]):
+                raise DeveloperFault("Extension of collection must be extension of same class hierarchy.")
+
+            installed = dict(Docs.installed)
+            installed[doc_class.manager.collection_name] = doc_class
+            # first sub collection of the collection, queries of sub collections are scoped by _subtype
+            index_subtype = doc_class.manager.sub_collection_name is not None \
+                and not filter(None, Docs.subtypes.get(doc_class.manager.db_name, {}))
+            subtypes = dict(Docs.subtypes)
+            subtypes[doc_class.manager.db_name] = dict(subtypes.get(doc_class.manager.db_name, {}))
+            subtypes[doc_class.manager.db_name][doc_class.manager.sub_collection_name] = doc_class
+            Docs.installed, Docs.subtypes = installed, subtypes
+        doc_class.manager.indices = list(indices)
+        if doc_class.manager.bucketing is not None:
+            doc_class.manager.bucketing.bind(doc_class, _field_specs(doc_class)[0])
+            map(lambda k: doc_class.manager._create_index(k, {}), doc_class.manager.bucketing.indices())
+        if index_subtype:
+            indices = [([('_subtype', 1)], {})] + list(indices)
         # Call create_index
         map(lambda (k, o): doc_class.manager._create_index(k, o), indices)
         map(lambda (c, f): doc_class.manager._add_delete_trigger(c, f), references)
+        map(lambda (p, l, fs): doc_class.manager._add_embed_trigger(p, l, fs), _embedded_references(doc_class))
+        doc_class.manager.file_fields = map(lambda (k, fs): (k, fs.key or k, fs),
+                                            filter(lambda (k, fs): isinstance(fs, FieldFile),
+                                                   _field_specs(doc_class)[0].iteritems()))
+        map(lambda (k, key, fs): doc_class.manager._add_file_trigger(key, fs), doc_class.manager.file_fields)
+        doc_class.manager.compressed_fields = map(lambda (k, fs): (fs.key or k, fs),
+                                                  filter(lambda (k, fs): isinstance(fs, FieldCompressed),
+                                                         _field_specs(doc_class)[0].iteritems()))
 
     @classmethod
     def factory(cls, collection_name, object_id=None):
         if object_id is None:
-            return Docs.installed[collection_name]()
-        man = cls.installed[collection_name].manager
-        raw = man.o.find_one(helper.object_id(object_id))
-        doc_key = man.db_name
-        if '_subtype' in raw:
-            subtype = raw.pop('_subtype')
-            doc_key = "%s:%s" % (man.db_name, subtype)
-        if doc_key not in Docs.installed:
-            raise DeveloperFault("Unknown document type:%s" % doc_key)
-        o = cls.installed[doc_key]()
-        o.inflate(raw)
-        return o
+            return cls.factory_doc(collection_name)()
+        man = cls.factory_doc(collection_name).manager
+        raw = man.load_raw(helper.object_id(object_id))
+        return man._inflater()(raw)
 
     @classmethod
     def factory_doc(cls, collection_name):
+        """
+        Model class of collection_name, model's module is imported on first use if it is declared (see model_path).
+        """
         if collection_name in cls.installed:
             return cls.installed[collection_name]
-        raise DeveloperFault('Unknown collection_name %s' % collection_name)
+        path = cls.model_path(collection_name)
+        if path is None:
+            raise DeveloperFault('Unknown collection_name %s' % collection_name)
+        # Not under _registry_lock, models register themselves while being imported (by any thread).
+        before = Docs.installed
+        started = time.time()
+        module_name, sep, class_name = path.partition(':')
+        module = importlib.import_module(module_name)
+        if class_name:
+            reduce(getattr, class_name.split('.'), module)
+        if collection_name not in Docs.installed:
+            raise DeveloperFault('"%s" does not define model of collection_name %s' % (path, collection_name))
+        loaded = {
+            'collection_name': collection_name,
+            'path': path,
+            'seconds': time.time() - started,
+            'models': sorted(set(Docs.installed) - set(before)),
+        }
+        with _registry_lock:
+            Docs.lazy_loaded = Docs.lazy_loaded + [loaded]
+        print 'Model "%s" is loaded from "%s" in %.3fs' % (collection_name, path, loaded['seconds'])
+        return Docs.installed[collection_name]
+
+    @classmethod
+    def declare(cls, collection_name, path):
+        """
+        Declare module of a model, so it is imported on first use (factory_doc, FieldDoc('collection_name')) instead
+        of up front.
+
+        :param path: dotted import path, 'package.module' or 'package.module:ClassName'
+        """
+        with _registry_lock:
+            lazy = dict(Docs.lazy)
+            lazy[collection_name] = path
+            Docs.lazy = lazy
+
+    @classmethod
+    def model_path(cls, collection_name):
+        """
+        Dotted import path of model, given by declare(), [models] section of configuration, or entry points of
+        `entry_point_group` (name is collection_name), in that order.
+
+        :return: path, None if the model is not declared
+        """
+        path = Docs.lazy.get(collection_name) or Configuration.MODELS.get(collection_name)
+        if path is None:
+            if Docs._entry_points is None:
+                Docs._entry_points = cls._scan_entry_points()
+            path = Docs._entry_points.get(collection_name)
+        return path
+
+    @classmethod
+    def _scan_entry_points(cls):
+        try:
+            import pkg_resources
+        except ImportError:
+            return {}
+        return dict((e.name, '%s:%s' % (e.module_name, '.'.join(e.attrs)) if e.attrs else e.module_name)
+                    for e in pkg_resources.iter_entry_points(cls.entry_point_group))
+
+
+def _is_immutable(value):
+    if isinstance(value, tuple):
+        return all(map(_is_immutable, value))
+    return value is None or isinstance(value, (basestring, bool, int, long, float, ObjectId, datetime.datetime,
+                                               datetime.date, frozenset))
+
+
+def _default_policy(default):
+    """
+    :return: 'shared' (immutable), 'list' or 'dict' (shallow copied on read), or 'copy' (deep copied on read)
+    """
+    if _is_immutable(default):
+        return 'shared'
+    if type(default) is list and all(map(_is_immutable, default)):
+        return 'list'
+    if type(default) is dict and all(map(_is_immutable, default.itervalues())):
+        return 'dict'
+    return 'copy'
 
 
 # FieldSpec
@@ -193,6 +1280,7 @@ class FieldSpec(object):
         self.transient = kwargs.get('transient', False)   # if set, it is Subclass responsibility to handle data injection through populate method.
         self.validators = kwargs.get('validators', [])
         self.default = kwargs.get('default', None)
+        self.default_policy = _default_policy(self.default)
         self.choices = kwargs.get('choices', {})
         self.max_length = kwargs.get('max_length', 0)
         self.fixed_length = kwargs.get('fixed_length', None)
@@ -245,7 +1333,7 @@ class FieldSpec(object):
             return self
         v = instance.dox.get(self.field_name, None)
         if v is None and self.default is not None:
-            v = instance.dox[self.field_name] = copy.deepcopy(self.default)
+            v = self.default_of(instance)
         return v
 
     def __set__(self, instance, value):
@@ -254,6 +1342,22 @@ class FieldSpec(object):
         value = self.from_python(value)
         self.validate(value, self.field_name)
         instance.dox[self.field_name] = value
+        instance._touched.add(self.field_name)
+
+    def default_of(self, instance):
+        """
+        Default value of a field read as None. Immutable defaults are shared, flat list and dict defaults are shallow
+        copied, other defaults are deep copied. Copies are assigned to the instance, so every read returns the same
+        value.
+        """
+        if self.default_policy == 'shared':
+            return self.default
+        if self.default_policy == 'copy':
+            v = copy.deepcopy(self.default)
+        else:
+            v = list(self.default) if self.default_policy == 'list' else dict(self.default)
+        instance.dox[self.field_name] = v
+        return v
 
     def add_named_validator(self, callback, message):
         def callme(value, name):
@@ -424,6 +1528,33 @@ class FieldAnyDoc(FieldSpec):
         return r
 
 
+class EmbeddedRef(ObjectId):
+    """
+    Value of FieldDoc(..., embed=[...]) read from database, ObjectId of the referenced document with snapshot of its
+    embedded fields as attributes (by document key), e.g. ticket.owner.name
+    """
+    __slots__ = ('embedded',)
+
+    def __init__(self, embedded):
+        super(EmbeddedRef, self).__init__(embedded['_id'])
+        self.embedded = embedded
+
+    def __getattr__(self, name):
+        try:
+            return object.__getattribute__(self, 'embedded')[name]
+        except (AttributeError, KeyError):
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        return EmbeddedRef, (self.embedded,)
+
+    def __copy__(self):
+        return EmbeddedRef(self.embedded)
+
+    def __deepcopy__(self, memo):
+        return EmbeddedRef(copy.deepcopy(self.embedded, memo))
+
+
 class FieldDoc(FieldSpec):
 
     def __init__(self, doc_class_or_collection_name, **kwargs):
@@ -431,17 +1562,65 @@ class FieldDoc(FieldSpec):
             raise ValueError('FieldDoc only accept single document type')
         self.doc_class_or_collection_name = doc_class_or_collection_name
         self.doc_class = None
+        # field names of referenced document stored next to its ObjectId, kept fresh by Docs.refresh_embedded
+        self.embed = list(kwargs.pop('embed', []))
         super(FieldDoc, self).__init__((ObjectId, Doc), **kwargs)
 
     def to_document(self, value):
+        object_id = self.object_id_of(value)
+        if not self.embed or object_id is None:
+            return object_id
+        if isinstance(value, EmbeddedRef):
+            return dict(value.embedded)
+        if isinstance(value, Doc):
+            fields = _field_specs(value.__class__)[0]
+            embedded = dict(map(lambda (name, key): (key, fields[name].to_document(getattr(value, name))),
+                                self.embedded_keys()))
+            embedded['_id'] = object_id
+            return embedded
+        # ObjectId stored before embed was declared, or appended to a list in place
+        return self.snapshot(object_id).embedded
+
+    def from_python(self, value):
+        if self.embed and type(value) is ObjectId:
+            return self.snapshot(value)     # read once on assignment, not on every document()
+        return value
+
+    def snapshot(self, object_id):
+        """
+        :return: EmbeddedRef of embedded fields read from referenced document
+        """
+        raw = self.doc_clz().manager.load_raw(object_id) or {}
+        embedded = dict(map(lambda (name, key): (key, raw.get(key)), self.embedded_keys()))
+        embedded['_id'] = object_id
+        return EmbeddedRef(embedded)
+
+    def from_document(self, oid):
+        if isinstance(oid, dict):
+            return EmbeddedRef(oid)
+        return oid
+
+    def object_id_of(self, value):
         if value and isinstance(value, self.doc_clz()):
             return value.object_id
         elif value and isinstance(value, ObjectId):
-            return value
+            return value if type(value) is ObjectId else ObjectId(value)
         return None
 
-    def from_document(self, oid):
-        return oid
+    def embedded_keys(self):
+        """
+        :return: list of (field name, document key) of embedded fields of referenced document
+        """
+        fields = _field_specs(self.doc_clz())[0]
+        unknown = filter(lambda name: name not in fields, self.embed)
+        if unknown:
+            raise DeveloperFault('"%s" has no field %s to embed' % (self.doc_clz().__name__, unknown))
+        return map(lambda name: (name, fields[name].key or name), self.embed)
+
+    def target_db_name(self):
+        target = self.doc_class_or_collection_name
+        collection_name = target if isinstance(target, basestring) else target.manager.collection_name
+        return collection_name.split(':', 1)[0]
 
     def from_serialized(self, oid):
         return oid and ObjectId(oid)
@@ -473,17 +1652,21 @@ class FieldDoc(FieldSpec):
         sanitize self.doc_class to be Document class object. (if it was given as string)
         :return: document class object,
         """
-        if self.doc_class is None:
+        doc_class = self.doc_class
+        if doc_class is None:
+            # resolve, and validate before publishing, concurrent resolutions yield the same class.
             if isinstance(self.doc_class_or_collection_name, basestring):
-                # resolve it to class instead
-                self.doc_class = Docs.installed[self.doc_class_or_collection_name]
-                if self.doc_class is None:
+                # resolve it to class instead, its module is imported if it is declared (see Docs.model_path)
+                try:
+                    doc_class = Docs.factory_doc(self.doc_class_or_collection_name)
+                except DeveloperFault:
                     raise ValueError('Unknown doc_class %s' % self.doc_class_or_collection_name)
             else:
-                self.doc_class = self.doc_class_or_collection_name
-            if not issubclass(self.doc_class, Doc):
+                doc_class = self.doc_class_or_collection_name
+            if not issubclass(doc_class, Doc):
                 raise ValueError('Expected doc_class to be subclass of Doc')
-        return self.doc_class
+            self.doc_class = doc_class
+        return doc_class
 
 
 class FieldList(FieldSpec):
@@ -507,6 +1690,12 @@ class FieldList(FieldSpec):
             return []
         return map(lambda v: self.element_fieldspecs.to_document(v), value)
 
+    def from_python(self, value):
+        if isinstance(self.element_fieldspecs, FieldDoc) and self.element_fieldspecs.embed \
+                and isinstance(value, (list, tuple)):
+            return type(value)(map(self.element_fieldspecs.from_python, value))
+        return value
+
     def from_document(self, value):
         if value is None:
             return []
@@ -597,6 +1786,156 @@ class FieldDict(FieldSpec):
         super(FieldDict, self).__init__(dict, **kwargs)
 
 
+class FieldCompressed(FieldSpec):
+    """
+    Value of inner FieldSpec stored as compressed binary, e.g. FieldCompressed(FieldDict(), codec='zstd')
+
+    Read documents keep the stored binary until the field is accessed, fields which were not accessed are written
+    back as is. Values smaller than `min_size` bytes (BSON encoded) are stored uncompressed, and values stored
+    uncompressed (e.g. before the field was compressed) are read as is. Compressed fields cannot be queried.
+    """
+
+    def __init__(self, inner_fieldspec, codec='zlib', min_size=0, **kwargs):
+        if not isinstance(inner_fieldspec, FieldSpec):
+            raise ValueError('inner_fieldspec must be FieldSpec instance')
+        self.inner = inner_fieldspec
+        self.codec = compression.codec(codec)
+        self.min_size = min_size
+        self.stats = compression.Stats()
+        super(FieldCompressed, self).__init__((), **kwargs)
+
+    def __get__(self, instance, owner):
+        if instance is not None and compression.is_compressed(instance.dox.get(self.field_name)):
+            instance.dox[self.field_name] = self.unpack(instance.dox[self.field_name])
+        return super(FieldCompressed, self).__get__(instance, owner)
+
+    def unpack(self, value):
+        if not compression.is_compressed(value):
+            return value
+        self.stats.add_unpacked()
+        return self.inner.from_document(compression.unpack(value))
+
+    def validate(self, value, name):
+        if compression.is_compressed(value):
+            return          # as stored
+        super(FieldCompressed, self).validate(value, name)
+        self.inner.validate(value, name)
+
+    def to_document(self, value):
+        if value is None or compression.is_compressed(value):
+            return value
+        document = self.inner.to_document(value)
+        if document is None:
+            return None
+        data = compression.encode(document)
+        if len(data) < self.min_size:
+            return document
+        return compression.pack(data, self.codec)
+
+    def record(self, value):
+        """
+        Count value of written document in savings(), only values packed by to_document are counted.
+        """
+        if isinstance(value, compression.Packed):
+            self.stats.add_packed(value.raw_size, len(value))
+
+    def from_document(self, value):
+        if isinstance(value, compression.Packed):
+            return Binary(value, value.subtype)     # read back as stored, not packed by this process
+        if compression.is_compressed(value):
+            return value    # unpacked on access
+        return self.inner.from_document(value)
+
+    def from_python(self, value):
+        return self.inner.from_python(value)
+
+    def to_serialized(self, value):
+        return self.inner.to_serialized(self.unpack(value))
+
+    def from_serialized(self, value):
+        return self.inner.from_serialized(value)
+
+    def savings(self):
+        """
+        :return: dict of packed and unpacked values count, raw and stored bytes of packed values, and their ratio.
+        """
+        return self.stats.report()
+
+
+class FieldFile(FieldSpec):
+    """
+    Content stored in a file bucket (GridFS layout) of model's database, document keeps the file id only.
+
+    Assign a file-like object (streamed in chunks) or str to upload it on save, ObjectId or StoredFile of existing
+    file to refer it. Value is read as files.StoredFile (see open(), read()), or files.PendingFile until saved.
+    Files are deleted along with their documents (Docs.delete), or when replaced (Doc.save), unless other documents
+    still refer them.
+    """
+
+    def __init__(self, bucket='fs', chunk_size=files.DEFAULT_CHUNK_SIZE, **kwargs):
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        super(FieldFile, self).__init__((ObjectId, files.PendingFile), **kwargs)
+
+    def bucket_of(self, instance):
+        manager = getattr(instance, 'manager', None)
+        if manager is None:
+            raise DeveloperFault('FieldFile "%s" is only supported by Doc' % self.field_name)
+        return manager.bucket(self.bucket)
+
+    def __get__(self, instance, owner):
+        v = super(FieldFile, self).__get__(instance, owner)
+        if instance is None or v is None or isinstance(v, files.PendingFile):
+            return v
+        return files.StoredFile(self.bucket_of(instance), v)
+
+    def __set__(self, instance, value):
+        if isinstance(value, files.StoredFile):
+            value = value.file_id
+        elif value is not None and not isinstance(value, (ObjectId, files.PendingFile)):
+            self.bucket_of(instance)        # only Doc can save it, fail on assignment
+            value = files.PendingFile(value)
+        super(FieldFile, self).__set__(instance, value)
+
+    def upload(self, instance):
+        """
+        Upload content assigned to instance's field (files.PendingFile), called by Doc.save.
+        """
+        value = instance.dox.get(self.field_name)
+        if isinstance(value, files.PendingFile):
+            instance.dox[self.field_name] = value.upload(self.bucket_of(instance), self.chunk_size)
+
+    def to_document(self, value):
+        return value.file_id if isinstance(value, files.PendingFile) else value
+
+    def writer(self, instance, filename=None, metadata=None):
+        """
+        Stream content into a new file, assigned to instance's field once the writer is closed. Content is written
+        as it is streamed, the file is left behind if instance is not saved.
+
+        Usage:
+            with Model.attachment.writer(o, 'report.csv') as w:
+                w.write(data)
+            o.save()
+        """
+        writer = self.bucket_of(instance).open_upload_stream(filename, self.chunk_size, metadata)
+        close = writer.close
+
+        def close_and_assign():
+            if not writer.closed:
+                close()
+                self.__set__(instance, writer.file_id)
+        writer.close = close_and_assign
+        return writer
+
+    def from_serialized(self, value):
+        return value and ObjectId(value)
+
+    def to_serialized(self, value):
+        file_id = self.to_document(value)
+        return file_id and str(file_id)
+
+
 class FieldNested(FieldSpec):
 
     def __init__(self, field_spec_aware_class, **kwargs):
@@ -640,14 +1979,117 @@ class FieldNested(FieldSpec):
             return spec_aware.populate(next_path)
 
 
+_field_specs_cache = {}
+
+
+_snapshot_specs_cache = {}
+
+
+def _shares_document_value(fs, seen=()):
+    """
+    True if FieldSpec's from_document and to_document keep (parts of) raw value as is.
+    """
+    if isinstance(fs, FieldList):
+        return _shares_document_value(fs.element_fieldspecs, seen)
+    if isinstance(fs, FieldTuple):
+        return any(map(lambda element_fs: _shares_document_value(element_fs, seen), fs.element_fieldspecs))
+    if isinstance(fs, FieldCompressed):
+        return _shares_document_value(fs.inner, seen)
+    if isinstance(fs, FieldNested):
+        clazz = fs.field_spec_aware_class
+        return clazz not in seen and any(map(lambda nested_fs: _shares_document_value(nested_fs, seen + (clazz,)),
+                                             _field_specs(clazz)[0].values()))
+    return isinstance(fs, (FieldDict, FieldAnyDoc))
+
+
+def _snapshot_specs(clazz):
+    """
+    :return: tuple of (document keys of fields sharing raw values, list of (field name, document key) of nested
+        fields), computed once per class. Nested fields keep their own snapshot, they are not listed as shared.
+    """
+    if clazz not in _snapshot_specs_cache:
+        fields = _field_specs(clazz)[0].items()
+        shared = [fs.key or k for k, fs in fields if not isinstance(fs, FieldNested) and _shares_document_value(fs)]
+        nested = [(k, fs.key or k) for k, fs in fields if isinstance(fs, FieldNested)]
+        _snapshot_specs_cache.setdefault(clazz, (shared, nested))
+    return _snapshot_specs_cache[clazz]
+
+
 # Building FieldSpec index from its parent classes, including itself
 def _field_specs(clazz):
+    """
+    :return: tuple of (fields, doc_key_map), computed once per class and shared, do not mutate.
+    """
+    if clazz in _field_specs_cache:
+        return _field_specs_cache[clazz]
+
     def is_field_spec(clz):
         return {key: fs for key, fs in clz.__dict__.iteritems() if isinstance(fs, FieldSpec)}
     mro = inspect.getmro(clazz)
     fields = reduce(lambda x, y: dict(x.items() + is_field_spec(y).items()), reversed(mro), {})
     doc_key_map = dict(map(lambda (x, f): (f.key or x, x), fields.iteritems()))
-    return fields, doc_key_map
+    return _field_specs_cache.setdefault(clazz, (fields, doc_key_map))
+
+
+def _embedded_references(clazz, prefix=''):
+    """
+    :return: list of (document key path, is_list, FieldDoc) of FieldDoc with embedded fields, nested fields included.
+    """
+    references = []
+    for name, fs in _field_specs(clazz)[0].iteritems():
+        path = prefix + (fs.key or name)
+        if isinstance(fs, FieldDoc) and fs.embed:
+            references.append((path, False, fs))
+        elif isinstance(fs, FieldList) and isinstance(fs.element_fieldspecs, FieldDoc) and fs.element_fieldspecs.embed:
+            references.append((path, True, fs.element_fieldspecs))
+        elif isinstance(fs, FieldNested):
+            references.extend(_embedded_references(fs.field_spec_aware_class, path + '.'))
+    return references
+
+
+def document_path(clazz, path):
+    """
+    Translate dotted field name path of given FieldSpecAware class into document key path (honour FieldSpec.key)
+
+    e.g. 'object_id' => '_id', 'content.int_val' => 'content.int_val'
+    Unknown segments, positional segments ('0', '$') are kept as is.
+
+    :param clazz: FieldSpecAware class
+    :param path: dotted field name path
+    :return: dotted document key path
+    """
+    keys = []
+    for segment in path.split('.'):
+        fs = _field_specs(clazz)[0].get(segment) if clazz is not None else None
+        if fs is None:
+            keys.append(segment)
+            if not segment.isdigit() and segment != '$':
+                clazz = None
+            continue
+        keys.append(fs.key or segment)
+        if isinstance(fs, FieldList):
+            fs = fs.element_fieldspecs
+        clazz = fs.field_spec_aware_class if isinstance(fs, FieldNested) else None
+    return '.'.join(keys)
+
+
+def field_spec_at(clazz, path):
+    """
+    FieldSpec of dotted field name path of given FieldSpecAware class, None if the path is not declared.
+
+    e.g. 'content.int_val' => FieldNested's int_val, 'list_of_docs.0' or 'list_of_docs.$' => element FieldSpec
+    """
+    fs = None
+    for segment in path.split('.'):
+        if isinstance(fs, FieldList) and (segment.isdigit() or segment.startswith('$')):
+            fs = fs.element_fieldspecs
+            continue
+        if fs is not None:
+            clazz = fs.field_spec_aware_class if isinstance(fs, FieldNested) else None
+        fs = _field_specs(clazz)[0].get(segment) if clazz is not None else None
+        if fs is None:
+            return None
+    return fs
 
 
 class _FieldSpecAware(object):
@@ -655,11 +2097,9 @@ class _FieldSpecAware(object):
     def __init__(self):
         super(_FieldSpecAware, self).__init__()
         self.__dict__['fields'], self.__dict__['doc_key_map'] = _field_specs(self.__class__)
-        for key in self.__dict__['fields']:
-            f = self.__dict__['fields'][key]
-            if isinstance(f, FieldSpec):
-                f.assign_field_name(key)
         self.dox = {}
+        self._snapshot = None           # raw document as of inflate (or save), base of changes()
+        self._touched = set()           # field names assigned since snapshot
 
     def is_field_spec(self, item):
         return item in self.fields
@@ -731,6 +2171,67 @@ class _FieldSpecAware(object):
                         return
 
             map(lambda (k, v): bypass(k, v), raw_document.iteritems())
+            self.take_snapshot(raw_document)
+
+    def take_snapshot(self, raw_document):
+        """
+        Keep raw document as base of changes(). It is shared, not copied, except values of fields which would be
+        the very same objects as instance's values (FieldDict, FieldAnyDoc, and lists of nested objects holding
+        them). Nested objects keep their own part, which replaces the raw one in this snapshot.
+        """
+        shared, nested = _snapshot_specs(self.__class__)
+        shared = filter(lambda document_key: document_key in raw_document, shared)
+        nested = filter(lambda (key, document_key): isinstance(self.dox.get(key), _FieldSpecAware)
+                        and isinstance(raw_document.get(document_key), dict), nested)
+        if shared or nested:
+            raw_document = dict(raw_document)
+            map(lambda document_key: raw_document.update({document_key: copy.deepcopy(raw_document[document_key])}),
+                shared)
+        self._snapshot = raw_document
+        self._touched = set()
+        for key, document_key in nested:
+            value = self.dox[key]
+            if value._snapshot is not raw_document[document_key]:
+                value.take_snapshot(raw_document[document_key])
+            raw_document[document_key] = value._snapshot    # diffed by the nested object, see _changes
+
+    def changes(self):
+        """
+        Changes since inflate (or save) as mongodb update document, e.g. {'$set': {'content.int_val': 3}}.
+        Nested objects are compared with their own snapshot, scalar fields which were not assigned are skipped,
+        list, tuple and dict values are compared by element (see helpers.document_diff).
+
+        Usage:
+            o.content.int_val = 3
+            o.list_of_docs.append(d)
+            SimpleDocument.manager.update({'_id': o.object_id}, o.changes())
+
+        :return: update document, {} if unchanged. Every field is set if there was no snapshot (new object).
+        """
+        return self._changes(None, {})
+
+    def _changes(self, path, update):
+        snapshot = self._snapshot or {}
+        for key, fs in self.fields.iteritems():
+            if fs.transient:
+                continue
+            document_key = fs.key or key
+            value_path = document_key if path is None else '%s.%s' % (path, document_key)
+            past = snapshot.get(document_key, helper.missing) if self._snapshot is not None else helper.missing
+            value = self.dox.get(key, fs.default)
+            if isinstance(fs, FieldNested) and isinstance(value, _FieldSpecAware) and value._snapshot is not None \
+                    and value._snapshot is past:
+                value._changes(value_path, update)
+                continue
+            if key in self.dox and key not in self._touched and past is not helper.missing \
+                    and not isinstance(fs, (FieldList, FieldTuple, FieldDict, FieldAnyDoc, FieldNested,
+                                            FieldCompressed)):
+                continue        # scalar, as of snapshot
+            current = fs.to_document(value)
+            if current is None and fs.omit_if_none:
+                current = helper.missing
+            helper.document_diff(past, current, value_path, update)
+        return update
 
     def serialized(self):
         return dict(map(lambda (k, f): (f.key or k, f.to_serialized(self.dox.get(k, f.default))), self.fields.iteritems()))
@@ -756,6 +2257,8 @@ class _FieldSpecAware(object):
 
 class _FieldSpecAwareMetaClass(type):
     def __new__(cls, clsname, bases, dct):
+        # FieldSpec (descriptor) is shared by every instance, its field_name is assigned once here.
+        map(lambda (k, f): f.assign_field_name(k), filter(lambda (k, f): isinstance(f, FieldSpec), dct.iteritems()))
         meta = 'Meta' in dct and dct['Meta'].__dict__ or {}
         # register myself to Doc repository
         if 'collection_name' in meta:
@@ -769,7 +2272,16 @@ class _FieldSpecAwareMetaClass(type):
                     raise DeveloperFault("Unable to extend empty non-discoverable parent class")
                 collection_name = "%s%s" % (parent_collection_name, collection_name)
 
-            dct['manager'] = Docs(collection_name, connection_name=connection_name)
+            count_cache_ttl = meta['count_cache_ttl'] if 'count_cache_ttl' in meta else 0
+            write_behind = meta['write_behind'] if 'write_behind' in meta else None
+            read_preference = meta['read_preference'] if 'read_preference' in meta else None
+            router = meta['router'] if 'router' in meta else None
+            bucket = meta['bucket'] if 'bucket' in meta else None
+            result_cache = meta['result_cache'] if 'result_cache' in meta else None
+
+            dct['manager'] = Docs(collection_name, connection_name=connection_name, count_cache_ttl=count_cache_ttl,
+                                  write_behind=write_behind, read_preference=read_preference, router=router,
+                                  bucket=bucket, result_cache=result_cache)
             clx = super(_FieldSpecAwareMetaClass, cls).__new__(cls, clsname, bases, dct)
             # Register indexing see:
             # http://api.mongodb.org/python/current/api/pymongo/collection.html#pymongo.collection.Collection.create_index
@@ -793,12 +2305,22 @@ class FieldSpecAware(six.with_metaclass(_FieldSpecAwareMetaClass, _FieldSpecAwar
     pass
 
 
+class _QueryFields(object):
+    """
+    Model.q, query fields of the model (see query.Fields)
+    """
+
+    def __get__(self, instance, owner):
+        return query.Fields(owner)
+
+
 class Doc(FieldSpecAware):
     PERM_W = 'write'
     PERM_R = 'read'
     PERM_D = 'delete'
     object_id = FieldObjectId(key="_id")
     manager = None                          # type: Docs
+    q = _QueryFields()
 
     def __init__(self, object_id=None):
         super(Doc, self).__init__()
@@ -808,7 +2330,7 @@ class Doc(FieldSpecAware):
 
     def load(self):
         if self.object_id is not None:
-            raw = self.manager.o.find_one(self.object_id)
+            raw = self.manager.load_raw(self.object_id)
             if not raw:
                 raise DocumentValidationError(_('Failed to load document, unknown document_id=%s' % self.object_id))
             self.inflate(raw)
@@ -819,10 +2341,31 @@ class Doc(FieldSpecAware):
     def is_new(self):
         return self._injected_object_id is not None and self.object_id == self._injected_object_id
 
+    def inflate(self, raw_document):
+        super(Doc, self).inflate(raw_document)
+        if isinstance(raw_document, dict):
+            self._injected_object_id = None     # inflated from database, it is not new.
+
     def save(self):
         self.validate()
-        self.object_id = self.manager.write(self.document())
+        map(lambda (name, key, fs): fs.upload(self), self.manager.file_fields)
+        document = self.document()
+        insert = self.is_new()
+        if self.manager.writer is not None and insert:
+            # Write behind, ObjectId is pre-assigned by load()
+            self.object_id = self.manager.write_behind(document)
+        else:
+            # New documents are inserted, loaded documents are replaced (no upsert), documents of caller supplied
+            # `_id` (assigned, or deserialized) are upserted.
+            self.object_id = self.manager.write(document, insert=insert, reassign_id=insert,
+                                                upsert=self._injected_object_id is not None)
         self._injected_object_id = None     # ObjectId has been committed.
+        if not insert and self.manager.file_fields and self._snapshot is not None:
+            self.manager.release_files(self._snapshot, document)
+        if not insert and self.manager.db_name in Docs._on_save:
+            # refresh snapshots embedded by other collections (FieldDoc embed)
+            self.manager.refresh_embedded(document, self._snapshot)
+        self.take_snapshot(document)
         return self.object_id
 
     def invoke(self, user, requested_operation):
@@ -16,3 +16,9 @@ class FieldValidationError(Exception):
     def __init__(self, value, message, name="No name"):
         super(FieldValidationError, self).__init__("Field \"%s\" value=\"%s\" type=\"%s\" message=\"%s\""
                                                    % (name, value, type(value), message))
+
+
+class BackpressureError(Exception):
+
+    def __init__(self, *args, **kwargs):
+        super(BackpressureError, self).__init__(*args, **kwargs)
@@ -0,0 +1,306 @@
+"""
+Chunked file storage in GridFS layout (<bucket>.files, <bucket>.chunks) on top of the collection API, so it works with
+every storage backend (see conf.register_backend). Files are interchangeable with GridFS drivers and tools.
+"""
+from bson import Binary, ObjectId
+from errors import DeveloperFault
+import datetime
+import os
+
+DEFAULT_CHUNK_SIZE = 255 * 1024
+DELETE_BATCH_SIZE = 1000
+
+
+class Bucket(object):
+    """
+    Usage:
+        bucket = Model.manager.bucket('attachments')
+        with bucket.open_upload_stream('report.pdf') as w:
+            w.write(data)
+        file_id = bucket.upload_from_stream(open('/path/to/large.bin', 'rb'))
+        for chunk in bucket.open_download_stream(file_id):
+            ...
+    """
+
+    def __init__(self, database, name='fs', chunk_size=DEFAULT_CHUNK_SIZE):
+        super(Bucket, self).__init__()
+        self.name = name
+        self.chunk_size = chunk_size
+        self.files = database['%s.files' % name]
+        self.chunks = database['%s.chunks' % name]
+        self.indexed = False
+
+    def _create_indexes(self):
+        if not self.indexed:
+            self.chunks.create_index([('files_id', 1), ('n', 1)], unique=True)
+            self.files.create_index([('filename', 1), ('uploadDate', 1)])
+            self.indexed = True
+
+    def open_upload_stream(self, filename=None, chunk_size=None, metadata=None, file_id=None):
+        """
+        :return: Writer, file is visible once the writer is closed (aborted if its `with` block raised).
+        """
+        if (chunk_size or self.chunk_size) <= 0:
+            raise DeveloperFault('chunk_size must be greater than 0')
+        self._create_indexes()
+        return Writer(self, file_id or ObjectId(), filename, chunk_size or self.chunk_size, metadata)
+
+    def upload_from_stream(self, source, filename=None, chunk_size=None, metadata=None):
+        """
+        :param source: file-like object (read in chunks, never loaded as a whole), or str
+        :return: file_id
+        """
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        if filename is None and isinstance(getattr(source, 'name', None), basestring):
+            filename = os.path.basename(source.name)
+        with self.open_upload_stream(filename, chunk_size, metadata) as writer:
+            if isinstance(source, str):
+                writer.write(source)
+            else:
+                for data in iter(lambda: source.read(writer.chunk_size), ''):
+                    writer.write(data)
+        return writer.file_id
+
+    def find_file(self, file_id):
+        return self.files.find_one({'_id': file_id})
+
+    def open_download_stream(self, file_id):
+        """
+        :return: Reader, DeveloperFault if the file does not exist.
+        """
+        document = self.find_file(file_id)
+        if document is None:
+            raise DeveloperFault('File %s is not found in bucket "%s"' % (file_id, self.name))
+        return Reader(self, document)
+
+    def delete_many(self, file_ids, batch_size=DELETE_BATCH_SIZE):
+        """
+        Delete files and their chunks, `batch_size` files per round trip.
+
+        :return: number of deleted files
+        """
+        file_ids = list(file_ids)
+        deleted = 0
+        for i in range(0, len(file_ids), batch_size):
+            batch = file_ids[i:i + batch_size]
+            deleted += self.files.delete_many({'_id': {'$in': batch}}).deleted_count
+            self.chunks.delete_many({'files_id': {'$in': batch}})
+        return deleted
+
+
+class Writer(object):
+    """
+    File-like writer of Bucket, chunks are written as soon as they are filled.
+    """
+
+    def __init__(self, bucket, file_id, filename, chunk_size, metadata):
+        super(Writer, self).__init__()
+        self.bucket = bucket
+        self.file_id = file_id
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.metadata = metadata
+        self.buffer = []
+        self.buffered = 0
+        self.n = 0
+        self.length = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.length += len(data)
+        if self.buffered >= self.chunk_size:
+            data = ''.join(self.buffer)
+            full = len(data) - len(data) % self.chunk_size
+            self._write_chunks(data[:full])
+            self.buffer = [data[full:]]
+            self.buffered = len(data) - full
+
+    def _write_chunks(self, data):
+        chunks = []
+        for i in range(0, len(data), self.chunk_size):
+            chunks.append({'files_id': self.file_id, 'n': self.n, 'data': Binary(data[i:i + self.chunk_size])})
+            self.n += 1
+        if chunks:
+            self.bucket.chunks.insert_many(chunks)
+
+    def close(self):
+        if self.closed:
+            return
+        self._write_chunks(''.join(self.buffer))
+        self.buffer = []
+        self.closed = True
+        document = {
+            '_id': self.file_id,
+            'length': self.length,
+            'chunkSize': self.chunk_size,
+            'uploadDate': datetime.datetime.utcnow(),
+            'filename': self.filename,
+        }
+        if self.metadata is not None:
+            document['metadata'] = self.metadata
+        self.bucket.files.insert_one(document)
+
+    def abort(self):
+        self.closed = True
+        self.buffer = []
+        self.bucket.chunks.delete_many({'files_id': self.file_id})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Reader(object):
+    """
+    File-like reader of Bucket, chunks are fetched as they are read. Iterating yields chunks.
+    """
+
+    def __init__(self, bucket, document):
+        super(Reader, self).__init__()
+        self.bucket = bucket
+        self.document = document
+        self.file_id = document['_id']
+        self.length = document['length']
+        self.chunk_size = document['chunkSize']
+        self.filename = document.get('filename')
+        self.metadata = document.get('metadata')
+        self.position = 0
+        self.cursor = None
+        self.chunk = ''             # data of chunk at position
+        self.chunk_n = -1
+
+    def _chunk(self, n):
+        """
+        Data of chunk n, chunks are read through one cursor while reading sequentially.
+        """
+        if n != self.chunk_n:
+            if self.cursor is None or n != self.chunk_n + 1:
+                self.cursor = self.bucket.chunks.find({'files_id': self.file_id, 'n': {'$gte': n}}).sort('n', 1)
+            chunk = next(self.cursor, None)
+            if chunk is None or chunk['n'] != n:
+                raise DeveloperFault('Chunk %d of file %s is missing' % (n, self.file_id))
+            self.chunk, self.chunk_n = str(chunk['data']), n
+        return self.chunk
+
+    def readchunk(self):
+        """
+        :return: data up to the end of current chunk, '' at the end of file
+        """
+        if self.position >= self.length:
+            return ''
+        n, offset = divmod(self.position, self.chunk_size)
+        data = self._chunk(n)[offset:]
+        self.position += len(data)
+        return data
+
+    def read(self, size=-1):
+        remaining = self.length - self.position if size < 0 else min(size, self.length - self.position)
+        parts = []
+        while remaining > 0:
+            data = self.readchunk()
+            if len(data) > remaining:
+                self.position -= len(data) - remaining
+                data = data[:remaining]
+            parts.append(data)
+            remaining -= len(data)
+        return ''.join(parts)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.length}[whence]
+        if base + offset < 0:
+            raise ValueError('negative seek position')
+        self.position = base + offset
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        return iter(self.readchunk, '')
+
+    def close(self):
+        self.cursor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PendingFile(object):
+    """
+    Value of FieldFile assigned but not saved yet, content is uploaded by Doc.save.
+    """
+    file_id = None
+
+    def __init__(self, source):
+        super(PendingFile, self).__init__()
+        self.source = source
+
+    def upload(self, bucket, chunk_size):
+        """
+        :return: file_id
+        """
+        return bucket.upload_from_stream(self.source, chunk_size=chunk_size)
+
+    def __repr__(self):
+        return '<PendingFile %r>' % getattr(self.source, 'name', type(self.source).__name__)
+
+
+class StoredFile(object):
+    """
+    Value of FieldFile, file id and its bucket. File document (length, filename, ...) is read on first use.
+    """
+
+    def __init__(self, bucket, file_id):
+        super(StoredFile, self).__init__()
+        self.bucket = bucket
+        self.file_id = file_id
+        self._document = None
+
+    @property
+    def document(self):
+        if self._document is None:
+            self._document = self.bucket.find_file(self.file_id)
+            if self._document is None:
+                raise DeveloperFault('File %s is not found in bucket "%s"' % (self.file_id, self.bucket.name))
+        return self._document
+
+    @property
+    def length(self):
+        return self.document['length']
+
+    @property
+    def filename(self):
+        return self.document.get('filename')
+
+    @property
+    def metadata(self):
+        return self.document.get('metadata')
+
+    def open(self):
+        return Reader(self.bucket, self.document)
+
+    def read(self):
+        return self.open().read()
+
+    def __eq__(self, other):
+        return isinstance(other, StoredFile) and other.file_id == self.file_id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<StoredFile %s:%s>' % (self.bucket.name, self.file_id)
@@ -1,4 +1,6 @@
-from bson import ObjectId
+from bson import BSON, ObjectId
+from bson.son import SON
+import base64
 import re
 
 
@@ -35,6 +37,66 @@ class DictDiffer(object):
             }
 
 
+missing = object()          # absent key, see document_diff
+
+
+def _is_path_key(key):
+    return isinstance(key, basestring) and key != '' and '.' not in key and not key.startswith('$')
+
+
+def document_diff(past, current, path, update):
+    """
+    Add difference of a document value into mongodb update document ($set, $unset, $push).
+    Identical values are skipped without comparison, dicts are compared by key, lists by element while their length
+    is kept. Appended lists are pushed, other changes of lists are set as a whole.
+
+    :param past: previous value, `missing` if key was absent
+    :param current: current value, `missing` if key is absent
+    :param path: dotted key path of the value
+    :param update: update document to be added to
+    :return: update
+    """
+    if current is past:
+        return update
+    if current is missing:
+        if past is not missing:
+            update.setdefault('$unset', {})[path] = ''
+    elif isinstance(past, dict) and isinstance(current, dict) and all(map(_is_path_key, current.keys() + past.keys())):
+        for k, v in current.iteritems():
+            document_diff(past.get(k, missing), v, '%s.%s' % (path, k), update)
+        for k in past:
+            if k not in current:
+                update.setdefault('$unset', {})['%s.%s' % (path, k)] = ''
+    elif isinstance(past, list) and isinstance(current, list) and len(current) >= len(past):
+        elements = reduce(lambda u, i: document_diff(past[i], current[i], '%s.%d' % (path, i), u), range(len(past)), {})
+        if len(current) > len(past) and elements:
+            # $push and $set of its elements would conflict
+            update.setdefault('$set', {})[path] = current
+        else:
+            map(lambda (op, fields): update.setdefault(op, {}).update(fields), elements.iteritems())
+            if len(current) > len(past):
+                update.setdefault('$push', {})[path] = {'$each': current[len(past):]}
+    elif past is missing or past != current or isinstance(past, bool) != isinstance(current, bool):
+        update.setdefault('$set', {})[path] = current
+    return update
+
+
+def canonical(value):
+    """
+    Hashable representation of (nested) condition, dict key order is ignored, except SON which order matters.
+
+    :param value: dict, list, tuple or any hashable value
+    :return: hashable tuple
+    """
+    if isinstance(value, SON):
+        return SON, tuple((k, canonical(v)) for k, v in value.iteritems())
+    if isinstance(value, dict):
+        return dict, tuple(sorted((k, canonical(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return list, tuple(canonical(v) for v in value)
+    return value
+
+
 def object_id(object_id_or_str):
     if object_id_or_str is None:
         return None
@@ -48,3 +110,40 @@ _object_id_pattern = re.compile(r'[a-zA-Z0-9]{24}')
 
 def is_object_id(object_id_or_str):
     return isinstance(object_id_or_str, ObjectId) or _object_id_pattern.match(object_id_or_str) is not None
+
+
+def value_at(document, path):
+    """
+    Read value from nested raw document using dotted path, None if path is not found.
+    """
+    for segment in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(segment)
+    return document
+
+
+def encode_token(payload):
+    """
+    Encode dict into opaque url-safe string
+    """
+    return base64.urlsafe_b64encode(BSON.encode(payload))
+
+
+def decode_token(token):
+    """
+    Reverse of encode_token
+    """
+    return BSON(base64.urlsafe_b64decode(str(token))).decode()
+
+
+def is_duplicate_id(error):
+    """
+    Check if server's write error (DuplicateKeyError.details, or an entry of BulkWriteError's writeErrors)
+    is a duplicate of `_id`.
+    """
+    if not error or error.get('code') not in (11000, 11001):
+        return False
+    if 'keyPattern' in error:
+        return error['keyPattern'].keys() == ['_id']
+    return ' index: _id_ ' in error.get('errmsg', '')
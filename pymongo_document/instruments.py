@@ -0,0 +1,180 @@
+import Queue
+import collections
+import random
+import threading
+
+
+def condition_shape(cond):
+    """
+    Replace values of condition by '?', keep keys and operators. Used to group similar queries.
+
+    e.g. {'int_val': {'$gt': 5}, 'str_val': 'x'} => {'int_val': {'$gt': '?'}, 'str_val': '?'}
+    """
+    if isinstance(cond, dict):
+        return dict((k, condition_shape(v)) for k, v in cond.iteritems())
+    if isinstance(cond, (list, tuple)) and any(isinstance(v, dict) for v in cond):
+        return map(condition_shape, cond)
+    return '?'
+
+
+class OperationEvent(object):
+    """
+    Emitted by Docs for each database operation, see Docs.add_listener
+    """
+
+    def __init__(self, manager, operation, cond, duration, returned=None, inflate_time=0.0, read_preference=None):
+        super(OperationEvent, self).__init__()
+        self.manager = manager
+        self.collection_name = manager.collection_name
+        self.operation = operation
+        self.cond = cond
+        self.duration = duration            # seconds, includes inflate_time
+        self.returned = returned            # number of documents returned, None if not applicable
+        self.inflate_time = inflate_time    # seconds
+        self.read_preference = read_preference  # read preference of the operation, None means model's
+
+    @property
+    def shape(self):
+        return condition_shape(self.cond)
+
+    def __repr__(self):
+        return '<OperationEvent %s.%s %s %.6fs returned=%s>' % (self.collection_name, self.operation, self.shape,
+                                                                self.duration, self.returned)
+
+
+class LatencyAggregator(object):
+    """
+    Listener which collect latency per model (collection_name) and operation.
+
+    Usage:
+        aggregator = LatencyAggregator()
+        Docs.add_listener(aggregator)
+        ...
+        print aggregator.dump()
+    """
+
+    def __init__(self, max_samples=10000):
+        super(LatencyAggregator, self).__init__()
+        self.max_samples = max_samples
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.max_samples))
+
+    def __call__(self, event):
+        self.samples[(event.collection_name, event.operation)].append(event.duration)
+
+    @staticmethod
+    def percentile(ordered, p):
+        """
+        Nearest rank percentile of sorted values
+        """
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+    def dump(self):
+        """
+        :return: {collection_name: {operation: {'count': n, 'p50': seconds, 'p99': seconds}}}
+        """
+        r = {}
+        for (collection_name, operation), durations in self.samples.items():
+            ordered = sorted(durations)
+            r.setdefault(collection_name, {})[operation] = {
+                'count': len(ordered),
+                'p50': self.percentile(ordered, 50),
+                'p99': self.percentile(ordered, 99),
+            }
+        return r
+
+    def reset(self):
+        self.samples.clear()
+
+
+class ExplainSampler(object):
+    """
+    Listener which explain a sample of conditions, and flag the ones which are resolved by collection scan (COLLSCAN).
+
+    Each flag record whether model's Meta.indices declares an index on any of condition's top level keys,
+    such flag signify that the declared index is either missing on server or not usable by the condition.
+
+    Sampled conditions are explained by a background thread, on every route of the condition (Meta.router) with
+    the operation's read preference. Samples are dropped when `max_queue` conditions are waiting to be explained.
+    """
+
+    operations = ('find', 'count', 'update', 'delete')
+
+    def __init__(self, rate=0.01, on_collscan=None, max_queue=100):
+        super(ExplainSampler, self).__init__()
+        self.rate = rate
+        self.on_collscan = on_collscan
+        self.flagged = []
+        self.dropped = 0
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        if event.operation not in self.operations or random.random() >= self.rate:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            self.dropped += 1
+            return
+        self.start()
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='explain-sampler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            try:
+                self.explain(event)
+            except Exception as e:
+                print 'Explain sampler failed to explain %s: %s' % (event, e)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Block until every sampled condition is explained
+        """
+        self.queue.join()
+
+    def explain(self, event):
+        manager = event.manager
+        cond = event.cond or {}
+        explained = cond if manager.bucketing is None else manager.bucketing.bucket_condition(cond)
+        for collection in manager.collections_for(cond, event.read_preference):
+            plan = collection.find(explained).explain()
+            if 'COLLSCAN' in self.stages(plan.get('queryPlanner', {}).get('winningPlan', {})):
+                break
+        else:
+            return
+        keys = filter(lambda k: not k.startswith('$'), cond.keys())
+        flag = {
+            'collection_name': event.collection_name,
+            'operation': event.operation,
+            'shape': event.shape,
+            'declared_index': any(manager.has_index_for([(k, 1)]) for k in keys),
+        }
+        self.flagged.append(flag)
+        if self.on_collscan is not None:
+            self.on_collscan(flag, plan)
+
+    @classmethod
+    def stages(cls, plan):
+        """
+        List stages of (nested) query plan
+        """
+        r = [plan['stage']] if 'stage' in plan else []
+        if 'inputStage' in plan:
+            r += cls.stages(plan['inputStage'])
+        for p in plan.get('inputStages', []):
+            r += cls.stages(p)
+        return r
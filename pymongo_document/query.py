@@ -0,0 +1,350 @@
+from errors import DeveloperFault, FieldValidationError
+import documents as doc
+import helpers as helper
+
+
+class Param(object):
+    """
+    Named placeholder of a query value, given later by Template.bind(**params).
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
+
+
+def param(name):
+    return Param(name)
+
+
+def condition(cond):
+    """
+    :param cond: raw condition (dict), Query or Template
+    :return: raw condition (dict), Query and Template are compiled (Template must not have unbound parameters).
+    """
+    if isinstance(cond, (Query, Template)):
+        return cond.to_condition()
+    return cond
+
+
+def _convert(fs, value, path):
+    """
+    Python value => document value of given FieldSpec, with type checking. None is accepted (missing or null).
+    """
+    if isinstance(fs, (doc.FieldObjectId, doc.FieldDoc)) and isinstance(value, basestring):
+        value = helper.object_id(value)
+    value = fs.from_python(value)
+    if value is None:
+        return None
+    if fs.classes and not isinstance(value, fs.classes):
+        raise FieldValidationError(value, 'Invalid data type.', path)
+    # referenced documents are matched by ObjectId, also when their fields are embedded (see Field.key)
+    if isinstance(fs, doc.FieldDoc):
+        document = fs.object_id_of(value)
+    elif isinstance(fs, doc.FieldList) and isinstance(fs.element_fieldspecs, doc.FieldDoc):
+        document = map(fs.element_fieldspecs.object_id_of, value)
+    else:
+        document = fs.to_document(value)
+    if document is None:
+        raise FieldValidationError(value, 'Invalid data type.', path)
+    return document
+
+
+class _Slot(object):
+    """
+    Value placeholder of compiled condition, and its converter.
+    """
+    __slots__ = ('index', 'name', 'convert')
+
+    def __init__(self, index, name, convert):
+        self.index = index
+        self.name = name
+        self.convert = convert
+
+
+def _fill(skeleton, values):
+    if isinstance(skeleton, _Slot):
+        return values[skeleton.index]
+    if isinstance(skeleton, dict):
+        return dict((k, _fill(v, values)) for k, v in skeleton.iteritems())
+    if isinstance(skeleton, list):
+        return map(lambda v: _fill(v, values), skeleton)
+    return skeleton
+
+
+class _Shape(object):
+    """
+    Compiled query shape: condition skeleton with value slots. Shared by every query of the same shape.
+    """
+
+    def __init__(self, query):
+        super(_Shape, self).__init__()
+        self.slots = []
+        self.skeleton = query.compile_skeleton(self.slots)
+        self.named = filter(lambda s: s.name is not None, self.slots)
+
+
+_shapes = {}                    # query shape => _Shape
+
+
+class Template(object):
+    """
+    Compiled query, field names are resolved, and constants are validated and converted once.
+    Named parameters (Param) are converted on each bind().
+
+    Usage:
+        by_range = ((Model.q.int_val >= param('low')) & (Model.q.int_val < param('high'))).compile()
+        Model.manager.find(by_range.bind(low=1, high=5))
+    """
+
+    def __init__(self, shape, values):
+        super(Template, self).__init__()
+        self.shape = shape
+        self.values = map(lambda (s, v): None if s.name is not None else s.convert(v), zip(shape.slots, values))
+
+    def params(self):
+        return sorted(set(map(lambda s: s.name, self.shape.named)))
+
+    def bind(self, **params):
+        """
+        :return: raw condition (dict, fresh copy), parameters are validated and converted by their field.
+        """
+        unknown = set(params) - set(self.params())
+        if unknown:
+            raise DeveloperFault('Unknown query parameters %s' % sorted(unknown))
+        values = list(self.values)
+        for slot in self.shape.named:
+            if slot.name not in params:
+                raise DeveloperFault('Missing query parameter "%s"' % slot.name)
+            values[slot.index] = slot.convert(params[slot.name])
+        return _fill(self.shape.skeleton, values)
+
+    def to_condition(self):
+        return self.bind()
+
+
+class Query(object):
+    """
+    Condition expression, combine with & (and), | (or), ~ (not).
+    Python's & and | bind tighter than comparisons, parenthesize them: (Model.q.a > 1) & (Model.q.b == 2)
+    """
+
+    def __and__(self, other):
+        return And(self._terms(And) + other._terms(And))
+
+    def __or__(self, other):
+        return Or(self._terms(Or) + other._terms(Or))
+
+    def __invert__(self):
+        return Not(self)
+
+    def _terms(self, clazz):
+        return list(self.children) if isinstance(self, clazz) else [self]
+
+    def shape(self):
+        """
+        :return: hashable structure of this query, constant values are not part of it.
+        """
+        raise NotImplementedError()
+
+    def values(self):
+        """
+        :return: list of values (constants and Params), in order of shape's slots.
+        """
+        raise NotImplementedError()
+
+    def compile_skeleton(self, slots):
+        raise NotImplementedError()
+
+    def compile(self):
+        """
+        :return: Template, compiled shape is cached and shared with every query of the same shape.
+        """
+        shape = self.shape()
+        compiled = _shapes.get(shape)
+        if compiled is None:
+            compiled = _shapes.setdefault(shape, _Shape(self))
+        return Template(compiled, self.values())
+
+    def to_condition(self, **params):
+        return self.compile().bind(**params)
+
+
+class Comparison(Query):
+
+    def __init__(self, field, operator, value, convert):
+        """
+        :param field: Field
+        :param operator: mongodb's operator e.g. '$gt', None means equality (or contains for lists)
+        :param value: constant or Param
+        :param convert: 'value' (field's value), 'each' (list of field's values), 'raw' (no conversion)
+        """
+        super(Comparison, self).__init__()
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.convert = convert
+
+    def shape(self):
+        name = self.value.name if isinstance(self.value, Param) else None
+        return Comparison, self.field.doc_class, self.field.path, self.operator, self.convert, name
+
+    def values(self):
+        return [self.value]
+
+    def converter(self):
+        fs, path = self.field.spec, self.field.path
+        if self.convert == 'value':
+            return lambda v: _convert(fs, v, path)
+        if self.convert == 'element':
+            element = fs.element_fieldspecs
+            return lambda v: _convert(element, v, path)
+        if self.convert == 'each':
+            element = fs.element_fieldspecs if isinstance(fs, doc.FieldList) else fs
+            return lambda v: map(lambda e: _convert(element, e, path), v)
+        return lambda v: v
+
+    def compile_skeleton(self, slots):
+        name = self.value.name if isinstance(self.value, Param) else None
+        slot = _Slot(len(slots), name, self.converter())
+        slots.append(slot)
+        return {self.field.key: slot if self.operator is None else {self.operator: slot}}
+
+
+class _Logical(Query):
+    operator = None
+
+    def __init__(self, children):
+        super(_Logical, self).__init__()
+        self.children = children
+
+    def shape(self):
+        return self.operator, tuple(map(lambda c: c.shape(), self.children))
+
+    def values(self):
+        return reduce(lambda a, c: a + c.values(), self.children, [])
+
+    def compile_skeleton(self, slots):
+        return {self.operator: map(lambda c: c.compile_skeleton(slots), self.children)}
+
+
+class And(_Logical):
+    operator = '$and'
+
+    def compile_skeleton(self, slots):
+        skeletons = map(lambda c: c.compile_skeleton(slots), self.children)
+        keys = reduce(lambda a, s: a + s.keys(), skeletons, [])
+        if len(keys) == len(set(keys)):
+            # disjoint keys are merged into a single condition
+            return reduce(lambda a, s: dict(a, **s), skeletons, {})
+        return {self.operator: skeletons}
+
+
+class Or(_Logical):
+    operator = '$or'
+
+
+class Not(_Logical):
+    operator = '$nor'
+
+    def __init__(self, child):
+        super(Not, self).__init__([child])
+
+
+class Field(object):
+    """
+    Field of a model in query expression, e.g. Model.q.int_val, Model.q.content.int_val
+    Use Model.q['path'] for fields whose name collides with Field's methods.
+    """
+
+    def __init__(self, doc_class, path):
+        super(Field, self).__init__()
+        self.doc_class = doc_class
+        self.path = path
+        self.spec = doc.field_spec_at(doc_class, path)
+        if self.spec is None:
+            raise DeveloperFault('"%s" has no field "%s"' % (doc_class.__name__, path))
+        if isinstance(self.spec, doc.FieldCompressed):
+            raise DeveloperFault('"%s" is compressed and cannot be queried' % path)
+        self.key = doc.document_path(doc_class, path)
+        element = self.spec.element_fieldspecs if isinstance(self.spec, doc.FieldList) else self.spec
+        if isinstance(element, doc.FieldDoc) and element.embed:
+            self.key += '._id'
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        return Field(self.doc_class, '%s.%s' % (self.path, name))
+
+    def __hash__(self):
+        return hash((self.doc_class, self.path))
+
+    def __eq__(self, value):
+        return Comparison(self, None, value, 'value')
+
+    def __ne__(self, value):
+        return Comparison(self, '$ne', value, 'value')
+
+    def __gt__(self, value):
+        return Comparison(self, '$gt', value, 'value')
+
+    def __ge__(self, value):
+        return Comparison(self, '$gte', value, 'value')
+
+    def __lt__(self, value):
+        return Comparison(self, '$lt', value, 'value')
+
+    def __le__(self, value):
+        return Comparison(self, '$lte', value, 'value')
+
+    def in_(self, values):
+        return Comparison(self, '$in', values, 'each')
+
+    def not_in(self, values):
+        return Comparison(self, '$nin', values, 'each')
+
+    def contains(self, value):
+        """
+        List field contains given element (e.g. Doc instance of FieldList(FieldDoc(...)))
+        """
+        if not isinstance(self.spec, doc.FieldList):
+            raise DeveloperFault('"%s" is not a list field' % self.path)
+        return Comparison(self, None, value, 'element')
+
+    def contains_all(self, values):
+        if not isinstance(self.spec, doc.FieldList):
+            raise DeveloperFault('"%s" is not a list field' % self.path)
+        return Comparison(self, '$all', values, 'each')
+
+    def exists(self, exists=True):
+        return Comparison(self, '$exists', exists, 'raw')
+
+    def regex(self, pattern):
+        return Comparison(self, '$regex', pattern, 'raw')
+
+
+class Fields(object):
+    """
+    Query fields of a model (Doc.q)
+
+    Usage:
+        SimpleDocument.manager.find((SimpleDocument.q.int_val > 5) & (SimpleDocument.q.str_val != 'x'))
+    """
+
+    def __init__(self, doc_class):
+        super(Fields, self).__init__()
+        self.doc_class = doc_class
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, path):
+        return Field(self.doc_class, path)
@@ -0,0 +1,98 @@
+"""
+Query result cache of a model (Meta.result_cache), see Docs.find_cached and Docs.count.
+
+Entries are tagged with the write version of their collection at the time they were read. Every write bumps the
+version (Docs.invalidate), entries of an older version are stale and dropped on lookup.
+
+Versions are local to the process, writes of other processes are seen once the entry expires (`ttl`), or when
+watcher.ChangeWatcher watches the model (changes bump the version).
+"""
+from collections import OrderedDict
+from errors import DeveloperFault
+import threading
+import time
+
+STORES = ('raw', 'ids')
+
+
+class ResultCache(object):
+    """
+    Thread safe LRU cache of query results keyed by canonical (operation, condition, sort, skip, limit, projection).
+
+    Usage:
+        class Article(doc.Doc):
+            class Meta:
+                collection_name = 'article'
+                result_cache = {'max_size': 256, 'store': 'raw', 'max_results': 1000, 'ttl': 60}
+
+        Article.manager.find_cached({'published': True}, sort=[('rank', -1)], limit=10)
+        Article.manager.result_cache.stats()
+    """
+
+    def __init__(self, max_size=256, store='raw', max_results=1000, ttl=None):
+        """
+        :param max_size: number of cached results
+        :param store: 'raw' keeps raw documents, 'ids' keeps `_id`s only (documents are re-read by `_id` on hit)
+        :param max_results: results with more documents are not cached
+        :param ttl: seconds an entry is fresh, None means until the next write of the collection
+        """
+        super(ResultCache, self).__init__()
+        if store not in STORES:
+            raise DeveloperFault('Unknown result cache store "%s", expected one of %s' % (store, STORES))
+        if max_size <= 0 or max_results <= 0 or (ttl is not None and ttl <= 0):
+            raise DeveloperFault('Result cache requires max_size > 0, max_results > 0, and ttl > 0')
+        self.max_size = max_size
+        self.store = store
+        self.max_results = max_results
+        self.ttl = ttl
+        self.entries = OrderedDict()        # key => (write version, expire time or None, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """
+        :return: (True, value) of fresh entry, (False, None) otherwise
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] == version and (entry[1] is None or entry[1] > time.time()):
+                self.entries[key] = entry
+                self.hits += 1
+                return True, entry[2]
+            if entry is not None:
+                self.stale += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, version, value):
+        """
+        :param version: write version read before the result was queried
+        """
+        if isinstance(value, list) and len(value) > self.max_results:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (version, time.time() + self.ttl if self.ttl is not None else None, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+        }
@@ -0,0 +1,191 @@
+from errors import DeveloperFault
+import helpers as helper
+import heapq
+import itertools
+import time
+
+
+class Router(object):
+    """
+    Pick connection (configuration section, see conf.get_connection) of a model's operations (Meta.router).
+    Subclass to implement custom routing.
+    """
+
+    def connections(self):
+        """
+        :return: every connection_name, targets of scattered operations and index creation.
+        """
+        raise NotImplementedError()
+
+    def for_document(self, document):
+        """
+        :param document: raw document to be written
+        :return: connection_name
+        """
+        raise NotImplementedError()
+
+    def for_condition(self, cond):
+        """
+        :param cond: raw condition
+        :return: list of connection_name to be queried, scattered when more than one.
+        """
+        return self.connections()
+
+
+class TenantRouter(Router):
+    """
+    Route by tenant key of documents, conditions without tenant key are scattered to every connection.
+
+    Usage:
+        class Invoice(doc.Doc):
+            tenant = doc.FieldString(none=False)
+
+            class Meta:
+                collection_name = 'invoice'
+                router = TenantRouter('tenant', {'acme': 'cluster_a', 'globex': 'cluster_b'})
+    """
+
+    def __init__(self, key, tenants, default=None):
+        """
+        :param key: document key (dotted path) of tenant
+        :param tenants: {tenant: connection_name}
+        :param default: connection_name of unknown tenants, None means unknown tenant is an error
+        """
+        super(TenantRouter, self).__init__()
+        self.key = key
+        self.tenants = dict(tenants)
+        self.default = default
+
+    def connections(self):
+        return sorted(set(self.tenants.values() + filter(None, [self.default])))
+
+    def connection_of(self, tenant):
+        connection_name = self.tenants.get(tenant, self.default)
+        if connection_name is None:
+            raise DeveloperFault('Unable to route tenant "%s" of "%s"' % (tenant, self.key))
+        return connection_name
+
+    def for_document(self, document):
+        return self.connection_of(helper.value_at(document, self.key))
+
+    def for_condition(self, cond):
+        tenants = self.tenants_of(cond or {})
+        if tenants is None:
+            return self.connections()
+        return sorted(set(map(self.connection_of, tenants)))
+
+    def tenants_of(self, cond):
+        """
+        :return: list of tenants given by condition (equality, $in, $and), None if condition does not restrict tenant.
+        """
+        value = cond.get(self.key)
+        if value is not None and not isinstance(value, dict):
+            return [value]
+        if isinstance(value, dict) and value.keys() == ['$in']:
+            return list(value['$in'])
+        if isinstance(value, dict) and value.keys() == ['$eq']:
+            return [value['$eq']]
+        for sub in cond.get('$and', []):
+            tenants = self.tenants_of(sub)
+            if tenants is not None:
+                return tenants
+        return None
+
+
+class _SortKey(object):
+    """
+    Compare raw documents by cursor's ordering
+    """
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, document, ordering):
+        self.values = map(lambda (k, d): helper.value_at(document, k), ordering)
+        self.directions = map(lambda (k, d): d, ordering)
+
+    def __lt__(self, other):
+        for a, b, d in zip(self.values, other.values, self.directions):
+            if a != b:
+                return a < b if d > 0 else a > b
+        return False
+
+
+class ScatterCursor(object):
+    """
+    Cursor over several connections (routes). Each route's cursor is sorted by its server, results are merged.
+    skip() is applied after merge, limit() is pushed down to every route.
+    """
+
+    def __init__(self, manager, cursors, cond):
+        super(ScatterCursor, self).__init__()
+        self.manager = manager
+        self.cursors = cursors
+        self.cond = cond
+        self.ordering = None
+        self.n_skip = 0
+        self.n_limit = 0
+        self.started = None         # iteration state, see _emit
+        self.returned = 0
+        self.emitted = False
+
+    def sort(self, key_or_list, direction=None):
+        self.ordering = [(key_or_list, direction or 1)] if isinstance(key_or_list, basestring) else list(key_or_list)
+        map(lambda c: c.sort(self.ordering), self.cursors)
+        return self
+
+    def skip(self, n):
+        self.n_skip = n
+        return self
+
+    def limit(self, n):
+        self.n_limit = n
+        return self
+
+    def raws(self):
+        """
+        Raw documents of every route, merged by ordering.
+        """
+        if self.n_limit:
+            map(lambda c: c.limit(self.n_skip + self.n_limit), self.cursors)
+        if self.ordering:
+            keyed = map(lambda c: itertools.imap(lambda raw: (_SortKey(raw, self.ordering), raw), c), self.cursors)
+            raws = itertools.imap(lambda (key, raw): raw, heapq.merge(*keyed))
+        else:
+            raws = itertools.chain(*self.cursors)
+        return itertools.islice(raws, self.n_skip, self.n_skip + self.n_limit if self.n_limit else None)
+
+    def __iter__(self):
+        self.started, self.returned, self.emitted = time.time(), 0, False
+        inflate = self.manager._inflater()
+        for raw in self.raws():
+            self.returned += 1
+            yield inflate(raw)
+        self._emit()
+
+    def _emit(self):
+        """
+        Emit find event once iteration is exhausted or cursor is closed
+        """
+        if self.started is None or self.emitted:
+            return
+        self.emitted = True
+        self.manager.emit('find', self.cond, time.time() - self.started, returned=self.returned)
+
+    def close(self):
+        self._emit()
+        map(lambda c: c.close(), self.cursors)
+
+    def __getitem__(self, index):
+        started = time.time()
+        inflate = self.manager._inflater()
+        for raw in itertools.islice(self.raws(), index, index + 1):
+            o = inflate(raw)
+            self.manager.emit('find', self.cond, time.time() - started, returned=1)
+            return o
+        self.manager.emit('find', self.cond, time.time() - started, returned=0)
+        raise IndexError('no such item for ScatterCursor instance')
+
+    def __len__(self):
+        """
+        Number of documents matching condition on every route (skip, limit are ignored).
+        """
+        return self.manager.count(self.cond)
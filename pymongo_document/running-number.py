@@ -1,5 +1,6 @@
 import datetime
 import documents as doc
+import threading
 from errors import DeveloperFault
 
 
@@ -55,6 +56,7 @@ class RunningNumberCenter(doc.Doc):
     :return: new batch number obeys format: YYYYMMDD#####
     """
     policies = {}
+    policies_lock = threading.Lock()
     name = doc.FieldString(none=False)
     next_value = doc.FieldNumeric(default=1)
 
@@ -63,11 +65,11 @@ class RunningNumberCenter(doc.Doc):
 
     @staticmethod
     def new_number(key):
-        if key not in RunningNumberCenter.policies:
+        policy = RunningNumberCenter.policies.get(key)
+        if policy is None:
             raise DeveloperFault("%s key is not recognized in RunningNumberPolicy" % key)
 
-        policy = RunningNumberCenter.policies[key]
-        pair = RunningNumberCenter.manager.find(cond={'name': key})
+        pair = list(RunningNumberCenter.manager.find({'name': key}).limit(1))
         if len(pair) == 0:
             o = RunningNumberCenter()
             o.name = key
@@ -79,7 +81,11 @@ class RunningNumberCenter(doc.Doc):
 
     @staticmethod
     def register_policy(key, policy):
-        RunningNumberCenter.policies[key] = policy
+        # copy-on-write, new_number reads policies without lock
+        with RunningNumberCenter.policies_lock:
+            policies = dict(RunningNumberCenter.policies)
+            policies[key] = policy
+            RunningNumberCenter.policies = policies
 
     class Meta:
         collection_name = '_number-center'
\ No newline at end of file
@@ -0,0 +1,1016 @@
+"""
+In-memory storage backend, implements the subset of pymongo's Database/Collection/Cursor api used by Docs.
+
+Select it per connection in pymongo-connectors.ini:
+
+    [memory_pool]
+    backend = memory
+    database_name = test_beds
+"""
+from bson import ObjectId
+from collections import OrderedDict, deque
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import ReadPreference
+from pymongo.write_concern import WriteConcern
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+import helpers as helper
+import datetime
+import threading
+import copy
+import re
+
+_regex_type = type(re.compile(''))
+
+
+# Values matching/comparing
+def _type_rank(v):
+    if v is None:
+        return 0
+    if isinstance(v, bool):
+        return 7
+    if isinstance(v, (int, long, float)):
+        return 1
+    if isinstance(v, basestring):
+        return 2
+    if isinstance(v, dict):
+        return 3
+    if isinstance(v, (list, tuple)):
+        return 4
+    if isinstance(v, ObjectId):
+        return 6
+    if isinstance(v, datetime.datetime):
+        return 8
+    return 9
+
+
+def _sort_key(v):
+    return _type_rank(v), v
+
+
+def _resolve(document, path):
+    """
+    Resolve dotted path into list of values, traversing into arrays (mongodb semantic). Missing path => []
+    """
+    parts = path.split('.')
+
+    def walk(v, i):
+        if i == len(parts):
+            return [v]
+        if isinstance(v, dict):
+            return walk(v[parts[i]], i + 1) if parts[i] in v else []
+        if isinstance(v, list):
+            if parts[i].isdigit():
+                index = int(parts[i])
+                return walk(v[index], i + 1) if index < len(v) else []
+            return reduce(lambda r, e: r + walk(e, i), filter(lambda e: isinstance(e, dict), v), [])
+        return []
+    return walk(document, 0)
+
+
+def _expand(values):
+    """
+    Values and elements of array values
+    """
+    r = []
+    for v in values:
+        r.append(v)
+        if isinstance(v, list):
+            r.extend(v)
+    return r
+
+
+def _equals(values, expected):
+    if isinstance(expected, _regex_type):
+        return any(isinstance(v, basestring) and expected.search(v) is not None for v in _expand(values))
+    if len(values) == 0:
+        return expected is None
+    return any(v == expected for v in _expand(values))
+
+
+def _compare(values, expected, op):
+    rank = _type_rank(expected)
+    return any(_type_rank(v) == rank and op(v, expected) for v in _expand(values))
+
+
+def _match_operators(values, ops):
+    for op, expected in ops.iteritems():
+        if op == '$eq':
+            ok = _equals(values, expected)
+        elif op == '$ne':
+            ok = not _equals(values, expected)
+        elif op == '$gt':
+            ok = _compare(values, expected, lambda a, b: a > b)
+        elif op == '$gte':
+            ok = _compare(values, expected, lambda a, b: a >= b)
+        elif op == '$lt':
+            ok = _compare(values, expected, lambda a, b: a < b)
+        elif op == '$lte':
+            ok = _compare(values, expected, lambda a, b: a <= b)
+        elif op == '$in':
+            ok = any(_equals(values, e) for e in expected)
+        elif op == '$nin':
+            ok = not any(_equals(values, e) for e in expected)
+        elif op == '$exists':
+            ok = (len(values) > 0) == bool(expected)
+        elif op == '$regex':
+            flags = reduce(lambda f, c: f | {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(c, 0),
+                           ops.get('$options', ''), 0)
+            pattern = expected if isinstance(expected, _regex_type) else re.compile(expected, flags)
+            ok = _equals(values, pattern)
+        elif op == '$options':
+            ok = True
+        elif op == '$size':
+            ok = any(isinstance(v, list) and len(v) == expected for v in values)
+        elif op == '$all':
+            ok = any(isinstance(v, list) and all(e in v for e in expected) for v in values)
+        elif op == '$elemMatch':
+            ok = any(isinstance(v, list) and any(_match_element(e, expected) for e in v) for v in values)
+        elif op == '$not':
+            ok = not _match_value(values, expected)
+        else:
+            raise NotImplementedError('Operator %s is not supported by memory backend' % op)
+        if not ok:
+            return False
+    return True
+
+
+def _is_operators(cond):
+    return isinstance(cond, dict) and len(cond) > 0 and all(k.startswith('$') for k in cond)
+
+
+def _match_value(values, cond):
+    if _is_operators(cond):
+        return _match_operators(values, cond)
+    return _equals(values, cond)
+
+
+def _match_element(element, cond):
+    if _is_operators(cond):
+        return _match_operators([element], cond)
+    return isinstance(element, dict) and match(element, cond)
+
+
+MATCH_OPERATORS = frozenset(['$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists', '$regex', '$options',
+                             '$size', '$all', '$elemMatch', '$not'])
+LOGICAL_OPERATORS = frozenset(['$and', '$or', '$nor'])
+
+
+def unsupported_operators(cond):
+    """
+    :return: set of operators of condition which match() does not support
+    """
+    found = set()
+    for key, expected in (cond or {}).iteritems():
+        if key in LOGICAL_OPERATORS:
+            map(lambda c: found.update(unsupported_operators(c)), expected)
+        elif key.startswith('$'):
+            found.add(key)
+        else:
+            found.update(_unsupported_value_operators(expected))
+    return found
+
+
+def _unsupported_value_operators(expected):
+    found = set()
+    if not _is_operators(expected):
+        return found
+    for op, value in expected.iteritems():
+        if op not in MATCH_OPERATORS:
+            found.add(op)
+        elif op == '$not':
+            found.update(_unsupported_value_operators(value))
+        elif op == '$elemMatch':
+            found.update(_unsupported_value_operators(value) if _is_operators(value) else unsupported_operators(value))
+    return found
+
+
+def match(document, cond):
+    """
+    Test raw document against query condition, see unsupported_operators()
+    """
+    for key, expected in (cond or {}).iteritems():
+        if key == '$and':
+            ok = all(match(document, c) for c in expected)
+        elif key == '$or':
+            ok = any(match(document, c) for c in expected)
+        elif key == '$nor':
+            ok = not any(match(document, c) for c in expected)
+        elif key.startswith('$'):
+            raise NotImplementedError('Operator %s is not supported by memory backend' % key)
+        else:
+            ok = _match_value(_resolve(document, key), expected)
+        if not ok:
+            return False
+    return True
+
+
+# Updates
+def _parent(document, path, create=True):
+    parts = path.split('.')
+    for p in parts[:-1]:
+        if isinstance(document, list) and p.isdigit():
+            document = document[int(p)]
+            continue
+        if p not in document:
+            if not create:
+                return None, parts[-1]
+            document[p] = {}
+        document = document[p]
+    return document, parts[-1]
+
+
+def _set(document, path, value):
+    parent, key = _parent(document, path)
+    if isinstance(parent, list):
+        parent[int(key)] = value
+    else:
+        parent[key] = value
+
+
+def _get(document, path, default=None):
+    parent, key = _parent(document, path, create=False)
+    if parent is None:
+        return default
+    if isinstance(parent, list):
+        return parent[int(key)] if int(key) < len(parent) else default
+    return parent.get(key, default)
+
+
+def _each(value):
+    return value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+
+
+def _array_filter_match(element, identifier, array_filters):
+    for f in array_filters or []:
+        for key, expected in f.iteritems():
+            name, sep, path = key.partition('.')
+            if name != identifier:
+                continue
+            if not (match(element, {path: expected}) if path else _match_value([element], expected)):
+                return False
+    return True
+
+
+def _positional_paths(document, path, array_filters):
+    """
+    Concrete paths of update path, `$[]` (every element) and `$[identifier]` (elements matching arrayFilters)
+    are expanded to element indexes.
+    """
+    if '.$[' not in path:
+        return [path]
+    head, sep, rest = path.partition('.$[')
+    identifier, sep, tail = rest.partition(']')
+    elements = _get(document, head, [])
+    paths = []
+    for i, element in enumerate(elements if isinstance(elements, list) else []):
+        if identifier and not _array_filter_match(element, identifier, array_filters):
+            continue
+        paths.extend(_positional_paths(document, '%s.%d%s' % (head, i, tail), array_filters))
+    return paths
+
+
+def apply_update(document, update, array_filters=None):
+    """
+    Apply update operators ($set, $unset, $inc, $min, $max, $push, $addToSet, $pull) to raw document in place
+    """
+    for op, fields in update.iteritems():
+        paths = ((p, v) for k, v in fields.iteritems() for p in _positional_paths(document, k, array_filters))
+        for path, value in paths:
+            if op == '$set':
+                _set(document, path, copy.deepcopy(value))
+            elif op == '$unset':
+                parent, key = _parent(document, path, create=False)
+                if isinstance(parent, dict):
+                    parent.pop(key, None)
+            elif op == '$inc':
+                _set(document, path, _get(document, path, 0) + value)
+            elif op == '$min':
+                current = _get(document, path)
+                if current is None or _sort_key(value) < _sort_key(current):
+                    _set(document, path, value)
+            elif op == '$max':
+                current = _get(document, path)
+                if current is None or _sort_key(value) > _sort_key(current):
+                    _set(document, path, value)
+            elif op == '$push':
+                _set(document, path, _get(document, path, []) + copy.deepcopy(_each(value)))
+            elif op == '$addToSet':
+                current = _get(document, path, [])
+                _set(document, path, current + filter(lambda v: v not in current, copy.deepcopy(_each(value))))
+            elif op == '$pull':
+                current = _get(document, path, [])
+                _set(document, path, filter(lambda v: not _match_element(v, value) if isinstance(value, dict)
+                                            else v != value, current))
+            else:
+                raise NotImplementedError('Update operator %s is not supported by memory backend' % op)
+
+
+def _upsert_seed(cond):
+    seed = {}
+    for key, value in cond.iteritems():
+        if key.startswith('$'):
+            continue
+        if not isinstance(value, dict) or not _is_operators(value):
+            _set(seed, key, copy.deepcopy(value))
+        elif '$eq' in value:
+            _set(seed, key, copy.deepcopy(value['$eq']))
+    return seed
+
+
+def project(document, projection):
+    if projection is None:
+        return document
+    if isinstance(projection, (list, tuple)):
+        projection = dict((k, 1) for k in projection)
+    include_id = projection.get('_id', 1)
+    fields = dict((k.split('.')[0], v) for k, v in projection.iteritems() if k != '_id')
+    if any(fields.values()):
+        r = dict((k, v) for k, v in document.iteritems() if k in fields)
+    else:
+        r = dict((k, v) for k, v in document.iteritems() if k not in fields)
+    if include_id and '_id' in document:
+        r['_id'] = document['_id']
+    elif not include_id:
+        r.pop('_id', None)
+    return r
+
+
+def sort_documents(documents, ordering):
+    for key, direction in reversed(list(ordering or [])):
+        documents.sort(key=lambda d: _sort_key((_resolve(d, key) or [None])[0]), reverse=direction < 0)
+    return documents
+
+
+def _evaluate(document, expr):
+    if isinstance(expr, basestring) and expr.startswith('$'):
+        return (_resolve(document, expr[1:]) or [None])[0]
+    if isinstance(expr, dict):
+        return dict((k, _evaluate(document, v)) for k, v in expr.iteritems())
+    return expr
+
+
+_accumulators = {
+    '$sum': lambda values: sum(v for v in values if isinstance(v, (int, long, float)) and not isinstance(v, bool)),
+    '$avg': lambda values: (lambda n: sum(n) / float(len(n)) if n else None)(
+        [v for v in values if isinstance(v, (int, long, float)) and not isinstance(v, bool)]),
+    '$min': lambda values: min([v for v in values if v is not None] or [None], key=_sort_key),
+    '$max': lambda values: max([v for v in values if v is not None] or [None], key=_sort_key),
+    '$first': lambda values: values[0] if values else None,
+    '$last': lambda values: values[-1] if values else None,
+    '$push': list,
+    '$addToSet': lambda values: reduce(lambda r, v: r if v in r else r + [v], values, []),
+}
+
+
+def _group(documents, spec):
+    groups = OrderedDict()
+    for d in documents:
+        key = _evaluate(d, spec['_id'])
+        groups.setdefault(helper.canonical(key), (key, []))[1].append(d)
+    r = []
+    for key, members in groups.itervalues():
+        o = {'_id': key}
+        for name, accumulator in spec.iteritems():
+            if name == '_id':
+                continue
+            (op, expr), = accumulator.items()
+            if op not in _accumulators:
+                raise NotImplementedError('Accumulator %s is not supported by memory backend' % op)
+            o[name] = _accumulators[op](map(lambda m: _evaluate(m, expr), members))
+        r.append(o)
+    return r
+
+
+def _duplicate_key_error(key_pattern, document):
+    """
+    DuplicateKeyError shaped like server's, details carry keyPattern and keyValue
+    """
+    index_name = '_'.join('%s_%s' % k for k in key_pattern.items())
+    key_value = dict((k, _resolve(document, k)) for k in key_pattern)
+    message = 'E11000 duplicate key error index: %s dup key: %s' % (index_name, key_value)
+    return DuplicateKeyError(message, 11000, {'code': 11000, 'errmsg': message,
+                                              'keyPattern': key_pattern, 'keyValue': key_value})
+
+
+class _Index(object):
+    """
+    Secondary index, lookup by leading key, uniqueness checked across all keys.
+    """
+
+    def __init__(self, keys, unique=False, sparse=False):
+        self.keys = keys
+        self.leading = keys[0][0]
+        self.unique = unique
+        self.sparse = sparse
+        self.entries = {}       # canonical value of leading key => set of _id
+        self.identities = {}    # canonical value of all keys => _id (unique only)
+
+    def leading_values(self, document):
+        values = _expand(_resolve(document, self.leading))
+        return map(helper.canonical, values or [None])
+
+    def identity(self, document):
+        return helper.canonical(map(lambda (k, d): _resolve(document, k), self.keys))
+
+    def add(self, document):
+        if self.sparse and not _resolve(document, self.leading):
+            return
+        if self.unique:
+            identity = self.identity(document)
+            if self.identities.get(identity, document['_id']) != document['_id']:
+                raise _duplicate_key_error(OrderedDict(self.keys), document)
+            self.identities[identity] = document['_id']
+        for v in self.leading_values(document):
+            self.entries.setdefault(v, set()).add(document['_id'])
+
+    def remove(self, document):
+        if self.unique:
+            identity = self.identity(document)
+            if self.identities.get(identity) == document['_id']:
+                del self.identities[identity]
+        for v in self.leading_values(document):
+            ids = self.entries.get(v)
+            if ids is not None:
+                ids.discard(document['_id'])
+                if not ids:
+                    del self.entries[v]
+
+    def candidates(self, cond):
+        """
+        :return: set of _id possibly matched, None if this index cannot be used
+        """
+        if self.leading not in cond:
+            return None
+        expected = cond[self.leading]
+        if isinstance(expected, _regex_type):
+            return None
+        if _is_operators(expected):
+            if '$eq' in expected:
+                expected = [expected['$eq']]
+            elif '$in' in expected and not any(isinstance(e, _regex_type) for e in expected['$in']):
+                expected = expected['$in']
+            else:
+                return None
+        else:
+            expected = [expected]
+        r = set()
+        for e in _expand(expected):
+            r.update(self.entries.get(helper.canonical(e), ()))
+        return r
+
+
+class Cursor(object):
+    """
+    Cursor over MemoryCollection, mimic pymongo's Cursor (including name mangled attributes read by MaskedCursor).
+    """
+
+    def __init__(self, collection, filter=None, projection=None, skip=0, limit=0, sort=None, **kwargs):
+        super(Cursor, self).__init__()
+        self.__collection = collection
+        self.__spec = filter or {}
+        self.__projection = projection
+        self.__skip = skip
+        self.__limit = limit
+        self.__ordering = sort and list(sort) or None
+        self.__results = None
+
+    @property
+    def collection(self):
+        return self.__collection
+
+    @property
+    def alive(self):
+        return self.__results is None or len(self.__results) > 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.__results is None:
+            self.__results = self.__collection.query(self.__spec, self.__ordering, self.__skip, self.__limit,
+                                                     self.__projection)
+            self.__results.reverse()
+        if not self.__results:
+            raise StopIteration
+        return self.__results.pop()
+
+    __next__ = next
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start = index.start or 0
+            self.__skip = start
+            self.__limit = index.stop - start if index.stop is not None else 0
+            return self
+        r = self.__collection.query(self.__spec, self.__ordering, self.__skip + index, 1, self.__projection)
+        if not r:
+            raise IndexError('no such item for Cursor instance')
+        return r[0]
+
+    def clone(self):
+        return self.__class__(self.__collection, self.__spec, self.__projection, self.__skip, self.__limit,
+                              self.__ordering)
+
+    def rewind(self):
+        self.__results = None
+        return self
+
+    def close(self):
+        self.__results = []
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, basestring):
+            self.__ordering = [(key_or_list, direction or 1)]
+        else:
+            self.__ordering = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self.__skip = skip
+        return self
+
+    def limit(self, limit):
+        self.__limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self.__collection.query(self.__spec, None, self.__skip, self.__limit, None))
+        return self.__collection.count_documents(self.__spec)
+
+    def distinct(self, key):
+        r = []
+        for document in self.__collection.query(self.__spec, None, self.__skip, self.__limit, None):
+            for v in _expand(_resolve(document, key)):
+                if not isinstance(v, list) and v not in r:
+                    r.append(v)
+        return r
+
+    def explain(self):
+        index = self.__collection.index_for(self.__spec)
+        stage = {'stage': 'IXSCAN', 'indexName': index} if index else {'stage': 'COLLSCAN'}
+        return {'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': stage} if index else stage}}
+
+
+class ChangeStream(object):
+    """
+    Change stream over MemoryCollection, mimic pymongo's ChangeStream. Resume is possible as long as
+    the token is still within collection's change history.
+    """
+
+    def __init__(self, collection, resume_after=None, full_document=None):
+        super(ChangeStream, self).__init__()
+        self.collection = collection
+        self.full_document = full_document
+        self.closed = False
+        with collection.lock:
+            if resume_after is None:
+                self.position = collection.change_sequence
+            else:
+                self.position = resume_after['_data']
+                oldest = collection.changes[0]['_id']['_data'] if collection.changes else collection.change_sequence + 1
+                if self.position + 1 < oldest:
+                    raise OperationFailure('Resume token %s is no longer in change history' % resume_after)
+        self.resume_token = resume_after
+
+    def __iter__(self):
+        return self
+
+    def try_next(self):
+        with self.collection.lock:
+            change = next((c for c in self.collection.changes if c['_id']['_data'] > self.position), None)
+            if change is None:
+                return None
+            self.position = change['_id']['_data']
+            self.resume_token = change['_id']
+            change = copy.deepcopy(change)
+        if change['operationType'] == 'update' and self.full_document != 'updateLookup':
+            change.pop('fullDocument', None)
+        return change
+
+    def next(self):
+        while not self.closed:
+            change = self.try_next()
+            if change is not None:
+                return change
+            with self.collection.changed:
+                self.collection.changed.wait(0.5)
+        raise StopIteration
+
+    __next__ = next
+
+    @property
+    def alive(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MemoryCollection(object):
+    """
+    Thread safe in-memory collection, documents are copied on the way in and out (like BSON round trip).
+    """
+
+    cursor_class = Cursor
+    change_history = 10000
+    # Single node, options are kept for introspection only.
+    read_preference = ReadPreference.PRIMARY
+    read_concern = ReadConcern()
+    write_concern = WriteConcern()
+
+    def __init__(self, database, name):
+        super(MemoryCollection, self).__init__()
+        self.database = database
+        self.name = name
+        self.documents = OrderedDict()      # _id => raw document
+        self.positions = {}                 # _id => insertion sequence
+        self.sequence = 0
+        self.indexes = {}                   # index name => _Index
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.changes = deque(maxlen=self.change_history)
+        self.change_sequence = 0
+        self.watched = False                # change history is recorded once collection is watched
+
+    @property
+    def full_name(self):
+        return '%s.%s' % (self.database.name, self.name)
+
+    def with_options(self, codec_options=None, read_preference=None, write_concern=None, read_concern=None):
+        return CollectionView(self, read_preference=read_preference or self.read_preference,
+                              write_concern=write_concern or self.write_concern,
+                              read_concern=read_concern or self.read_concern)
+
+    def watch(self, pipeline=None, full_document=None, resume_after=None, **kwargs):
+        self.watched = True
+        return ChangeStream(self, resume_after=resume_after, full_document=full_document)
+
+    def _publish(self, operation, object_id, document=None):
+        if not self.watched:
+            return
+        with self.lock:
+            self.change_sequence += 1
+            change = {
+                '_id': {'_data': self.change_sequence},
+                'operationType': operation,
+                'ns': {'db': self.database.name, 'coll': self.name},
+                'documentKey': {'_id': object_id},
+            }
+            if document is not None:
+                change['fullDocument'] = copy.deepcopy(document)
+            self.changes.append(change)
+            self.changed.notify_all()
+
+    # Indexes
+    def create_index(self, keys, **kwargs):
+        keys = [(keys, 1)] if isinstance(keys, basestring) else map(tuple, keys)
+        name = kwargs.get('name') or '_'.join('%s_%s' % k for k in keys)
+        with self.lock:
+            if name not in self.indexes:
+                index = _Index(keys, unique=kwargs.get('unique', False), sparse=kwargs.get('sparse', False))
+                map(index.add, self.documents.itervalues())
+                self.indexes[name] = index
+        return name
+
+    def drop_index(self, name):
+        with self.lock:
+            self.indexes.pop(name, None)
+
+    def index_information(self):
+        return dict((name, {'key': index.keys, 'unique': index.unique}) for name, index in self.indexes.iteritems())
+
+    def index_for(self, cond):
+        if isinstance(cond, dict) and '_id' in cond:
+            return '_id_'
+        return next((name for name, index in self.indexes.iteritems()
+                     if isinstance(cond, dict) and index.candidates(cond) is not None), None)
+
+    # Reading
+    def _matched(self, cond):
+        """
+        :return: list of matched raw documents (not copied), in insertion order.
+        """
+        if not isinstance(cond, dict):
+            cond = {'_id': cond}
+        with self.lock:
+            expected = cond.get('_id') if '_id' in cond else None
+            if expected is not None and not _is_operators(expected) and not isinstance(expected, _regex_type):
+                document = self.documents.get(expected)
+                return [document] if document is not None and match(document, cond) else []
+            candidates = None
+            for index in self.indexes.itervalues():
+                candidates = index.candidates(cond)
+                if candidates is not None:
+                    break
+            if candidates is None:
+                documents = self.documents.itervalues()
+            else:
+                documents = filter(None, map(self.documents.get, candidates))
+                documents.sort(key=lambda d: self.positions[d['_id']])
+            return filter(lambda d: match(d, cond), documents)
+
+    def query(self, cond, ordering=None, skip=0, limit=0, projection=None):
+        documents = sort_documents(self._matched(cond), ordering)
+        documents = documents[skip:skip + limit] if limit else documents[skip:]
+        return map(lambda d: project(copy.deepcopy(d), projection), documents)
+
+    def find(self, *args, **kwargs):
+        return self.cursor_class(self, *args, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        r = self.find(filter, *args, **kwargs).limit(1)
+        return next(iter(r), None)
+
+    def count_documents(self, filter, limit=0, skip=0, **kwargs):
+        n = max(0, len(self._matched(filter)) - skip)
+        return min(n, limit) if limit else n
+
+    def estimated_document_count(self, **kwargs):
+        return len(self.documents)
+
+    def distinct(self, key, filter=None):
+        return self.find(filter).distinct(key)
+
+    # Writing
+    def _store(self, document, previous=None, operation='update'):
+        with self.lock:
+            if previous is not None:
+                map(lambda index: index.remove(previous), self.indexes.itervalues())
+            try:
+                map(lambda index: index.add(document), self.indexes.itervalues())
+            except DuplicateKeyError:
+                map(lambda index: index.remove(document), self.indexes.itervalues())
+                if previous is not None:
+                    map(lambda index: index.add(previous), self.indexes.itervalues())
+                raise
+            if document['_id'] not in self.positions:
+                self.sequence += 1
+                self.positions[document['_id']] = self.sequence
+            self.documents[document['_id']] = document
+            self._publish(operation if previous is not None else 'insert', document['_id'], document)
+
+    def insert_one(self, document, **kwargs):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        with self.lock:
+            if document['_id'] in self.documents:
+                raise _duplicate_key_error({'_id': 1}, document)
+            self._store(copy.deepcopy(document))
+        return InsertOneResult(document['_id'], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        ids = []
+        errors = []
+        for i, document in enumerate(documents):
+            try:
+                ids.append(self.insert_one(document).inserted_id)
+            except DuplicateKeyError as e:
+                errors.append(dict(e.details, index=i, op=document))
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({'nInserted': len(ids), 'nUpserted': 0, 'nMatched': 0, 'nModified': 0,
+                                  'nRemoved': 0, 'upserted': [], 'writeErrors': errors, 'writeConcernErrors': []})
+        return InsertManyResult(ids, True)
+
+    def save(self, document, **kwargs):
+        if '_id' not in document:
+            return self.insert_one(document).inserted_id
+        self.replace_one({'_id': document['_id']}, document, upsert=True)
+        return document['_id']
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        with self.lock:
+            matched = self._matched(filter)[:1]
+            if not matched:
+                if not upsert:
+                    return UpdateResult({'n': 0, 'nModified': 0}, True)
+                document = _upsert_seed(filter)
+                document.update(copy.deepcopy(replacement))
+                self.insert_one(document)
+                return UpdateResult({'n': 1, 'nModified': 0, 'upserted': document['_id']}, True)
+            document = copy.deepcopy(replacement)
+            document['_id'] = matched[0]['_id']
+            self._store(document, matched[0], 'replace')
+            return UpdateResult({'n': 1, 'nModified': 1}, True)
+
+    def _update(self, filter, update, upsert, many, array_filters=None):
+        if not all(k.startswith('$') for k in update):
+            raise ValueError('update only works with $ operators')
+        with self.lock:
+            matched = self._matched(filter)
+            if not many:
+                matched = matched[:1]
+            if not matched:
+                if not upsert:
+                    return UpdateResult({'n': 0, 'nModified': 0}, True)
+                document = _upsert_seed(filter)
+                apply_update(document, update)
+                self.insert_one(document)
+                return UpdateResult({'n': 1, 'nModified': 0, 'upserted': document['_id']}, True)
+            modified = 0
+            for previous in matched:
+                document = copy.deepcopy(previous)
+                apply_update(document, update, array_filters)
+                if document != previous:
+                    self._store(document, previous)
+                    modified += 1
+            return UpdateResult({'n': len(matched), 'nModified': modified}, True)
+
+    def update_one(self, filter, update, upsert=False, array_filters=None, **kwargs):
+        return self._update(filter, update, upsert, False, array_filters)
+
+    def update_many(self, filter, update, upsert=False, array_filters=None, **kwargs):
+        return self._update(filter, update, upsert, True, array_filters)
+
+    def find_one_and_update(self, filter, update, upsert=False, return_document=False, **kwargs):
+        with self.lock:
+            before = self.find_one(filter)
+            r = self._update(filter, update, upsert, False)
+            if not return_document:
+                return before
+            object_id = r.upserted_id if r.upserted_id is not None else before and before['_id']
+            return object_id is not None and self.find_one({'_id': object_id}) or None
+
+    def _delete(self, filter, many):
+        with self.lock:
+            matched = self._matched(filter)
+            if not many:
+                matched = matched[:1]
+            for document in matched:
+                map(lambda index: index.remove(document), self.indexes.itervalues())
+                del self.documents[document['_id']]
+                del self.positions[document['_id']]
+                self._publish('delete', document['_id'])
+            return DeleteResult({'n': len(matched)}, True)
+
+    def delete_one(self, filter, **kwargs):
+        return self._delete(filter, False)
+
+    def delete_many(self, filter, **kwargs):
+        return self._delete(filter, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        Supported requests: InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+        """
+        r = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': [],
+             'writeErrors': [], 'writeConcernErrors': []}
+        for i, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self.insert_one(request._doc)
+                    r['nInserted'] += 1
+                    continue
+                if isinstance(request, (DeleteOne, DeleteMany)):
+                    r['nRemoved'] += self._delete(request._filter, isinstance(request, DeleteMany)).deleted_count
+                    continue
+                if isinstance(request, ReplaceOne):
+                    result = self.replace_one(request._filter, request._doc, request._upsert)
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    result = self._update(request._filter, request._doc, request._upsert,
+                                          isinstance(request, UpdateMany), request._array_filters)
+                else:
+                    raise TypeError('%r is not a valid request' % request)
+                if result.upserted_id is not None:
+                    r['nUpserted'] += 1
+                    r['upserted'].append({'index': i, '_id': result.upserted_id})
+                else:
+                    r['nMatched'] += result.matched_count
+                    r['nModified'] += result.modified_count
+            except DuplicateKeyError as e:
+                r['writeErrors'].append(dict(e.details, index=i, op=request))
+                if ordered:
+                    break
+        if r['writeErrors']:
+            raise BulkWriteError(r)
+        return BulkWriteResult(r, True)
+
+    def drop(self):
+        with self.lock:
+            self.documents.clear()
+            self.positions.clear()
+            self.indexes.clear()
+
+    # Aggregation
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Supported stages: $match, $sort, $skip, $limit, $project, $unwind (path only), $lookup (localField),
+        $group (field references only)
+        """
+        with self.lock:
+            documents = map(copy.deepcopy, self.documents.itervalues())
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == '$match':
+                documents = filter(lambda d: match(d, spec), documents)
+            elif name == '$sort':
+                documents = sort_documents(documents, spec.items())
+            elif name == '$skip':
+                documents = documents[spec:]
+            elif name == '$limit':
+                documents = documents[:spec]
+            elif name == '$project':
+                documents = map(lambda d: project(d, spec), documents)
+            elif name == '$unwind':
+                path = (spec['path'] if isinstance(spec, dict) else spec)[1:]
+                unwound = []
+                for d in documents:
+                    for v in (_get(d, path) or []):
+                        u = copy.deepcopy(d)
+                        _set(u, path, v)
+                        unwound.append(u)
+                documents = unwound
+            elif name == '$group':
+                documents = _group(documents, spec)
+            elif name == '$lookup':
+                foreign = self.database[spec['from']]
+                for d in documents:
+                    local = _expand(_resolve(d, spec['localField'])) or [None]
+                    d[spec['as']] = foreign.query({spec['foreignField']: {'$in': local}})
+            else:
+                raise NotImplementedError('Stage %s is not supported by memory backend' % name)
+        return iter(documents)
+
+
+class CollectionView(object):
+    """
+    MemoryCollection with its own options (see MemoryCollection.with_options), state is shared with the collection.
+    """
+
+    cursor_class = Cursor
+
+    def __init__(self, collection, **options):
+        super(CollectionView, self).__init__()
+        self.collection = collection
+        self.__dict__.update(options)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def with_options(self, codec_options=None, read_preference=None, write_concern=None, read_concern=None):
+        return self.collection.with_options(read_preference=read_preference or self.read_preference,
+                                            write_concern=write_concern or self.write_concern,
+                                            read_concern=read_concern or self.read_concern)
+
+
+class MemoryDatabase(object):
+    """
+    In-memory database, databases are shared per (connection_name, database_name) within the process.
+    """
+
+    instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name):
+        super(MemoryDatabase, self).__init__()
+        self.name = name
+        self.collections = {}
+        self._collections_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, connection_name, database_name):
+        with cls._lock:
+            key = (connection_name, database_name)
+            if key not in cls.instances:
+                cls.instances[key] = MemoryDatabase(database_name)
+            return cls.instances[key]
+
+    def __getitem__(self, name):
+        with self._collections_lock:
+            if name not in self.collections:
+                self.collections[name] = MemoryCollection(self, name)
+            return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self):
+        return self.collections.keys()
+
+    def drop_collection(self, name):
+        with self._collections_lock:
+            collection = self.collections.pop(name, None)
+        if collection is not None:
+            collection.drop()
+
+
+def factory(connection_name, cnf, database_name):
+    return MemoryDatabase.get(connection_name, database_name)
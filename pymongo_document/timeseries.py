@@ -0,0 +1,354 @@
+"""
+Time-series bucketing (Meta.bucket), readings of the same key and time span are appended into one bucket document.
+
+Bucket document:
+    {'_id': ObjectId, <key>: key value, 'start': start of span, 'count': number of readings,
+     'min': earliest reading time, 'max': latest reading time, 'items': [reading documents without <key>]}
+
+Usage:
+    class Reading(doc.Doc):
+        sensor = doc.FieldString(none=False)
+        ts = doc.FieldDateTime(none=False)
+        value = doc.FieldNumeric()
+
+        class Meta:
+            collection_name = 'reading'
+            bucket = {'key': 'sensor', 'time_field': 'ts', 'max_items': 500, 'span': '1h'}
+"""
+from bson import ObjectId
+from errors import DeveloperFault, DocumentValidationError
+from routing import _SortKey
+from storage import match, unsupported_operators
+import datetime
+import heapq
+import itertools
+import time
+
+_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_epoch = datetime.datetime(1970, 1, 1)
+_range_operators = ('$gt', '$gte', '$lt', '$lte', '$eq')
+
+
+def parse_span(span):
+    """
+    :param span: '30s', '15m', '1h', '1d', or seconds
+    :return: timedelta
+    """
+    if isinstance(span, datetime.timedelta):
+        return span
+    if isinstance(span, basestring) and span[-1:] in _units and span[:-1].isdigit():
+        seconds = int(span[:-1]) * _units[span[-1]]
+    elif isinstance(span, (int, long)):
+        seconds = span
+    else:
+        raise DeveloperFault('Bad bucket span "%s", expected e.g. 30s, 15m, 1h, 1d' % span)
+    if seconds <= 0:
+        raise DeveloperFault('Bucket span must be greater than 0')
+    return datetime.timedelta(seconds=seconds)
+
+
+class Bucketing(object):
+    """
+    Bucket layout of a model (Meta.bucket), translates readings into bucket operations and back.
+    """
+
+    def __init__(self, key, time_field, max_items=1000, span='1h'):
+        super(Bucketing, self).__init__()
+        if max_items <= 0:
+            raise DeveloperFault('Bucket max_items must be greater than 0')
+        self.key_field = key
+        self.time_field = time_field
+        self.max_items = max_items
+        self.span = parse_span(span)
+        self.key = key                  # document keys, see bind()
+        self.time = time_field
+
+    def bind(self, doc_class, fields):
+        """
+        Resolve document keys of bucket key and time fields of registered model.
+
+        :param fields: FieldSpec of doc_class by name
+        """
+        for name in (self.key_field, self.time_field):
+            if name not in fields:
+                raise DeveloperFault('"%s" has no field "%s" to bucket by' % (doc_class.__name__, name))
+        self.key = fields[self.key_field].key or self.key_field
+        self.time = fields[self.time_field].key or self.time_field
+
+    def indices(self):
+        return [[(self.key, 1), ('start', 1)], [('start', 1)]]
+
+    def start_of(self, ts):
+        span = int(self.span.total_seconds())
+        return _epoch + datetime.timedelta(seconds=int((ts - _epoch).total_seconds()) // span * span)
+
+    def split(self, document):
+        """
+        :return: (key value, reading time, item stored in bucket)
+        """
+        ts = document.get(self.time)
+        if not isinstance(ts, datetime.datetime):
+            raise DocumentValidationError('Reading requires "%s" datetime to be bucketed' % self.time_field)
+        item = dict(document)
+        return item.pop(self.key, None), ts, item
+
+    def appends(self, documents):
+        """
+        Upserts appending readings into buckets, one per bucket (key, span) and at most max_items readings each.
+        A bucket is filled until max_items, then the next upsert creates a new bucket of the same span.
+
+        :return: list of (condition, update) to be upserted
+        """
+        groups = {}
+        order = []
+        for document in documents:
+            if document.get('_id') is None:
+                document['_id'] = ObjectId()      # readings are addressed by `_id`, as insert_one assigns it
+            k, ts, item = self.split(document)
+            group = (k, self.start_of(ts))
+            if group not in groups:
+                groups[group] = []
+                order.append(group)
+            groups[group].append((ts, item))
+        operations = []
+        for k, start in order:
+            readings = groups[(k, start)]
+            for i in range(0, len(readings), self.max_items):
+                chunk = readings[i:i + self.max_items]
+                items = map(lambda (ts, item): item, chunk)
+                times = map(lambda (ts, item): ts, chunk)
+                cond = {self.key: k, 'start': start, 'count': {'$lte': self.max_items - len(chunk)}}
+                operations.append((cond, {
+                    '$push': {'items': items[0] if len(items) == 1 else {'$each': items}},
+                    '$inc': {'count': len(items)},
+                    '$min': {'min': min(times)},
+                    '$max': {'max': max(times)},
+                }))
+        return operations
+
+    def replace_operation(self, document, bucket):
+        """
+        :param bucket: current bucket of the reading (`_id`, key and start), found by `items._id`
+        :return: (condition, update, array_filters) replacing the reading within its bucket, None when its key or
+            span changed (see pull_operation and appends)
+        """
+        k, ts, item = self.split(document)
+        if bucket.get(self.key) != k or bucket.get('start') != self.start_of(ts):
+            return None
+        cond = {'_id': bucket['_id'], 'items._id': document['_id']}
+        update = {'$set': {'items.$[reading]': item}, '$min': {'min': ts}, '$max': {'max': ts}}
+        return cond, update, [{'reading._id': document['_id']}]
+
+    def pull_operation(self, object_id, bucket):
+        """
+        Remove a reading moving out of its bucket, bucket's min and max are kept (they remain a valid bound).
+
+        :return: (condition, update)
+        """
+        return {'_id': bucket['_id'], 'items._id': object_id}, {'$pull': {'items': {'_id': object_id}},
+                                                                 '$inc': {'count': -1}}
+
+    def reading_of(self, bucket, item):
+        reading = dict(item)
+        reading[self.key] = bucket.get(self.key)
+        return reading
+
+    def readings(self, bucket, cond=None):
+        """
+        :return: generator of raw readings of bucket, matching condition if given
+        """
+        for item in bucket.get('items', []):
+            reading = self.reading_of(bucket, item)
+            if not cond or match(reading, cond):
+                yield reading
+
+    def time_range(self, cond):
+        """
+        :return: (time range, exact), time range is dict of $gt, $gte, $lt, $lte of reading time given by condition,
+            exact is True if condition only restricts bucket key and reading time range (whole buckets may be counted
+            by their summary).
+        """
+        value = cond.get(self.time)
+        if value is None:
+            bounds = {}
+        elif not isinstance(value, dict):
+            bounds = {'$gte': value, '$lte': value}
+        elif all(op in _range_operators for op in value):
+            bounds = dict(value)
+            if '$eq' in bounds:
+                bounds['$gte'] = bounds['$lte'] = bounds.pop('$eq')
+        else:
+            return {}, False
+        return bounds, all(k in (self.key, self.time) for k in cond)
+
+    def bucket_condition(self, cond):
+        """
+        Condition of buckets which may contain readings matching condition (reading key and time range).
+        Readings are matched in process (storage.match), DeveloperFault if condition has operators it lacks.
+        """
+        unsupported = unsupported_operators(cond)
+        if unsupported:
+            raise DeveloperFault('Operators %s are not supported by conditions of bucketed readings (Meta.bucket)'
+                                 % sorted(unsupported))
+        bucket_cond = {}
+        if self.key in cond:
+            bucket_cond[self.key] = cond[self.key]
+        if '_id' in cond:
+            bucket_cond['items._id'] = cond['_id']
+        bounds, exact = self.time_range(cond)
+        lower = bounds.get('$gte', bounds.get('$gt'))
+        upper = bounds.get('$lte', bounds.get('$lt'))
+        if lower is not None:
+            bucket_cond['max'] = {'$gte': lower}
+            bucket_cond['start'] = {'$gt': lower - self.span}
+        if upper is not None:
+            bucket_cond['min'] = {'$lte': upper}
+            bucket_cond.setdefault('start', {})['$lte'] = upper
+        return bucket_cond
+
+    def covers(self, bucket, bounds):
+        """
+        True if every reading of bucket is within time range
+        """
+        low, high = bucket.get('min'), bucket.get('max')
+        return (('$gt' not in bounds or low > bounds['$gt']) and ('$gte' not in bounds or low >= bounds['$gte'])
+                and ('$lt' not in bounds or high < bounds['$lt']) and ('$lte' not in bounds or high <= bounds['$lte']))
+
+    def remove(self, collection, cond, retries=10):
+        """
+        Remove readings matching condition. Emptied buckets are deleted, other buckets are replaced with remaining
+        readings and their summary, unless they were appended meanwhile (then re-read and retried).
+
+        :return: number of removed readings
+        """
+        if not cond:
+            removed = sum(map(lambda b: b.get('count', 0), collection.find({}, {'count': 1})))
+            collection.delete_many({})
+            return removed
+        removed = 0
+        for bucket in collection.find(self.bucket_condition(cond)):
+            for attempt in range(retries):
+                kept = filter(lambda item: not match(self.reading_of(bucket, item), cond), bucket['items'])
+                if len(kept) == len(bucket['items']):
+                    break
+                guard = {'_id': bucket['_id'], 'count': bucket['count']}
+                if kept:
+                    times = map(lambda item: item[self.time], kept)
+                    replacement = dict(bucket, items=kept, count=len(kept), min=min(times), max=max(times))
+                    matched = collection.replace_one(guard, replacement).matched_count
+                else:
+                    matched = collection.delete_one(guard).deleted_count
+                if matched:
+                    removed += len(bucket['items']) - len(kept)
+                    break
+                bucket = collection.find_one({'_id': bucket['_id']})
+                if bucket is None:
+                    break
+            else:
+                raise DocumentValidationError('Failed to remove readings of bucket %s, it is busy' % bucket['_id'])
+        return removed
+
+    def count(self, collections, cond):
+        """
+        Number of readings matching condition. Buckets within key and time range condition are counted by their
+        summary, other buckets by their matching readings.
+        """
+        bounds, exact = self.time_range(cond)
+        bucket_cond = self.bucket_condition(cond)
+        n = 0
+        for collection in collections:
+            if exact:
+                summaries = collection.find(bucket_cond, {'count': 1, 'min': 1, 'max': 1})
+                partial = []
+                for bucket in summaries:
+                    if self.covers(bucket, bounds):
+                        n += bucket.get('count', 0)
+                    else:
+                        partial.append(bucket['_id'])
+                if not partial:
+                    continue
+                buckets = collection.find({'_id': {'$in': partial}})
+            else:
+                buckets = collection.find(bucket_cond)
+            n += sum(sum(1 for r in self.readings(bucket, cond)) for bucket in buckets)
+        return n
+
+
+class BucketCursor(object):
+    """
+    Cursor of readings of bucketed model (Meta.bucket), buckets are unwound into readings matching the condition.
+    Buckets are read in (key, start) order, readings in order of append. sort() sorts matching readings in memory.
+    """
+
+    def __init__(self, manager, cond):
+        super(BucketCursor, self).__init__()
+        self.manager = manager
+        self.cond = cond
+        self.ordering = None
+        self.n_skip = 0
+        self.n_limit = 0
+        self.started = None         # iteration state, see _emit
+        self.returned = 0
+        self.emitted = False
+
+    def sort(self, key_or_list, direction=None):
+        self.ordering = [(key_or_list, direction or 1)] if isinstance(key_or_list, basestring) else list(key_or_list)
+        return self
+
+    def skip(self, n):
+        self.n_skip = n
+        return self
+
+    def limit(self, n):
+        self.n_limit = n
+        return self
+
+    def raws(self):
+        bucketing = self.manager.bucketing
+        bucket_cond = bucketing.bucket_condition(self.cond)
+        buckets = itertools.chain.from_iterable(
+            itertools.imap(lambda c: c.find(bucket_cond).sort([(bucketing.key, 1), ('start', 1)]),
+                           self.manager.collections_for(self.cond)))
+        raws = itertools.chain.from_iterable(itertools.imap(lambda b: bucketing.readings(b, self.cond), buckets))
+        if self.ordering:
+            end = self.n_skip + self.n_limit if self.n_limit else None
+            keyed = itertools.imap(lambda raw: (_SortKey(raw, self.ordering), raw), raws)
+            selected = heapq.nsmallest(end, keyed) if end is not None else sorted(keyed)
+            raws = itertools.imap(lambda (key, raw): raw, selected)
+        return itertools.islice(raws, self.n_skip, self.n_skip + self.n_limit if self.n_limit else None)
+
+    def __iter__(self):
+        self.started, self.returned, self.emitted = time.time(), 0, False
+        inflate = self.manager._inflater()
+        for raw in self.raws():
+            self.returned += 1
+            yield inflate(raw)
+        self._emit()
+
+    def _emit(self):
+        """
+        Emit find event once iteration is exhausted or cursor is closed
+        """
+        if self.started is None or self.emitted:
+            return
+        self.emitted = True
+        self.manager.emit('find', self.cond, time.time() - self.started, returned=self.returned)
+
+    def close(self):
+        self._emit()
+
+    def __getitem__(self, index):
+        started = time.time()
+        inflate = self.manager._inflater()
+        for raw in itertools.islice(self.raws(), index, index + 1):
+            o = inflate(raw)
+            self.manager.emit('find', self.cond, time.time() - started, returned=1)
+            return o
+        self.manager.emit('find', self.cond, time.time() - started, returned=0)
+        raise IndexError('no such item for BucketCursor instance')
+
+    def __len__(self):
+        """
+        Number of readings matching condition (skip, limit are ignored).
+        """
+        return self.manager.count(self.cond)
@@ -0,0 +1,314 @@
+"""
+Streaming export / import of registered models, NDJSON (MongoDB extended JSON, one document per line) or CSV.
+
+    pymongo-document --config settings/ export user --output users.ndjson
+    pymongo-document --config settings/ import user --input users.ndjson --batch-size 1000 --workers 4
+    pymongo-document --config settings/ export user --format csv --query '{"active": true}' > users.csv
+
+Documents are streamed through generators (read, validate, batch, write), memory use does not grow with the
+number of documents. Imported rows are validated by the model's FieldSpecs, and written with bulk_write of
+upserting replace_one (see Docs.replace_many), existing documents with the same `_id` are replaced.
+"""
+from bson import ObjectId, json_util
+from conf import update_config
+from errors import DeveloperFault, DocumentValidationError, FieldValidationError
+import documents as doc
+import Queue
+import argparse
+import contextlib
+import csv
+import importlib
+import itertools
+import sys
+import threading
+import time
+
+FORMATS = ('ndjson', 'csv')
+_json_options = json_util.JSONOptions(tz_aware=False)     # datetimes are read naive, as pymongo does by default
+
+
+class Progress(object):
+    """
+    Count transferred rows, report rows per second to `stream` at most every `interval` seconds.
+    """
+
+    def __init__(self, label, stream=None, interval=5.0):
+        super(Progress, self).__init__()
+        self.label = label
+        self.stream = stream
+        self.interval = interval
+        self.started = time.time()
+        self.reported = self.started
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.rows += n
+            now = time.time()
+            if self.stream is None or now - self.reported < self.interval:
+                return
+            self.reported = now
+        self.stream.write('%s: %d rows, %.0f rows/s\n' % (self.label, self.rows, self.rows / (now - self.started)))
+
+    def report(self):
+        seconds = time.time() - self.started
+        report = {
+            'rows': self.rows,
+            'seconds': seconds,
+            'rows_per_sec': self.rows / seconds if seconds > 0 else None,
+        }
+        if self.stream is not None:
+            self.stream.write('%s: %d rows in %.2fs, %.0f rows/s\n' % (self.label, self.rows, seconds,
+                                                                      report['rows_per_sec'] or 0))
+        return report
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _csv_codec(fs):
+    """
+    :return: (encode, decode) of a CSV cell of given FieldSpec, strings and ObjectIds are written as is, other values
+        as extended JSON.
+    """
+    if isinstance(fs, doc.FieldString):
+        return lambda v: v.encode('utf-8') if isinstance(v, unicode) else v, lambda s: s.decode('utf-8')
+    if isinstance(fs, (doc.FieldObjectId, doc.FieldFile)) or (isinstance(fs, doc.FieldDoc) and not fs.embed):
+        return str, ObjectId
+    return json_util.dumps, lambda s: json_util.loads(s, json_options=_json_options)
+
+
+def csv_columns(doc_class):
+    """
+    :return: list of (document key, encode, decode) of model's stored fields, `_id` first.
+    """
+    fields = filter(lambda (k, fs): not fs.transient, doc._field_specs(doc_class)[0].iteritems())
+    columns = sorted(map(lambda (k, fs): (fs.key or k,) + _csv_codec(fs), fields))
+    return sorted(columns, key=lambda c: c[0] != '_id')
+
+
+def write_ndjson(stream, raws):
+    for raw in raws:
+        stream.write(json_util.dumps(raw))
+        stream.write('\n')
+        yield raw
+
+
+def read_ndjson(stream):
+    """
+    :return: generator of (line number, raw document)
+    """
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            yield number, json_util.loads(line, json_options=_json_options)
+
+
+def write_csv(stream, doc_class, raws):
+    """
+    Header row is the document keys of the model, missing and null values are empty cells.
+    """
+    columns = csv_columns(doc_class)
+    writer = csv.writer(stream)
+    writer.writerow(map(lambda c: c[0], columns))
+    for raw in raws:
+        writer.writerow(map(lambda (key, encode, decode): '' if raw.get(key) is None else encode(raw[key]), columns))
+        yield raw
+
+
+def read_csv(stream, doc_class):
+    """
+    :return: generator of (line number, raw document), empty cells are missing keys.
+    """
+    codecs = dict(map(lambda (key, encode, decode): (key, decode), csv_columns(doc_class)))
+    reader = csv.reader(stream)
+    header = next(reader, None) or []
+    unknown = filter(lambda key: key not in codecs, header)
+    if unknown:
+        raise DeveloperFault('"%s" has no field %s' % (doc_class.__name__, unknown))
+    for row in reader:
+        try:
+            yield reader.line_num, dict((k, codecs[k](v)) for k, v in zip(header, row) if v != '')
+        except ValueError as e:
+            raise DocumentValidationError('line %d: %s' % (reader.line_num, e))
+
+
+def validated(doc_class, rows):
+    """
+    Inflate raw documents into the model (or its sub collection class, by `_subtype`) and validate them.
+
+    :param rows: iterable of (line number, raw document)
+    :return: generator of (manager, document) ready to be written
+    """
+    classes = doc.Docs.subtypes.get(doc_class.manager.db_name, {})
+    for number, raw in rows:
+        clazz = classes.get(raw.pop('_subtype', doc_class.manager.sub_collection_name))
+        if clazz is None or not issubclass(clazz, doc_class):
+            raise DocumentValidationError('line %d: unknown document type of "%s"' % (number, doc_class.__name__))
+        o = clazz()
+        try:
+            o.inflate(raw)
+            o.validate()
+        except (FieldValidationError, DocumentValidationError, ValueError, TypeError) as e:
+            raise DocumentValidationError('line %d: %s' % (number, e))
+        yield o.manager, o.document()
+
+
+def write_parallel(write, batches, workers):
+    """
+    Call write(batch) for each batch by `workers` threads, batches are read ahead by at most 2 per worker.
+    First failure stops the transfer and is raised.
+
+    :return: sum of write(batch)
+    """
+    if workers <= 1:
+        return sum(itertools.imap(write, batches))
+    queue = Queue.Queue(maxsize=workers * 2)
+    failures = []
+    written = [0]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            batch = queue.get()
+            if batch is None:
+                return
+            try:
+                if not failures:
+                    n = write(batch)
+                    with lock:
+                        written[0] += n
+            except Exception:
+                failures.append(sys.exc_info())
+
+    threads = map(lambda i: threading.Thread(target=work, name='transfer-writer:%d' % i), range(workers))
+    map(lambda t: t.setDaemon(True), threads)
+    map(lambda t: t.start(), threads)
+    try:
+        for batch in batches:
+            if failures:
+                break
+            queue.put(batch)
+    finally:
+        map(lambda t: queue.put(None), threads)
+        map(lambda t: t.join(), threads)
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    return written[0]
+
+
+def export_documents(doc_class, stream, format='ndjson', cond=None, batch_size=1000, progress=None):
+    """
+    Stream stored documents of the model (raw, as stored) into stream.
+
+    :param cond: condition, query.Query or query.Template
+    :param progress: Progress, None means not reported
+    :return: report dict of rows, seconds, rows_per_sec
+    """
+    if format not in FORMATS:
+        raise DeveloperFault('Unknown format "%s", expected one of %s' % (format, FORMATS))
+    progress = progress or Progress('export %s' % doc_class.manager.collection_name)
+    manager = doc_class.manager
+    cond = manager.scope(cond)
+    raws = itertools.chain.from_iterable(
+        itertools.imap(lambda c: c.find(cond, batch_size=batch_size), manager.collections_for(cond)))
+    written = write_ndjson(stream, raws) if format == 'ndjson' else write_csv(stream, doc_class, raws)
+    for batch in batches(written, batch_size):
+        progress.add(len(batch))
+    stream.flush()
+    return progress.report()
+
+
+def import_documents(doc_class, stream, format='ndjson', batch_size=1000, workers=1, progress=None):
+    """
+    Stream documents from stream into the model's collection, validated by model's FieldSpecs, written in batches
+    of replace_many (upsert) by `workers` threads.
+
+    :param progress: Progress, None means not reported
+    :return: report dict of rows, seconds, rows_per_sec
+    """
+    if format not in FORMATS:
+        raise DeveloperFault('Unknown format "%s", expected one of %s' % (format, FORMATS))
+    if batch_size <= 0 or workers <= 0:
+        raise DeveloperFault('import requires batch_size > 0, and workers > 0')
+    progress = progress or Progress('import %s' % doc_class.manager.collection_name)
+    rows = read_ndjson(stream) if format == 'ndjson' else read_csv(stream, doc_class)
+
+    def write(batch):
+        managers = []
+        for manager, document in batch:
+            routed = next((m for m in managers if m[0] is manager), None)
+            if routed is None:
+                routed = (manager, [])
+                managers.append(routed)
+            routed[1].append(document)
+        map(lambda (manager, documents): manager.replace_many(documents), managers)
+        progress.add(len(batch))
+        return len(batch)
+
+    write_parallel(write, batches(validated(doc_class, rows), batch_size), workers)
+    return progress.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pymongo-document')
+    parser.add_argument('--config', default=None, help='pymongo-connectors.ini, or its directory')
+    parser.add_argument('--module', action='append', default=[], help='import module defining models, repeatable')
+    commands = parser.add_subparsers()
+
+    p = commands.add_parser('export', help='write documents of collection_name to output')
+    p.add_argument('collection_name')
+    p.add_argument('--format', choices=FORMATS, default='ndjson')
+    p.add_argument('--output', default=None, help='file, default stdout')
+    p.add_argument('--query', default=None, help='condition, extended JSON')
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.set_defaults(command='export')
+
+    p = commands.add_parser('import', help='write documents from input into collection_name')
+    p.add_argument('collection_name')
+    p.add_argument('--format', choices=FORMATS, default='ndjson')
+    p.add_argument('--input', default=None, help='file, default stdin')
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.add_argument('--workers', type=int, default=1, help='parallel bulk writers')
+    p.set_defaults(command='import')
+
+    args = parser.parse_args(argv)
+    # diagnostics printed by models (registration, lazy loading) go to stderr, stdout is kept for exported rows
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        if args.config is not None:
+            update_config(args.config)
+        map(importlib.import_module, args.module)
+        doc_class = doc.Docs.factory_doc(args.collection_name)
+        progress = Progress('%s %s' % (args.command, args.collection_name), stream=sys.stderr)
+        if args.command == 'export':
+            cond = json_util.loads(args.query, json_options=_json_options) if args.query else None
+            with _opened(args.output, 'wb', stdout) as stream:
+                export_documents(doc_class, stream, args.format, cond, args.batch_size, progress)
+        else:
+            with _opened(args.input, 'rb', sys.stdin) as stream:
+                import_documents(doc_class, stream, args.format, args.batch_size, args.workers, progress)
+    finally:
+        sys.stdout = stdout
+
+
+@contextlib.contextmanager
+def _opened(path, mode, default):
+    """
+    File of path (closed on exit), or default stream (left open) when path is not given.
+    """
+    if not path:
+        yield default
+        return
+    with open(path, mode) as f:
+        yield f
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+from collections import OrderedDict
+import documents as doc
+import helpers as helper
+import json
+import os
+import storage
+import threading
+import time
+
+
+class DocCache(object):
+    """
+    Thread safe LRU cache of Doc instances keyed by (collection full name, object_id).
+    Keep it consistent across processes with ChangeWatcher.
+    """
+
+    def __init__(self, max_size=10000):
+        super(DocCache, self).__init__()
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, doc_class, object_id):
+        """
+        :return: cached Doc, loaded from database on miss, None if document does not exist.
+        """
+        object_id = helper.object_id(object_id)
+        key = (doc_class.manager.o.full_name, object_id)
+        with self.lock:
+            o = self.entries.pop(key, None)
+            if o is not None:
+                self.entries[key] = o
+                self.hits += 1
+                return o
+            self.misses += 1
+        raw = doc_class.manager.load_raw(object_id)
+        if raw is None:
+            return None
+        return self.put(doc_class.manager._inflater()(raw))
+
+    def put(self, o):
+        with self.lock:
+            self.entries.pop((o.manager.o.full_name, o.object_id), None)
+            self.entries[(o.manager.o.full_name, o.object_id)] = o
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return o
+
+    def invalidate(self, full_name, object_id):
+        with self.lock:
+            self.entries.pop((full_name, object_id), None)
+
+    def refresh(self, manager, raw):
+        """
+        Replace cached entry with given raw document, only if the entry is cached.
+        """
+        with self.lock:
+            if (manager.o.full_name, raw['_id']) not in self.entries:
+                return
+        self.put(manager._inflater()(raw))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class MemoryTokenStore(object):
+    """
+    Resume tokens kept within process
+    """
+
+    def __init__(self):
+        super(MemoryTokenStore, self).__init__()
+        self.tokens = {}
+
+    def load(self, name):
+        return self.tokens.get(name)
+
+    def save(self, name, token):
+        self.tokens[name] = token
+
+
+class FileTokenStore(MemoryTokenStore):
+    """
+    Resume tokens persisted to json file, so watcher resumes where it stopped after restart.
+    File is written every `save_every` changes.
+    """
+
+    def __init__(self, path, save_every=1):
+        super(FileTokenStore, self).__init__()
+        self.path = path
+        self.save_every = save_every
+        self.unsaved = 0
+        self.lock = threading.RLock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.tokens = dict((k, helper.decode_token(v)) for k, v in json.load(f).iteritems())
+
+    def save(self, name, token):
+        with self.lock:
+            super(FileTokenStore, self).save(name, token)
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            tmp = '%s.tmp' % self.path
+            with open(tmp, 'w') as f:
+                json.dump(dict((k, helper.encode_token(v)) for k, v in self.tokens.iteritems()), f)
+            os.rename(tmp, self.path)
+            self.unsaved = 0
+
+
+class ChangeWatcher(object):
+    """
+    Subscribe to change streams of registered models, invalidate (or refresh) DocCache entries by `_id`, invalidate
+    model's Meta.result_cache and count cache, and call model's callbacks.
+
+    Usage:
+        cache = DocCache()
+        watcher = ChangeWatcher(cache, token_store=FileTokenStore('/var/run/app/tokens.json'))
+        watcher.register(SimpleDocument, lambda operation, object_id, raw: ...)
+        watcher.start()         # background threads, or call watcher.poll() periodically.
+    """
+
+    def __init__(self, cache=None, token_store=None, refresh=False, retry_delay=1.0):
+        super(ChangeWatcher, self).__init__()
+        self.cache = cache
+        self.token_store = token_store or MemoryTokenStore()
+        self.refresh = refresh                  # refresh cached entries with full document instead of invalidate
+        self.callbacks = {}                     # collection full name => list of (doc_class, callback)
+        self.managers = {}                      # collection full name => manager of collection's root class
+        self.lookup = set()                     # collection full names which need full document of updates
+        self.streams = {}
+        self.threads = []
+        self.retry_delay = retry_delay          # seconds before a failed stream is reopened, see start()
+        self.stopping = threading.Event()
+        self.errors = 0                         # failed callbacks, cache refreshes and streams
+
+    def register(self, doc_class, callback=None):
+        """
+        :param doc_class: Doc class to be watched, subclasses sharing collection are notified of their own subtype
+            (their collection's stream then looks up full document of updates).
+        :param callback: callable(operation_type, object_id, raw_document or None)
+        """
+        name = doc_class.manager.o.full_name
+        if self.refresh or (callback is not None and doc_class.manager.sub_collection_name is not None):
+            self.lookup.add(name)
+        root = doc.Docs.installed.get(doc_class.manager.db_name, doc_class)
+        self.managers.setdefault(name, root.manager)
+        self.callbacks.setdefault(name, []).append((doc_class, callback))
+
+    def stream(self, name):
+        if name not in self.streams:
+            self.streams[name] = self.managers[name].o.watch(
+                full_document='updateLookup' if name in self.lookup else None,
+                resume_after=self.token_store.load(name))
+        return self.streams[name]
+
+    def dispatch(self, name, change):
+        operation = change['operationType']
+        object_id = change.get('documentKey', {}).get('_id')
+        raw = change.get('fullDocument')
+        self.managers[name].invalidate()        # Meta.result_cache, count cache of writes by other processes
+        if self.cache is not None and object_id is not None:
+            try:
+                if self.refresh and raw is not None and operation != 'delete':
+                    self.cache.refresh(self.managers[name], raw)
+                else:
+                    self.cache.invalidate(name, object_id)
+            except Exception as e:
+                # stale entry is dropped, it is loaded again on next get
+                self.cache.invalidate(name, object_id)
+                self.report(name, 'failed to refresh %s' % object_id, e)
+        for doc_class, callback in self.callbacks.get(name, []):
+            scope = doc_class.manager.scope()
+            if callback is None or (raw is not None and not storage.match(raw, scope)):
+                continue
+            try:
+                callback(operation, object_id, raw)
+            except Exception as e:
+                self.report(name, 'callback failed on %s %s' % (operation, object_id), e)
+        self.token_store.save(name, change['_id'])
+
+    def report(self, name, message, error):
+        self.errors += 1
+        print 'Watcher "%s" %s: %s' % (name, message, error)
+
+    def close_stream(self, name):
+        """
+        Drop stream of collection, next stream() reopens it from the last saved resume token.
+        """
+        stream = self.streams.pop(name, None)
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def poll(self):
+        """
+        Process pending changes of every registered collection, without blocking.
+
+        :return: number of changes processed
+        """
+        n = 0
+        for name in self.managers.keys():
+            stream = self.stream(name)
+            try:
+                change = stream.try_next()
+                while change is not None:
+                    self.dispatch(name, change)
+                    n += 1
+                    change = stream.try_next()
+            except Exception:
+                self.close_stream(name)     # reopened from the last saved resume token by next poll
+                raise
+        return n
+
+    def start(self):
+        """
+        Process changes in background, one daemon thread per collection. A failed stream (e.g. network error) is
+        reported and reopened from the last saved resume token after `retry_delay` seconds, until stop().
+        """
+        def follow(name):
+            while not self.stopping.is_set():
+                try:
+                    stream = self.stream(name)
+                    if self.stopping.is_set():
+                        self.close_stream(name)     # stopped while reopening
+                        return
+                    for change in stream:
+                        self.dispatch(name, change)
+                except Exception as e:
+                    if self.stopping.is_set():
+                        return
+                    self.report(name, 'stream failed', e)
+                self.close_stream(name)
+                self.stopping.wait(self.retry_delay)
+
+        self.stopping.clear()
+        map(self.stream, self.managers.keys())
+        for name in self.managers.keys():
+            t = threading.Thread(target=follow, args=(name,), name='watcher:%s' % name)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout=5.0):
+        """
+        Close streams, and wait up to `timeout` seconds for each background thread to end.
+        """
+        self.stopping.set()
+        map(self.close_stream, self.streams.keys())
+        map(lambda t: t.join(timeout), self.threads)
+        self.threads = []
@@ -0,0 +1,130 @@
+from errors import BackpressureError, DeveloperFault
+import Queue
+import atexit
+import os
+import threading
+import time
+
+
+class WriteBehindWriter(object):
+    """
+    Buffered writer for append-only models (Meta.write_behind), new documents are queued and inserted by
+    a background thread with insert_many.
+
+    Options:
+        max_batch - maximum number of documents per insert_many (default 500)
+        max_delay_ms - maximum time a document waits in queue before flushed (default 100)
+        max_queue - queue size, save() blocks when queue is full (default 10000)
+        block_timeout - seconds save() may block on full queue before BackpressureError is raised (default None, forever)
+        on_error - callable(exception, documents) called when a batch failed to be written
+    """
+
+    def __init__(self, manager, max_batch=500, max_delay_ms=100, max_queue=10000, block_timeout=None, on_error=None):
+        super(WriteBehindWriter, self).__init__()
+        if max_batch <= 0 or max_delay_ms < 0:
+            raise DeveloperFault('write_behind requires max_batch > 0, and max_delay_ms >= 0')
+        self.manager = manager
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self.block_timeout = block_timeout
+        self.on_error = on_error
+        self.max_queue = max_queue
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.flush_on_exit = False
+        self.written = 0
+        self.failed = 0
+
+    def _after_fork(self):
+        """
+        Thread does not survive fork, documents queued before fork are the parent's to write, they are dropped here
+        (queue and lock may also have been held by the parent's thread).
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(maxsize=self.max_queue)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self._after_fork()
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='write-behind:%s' % self.manager.collection_name)
+                self.thread.daemon = True
+                self.thread.start()
+                if not self.flush_on_exit:
+                    atexit.register(self.flush)
+                    self.flush_on_exit = True
+
+    def put(self, document):
+        self.start()
+        try:
+            self.queue.put(document, True, self.block_timeout)
+        except Queue.Full:
+            raise BackpressureError('Write behind queue of "%s" is full' % self.manager.collection_name)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                try:
+                    batch.append(self.queue.get(remaining > 0, max(remaining, 0)))
+                except Queue.Empty:
+                    break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        try:
+            self.write(batch)
+        except Exception as e:
+            # e.g. a failing listener, the thread must keep on writing
+            print 'Write behind "%s" failed after writing %s documents: %s' % (self.manager.collection_name,
+                                                                               len(batch), e)
+        finally:
+            map(lambda d: self.queue.task_done(), batch)
+
+    def write(self, batch):
+        started = time.time()
+        try:
+            map(lambda (collection, documents): collection.insert_many(documents, ordered=False),
+                self.manager.routes_of(batch))
+            self.written += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            if self.on_error is not None:
+                try:
+                    self.on_error(e, batch)
+                except Exception as callback_error:
+                    print 'Write behind "%s" on_error failed: %s' % (self.manager.collection_name, callback_error)
+            else:
+                print 'Write behind "%s" failed to write %s documents: %s' % (self.manager.collection_name, len(batch), e)
+        self.manager.invalidate()
+        self.manager.emit('write', {}, time.time() - started, returned=len(batch))
+
+    def flush(self):
+        """
+        Block until every queued document is written, queued documents are written by the caller when the thread
+        is not running (e.g. at exit).
+        """
+        self._after_fork()
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+            return
+        while True:
+            batch = []
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write_batch(batch)
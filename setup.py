@@ -27,6 +27,9 @@ setup(
         'Topic :: Software Development :: Libraries',
     ],
     keywords=['pymongo', 'database', 'mongodb', 'modeling'],
-    packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests*', 'benchmarks*']),
     install_requires=['six', 'pymongo', 'configparser'],
+    entry_points={
+        'console_scripts': ['pymongo-document = pymongo_document.transfer:main'],
+    },
 )
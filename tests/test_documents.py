@@ -1,6 +1,22 @@
-from pymongo_document import documents as doc, errors as err, conf
+from pymongo_document import documents as doc, errors as err, conf, storage
+from pymongo_document.aggregation import Pipeline
+from pymongo_document.instruments import LatencyAggregator, ExplainSampler
+from pymongo_document.watcher import DocCache, ChangeWatcher, FileTokenStore
+from pymongo_document.routing import TenantRouter, ScatterCursor
+from pymongo_document.query import param
+from pymongo_document.resultcache import ResultCache
+from pymongo_document.writebehind import WriteBehindWriter
+from pymongo_document import transfer
 import pymongo
 import unittest
+import copy
+import json
+import os
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
 
 
@@ -536,5 +552,1349 @@ class TestDocumentBasic(unittest.TestCase):
         self.assertRaises(err.DeveloperFault, lambda: conf.update_config('tests/unknown_config_file.ini'))
         self.assertRaises(err.DeveloperFault, lambda: conf.update_config('tests/conf/'))
 
+        self.assertEqual(conf.client_options(conf.Configuration.CONF['test_data_pool']),
+                         {'compressors': 'zstd,snappy,zlib', 'zlibCompressionLevel': 6})
+        bad = tempfile.NamedTemporaryFile(suffix='.ini', delete=False)
+        bad.write('[default]\nconnection_string = mongodb://localhost:27017/\ncompressors = zstd,lz4\n')
+        bad.close()
+        try:
+            self.assertRaisesRegexp(err.DeveloperFault, 'lz4', lambda: conf.update_config(bad.name))
+        finally:
+            os.remove(bad.name)
+
+    def test_server_side_populate(self):
+        s = SimpleDocument()
+        s.int_val = 5
+        s.save()
+
+        c = ABitComplexDocument()
+        c.int_val_2 = 1250
+        c.save()
+
+        l = HolderOfSimpleDocuments()
+        l.list_of_docs = [c.object_id, s.object_id]
+        l.save()
+
+        found = list(HolderOfSimpleDocuments.manager.find({'_id': l.object_id}).populate('list_of_docs'))
+        self.assertEqual(len(found), 1)
+        self.assertEqual(len(found[0].list_of_docs), 2)
+        self.assertTrue(isinstance(found[0].list_of_docs[0], ABitComplexDocument))
+        self.assertEqual(found[0].list_of_docs[0].int_val_2, 1250)
+        self.assertEqual(found[0].list_of_docs[1], s)
+        self.assertEqual(found[0].list_of_docs[1].int_val, 5)
+
+        self.assertRaises(err.DeveloperFault, lambda: SimpleDocument.manager.find().populate('int_val'))
+
+    def test_count(self):
+        class CountedDocument(doc.Doc):
+            int_val = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_counted_document'
+                count_cache_ttl = 60
+
+        CountedDocument.manager.delete()
+        for i in range(3):
+            o = CountedDocument()
+            o.int_val = i
+            o.save()
+
+        self.assertEqual(CountedDocument.manager.count(), 3)
+        self.assertEqual(CountedDocument.manager.count({'int_val': {'$gte': 1}}), 2)
+        self.assertEqual(CountedDocument.manager.count(limit=1), 1)
+        self.assertEqual(CountedDocument.manager.estimated_count(), 3)
+
+        # Count is cached, raw write is not noticed
+        CountedDocument.manager.o.insert_one({'int_val': 9})
+        self.assertEqual(CountedDocument.manager.count(), 3)
+
+        # Write through manager invalidate the cache
+        CountedDocument.manager.update({'int_val': 9}, {'$set': {'int_val': 10}})
+        self.assertEqual(CountedDocument.manager.count(), 4)
+
+        # Cache is shared by models of the collection, write through any of them invalidates it
+        class CountedSubDocument(CountedDocument):
+            class Meta:
+                collection_name = ':sub'
+
+        CountedSubDocument().save()
+        self.assertEqual(CountedDocument.manager.count(), 5)
+        CountedSubDocument.manager.delete()
+        self.assertEqual(CountedDocument.manager.count(), 4)
+
+        # Keyed by read preference, least recently used conditions are evicted
+        CountedDocument.manager.o.insert_one({'int_val': 11})
+        self.assertEqual(CountedDocument.manager.count(read_preference='secondaryPreferred'), 5)
+        self.assertEqual(CountedDocument.manager.count(), 4)
+        size, CountedDocument.manager.count_cache_size = CountedDocument.manager.count_cache_size, 2
+        try:
+            map(lambda i: CountedDocument.manager.count({'int_val': i}), range(5))
+        finally:
+            CountedDocument.manager.count_cache_size = size
+        self.assertEqual(len(doc.Docs.count_caches['test_counted_document']), 2)
+        CountedDocument.manager.update({'int_val': 11}, {'$set': {'int_val': 12}})
+
+        # Exhausted cursor knows its length
+        cursor = CountedDocument.manager.find({'int_val': {'$lt': 10}})
+        self.assertEqual(len([o for o in cursor]), 3)
+        CountedDocument.manager.o.delete_many({})
+        self.assertEqual(len(cursor), 3)
+
+    def test_paginate(self):
+        class PagedDocument(doc.Doc):
+            int_val = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_paged_document'
+                indices = [([('int_val', pymongo.ASCENDING)], {})]
+
+        PagedDocument.manager.delete()
+        for i in [3, 1, 2, 2, 5]:
+            o = PagedDocument()
+            o.int_val = i
+            o.save()
+
+        seen = []
+        page, token = PagedDocument.manager.paginate(sort=[('int_val', pymongo.DESCENDING)], limit=2)
+        while page:
+            seen.extend(map(lambda o: o.int_val, page))
+            if token is None:
+                break
+            page, token = PagedDocument.manager.paginate(sort=[('int_val', pymongo.DESCENDING)], after=token, limit=2)
+        self.assertEqual(seen, [5, 3, 2, 2, 1])
+
+        page, token = PagedDocument.manager.paginate({'int_val': {'$gt': 1}}, sort=[('int_val', 1)], limit=10)
+        self.assertEqual(map(lambda o: o.int_val, page), [2, 2, 3, 5])
+        self.assertEqual(token, None)
+
+        # str_val is not indexed
+        self.assertRaises(err.DeveloperFault, lambda: SimpleDocument.manager.paginate(sort=[('str_val', 1)]))
+        self.assertRaises(err.DeveloperFault, lambda: PagedDocument.manager.paginate(after='not a token'))
+
+        # null sort values are paged, first ascending, last descending
+        for i in range(3):
+            PagedDocument().save()
+        for direction, expected in [(1, [None] * 3 + [1, 2, 2, 3, 5]), (-1, [5, 3, 2, 2, 1] + [None] * 3)]:
+            seen = []
+            page, token = PagedDocument.manager.paginate(sort=[('int_val', direction)], limit=2)
+            while page:
+                seen.extend(map(lambda o: o.int_val, page))
+                if token is None:
+                    break
+                page, token = PagedDocument.manager.paginate(sort=[('int_val', direction)], after=token, limit=2)
+            self.assertEqual(seen, expected)
+
+    def test_write_behind(self):
+        failures = []
+
+        class AuditDocument(doc.Doc):
+            action = doc.FieldString()
+
+            class Meta:
+                collection_name = 'test_audit_document'
+                write_behind = {'max_batch': 10, 'max_delay_ms': 5, 'on_error': lambda e, docs: failures.append(docs)}
+
+        AuditDocument.manager.delete()
+        ids = []
+        for i in range(25):
+            o = AuditDocument()
+            o.action = 'action %s' % i
+            ids.append(o.save())
+        self.assertEqual(ids[-1], o.object_id)
+
+        AuditDocument.manager.flush()
+        self.assertEqual(AuditDocument.manager.count(), 25)
+        self.assertEqual(AuditDocument(ids[3]).action, 'action 3')
+
+        # Existing document is written synchronously
+        o.action = 'changed'
+        o.save()
+        self.assertEqual(AuditDocument(o.object_id).action, 'changed')
+
+        # Duplicated _id is reported to on_error
+        AuditDocument.manager.write_behind({'_id': o.object_id, 'action': 'duplicated'})
+        AuditDocument.manager.flush()
+        self.assertEqual(len(failures), 1)
+
+        # Failing on_error does not stop the writer
+        writer = AuditDocument.manager.writer
+        writer.on_error = lambda e, docs: 1 / 0
+        AuditDocument.manager.write_behind({'_id': o.object_id, 'action': 'duplicated'})
+        AuditDocument.manager.write_behind({'action': 'after failure', '_id': doc.FieldObjectId.new_id()})
+        AuditDocument.manager.flush()
+        self.assertTrue(writer.thread.is_alive())
+        self.assertEqual(AuditDocument.manager.count(), 26)
+
+        # Queued documents are written by flush when the thread is not running, forked child drops parent's queue
+        stopped = WriteBehindWriter(AuditDocument.manager)
+        stopped.queue.put({'action': 'queued', '_id': doc.FieldObjectId.new_id()})
+        stopped.flush()
+        self.assertEqual(AuditDocument.manager.count(), 27)
+        stopped.queue.put({'action': 'parent', '_id': doc.FieldObjectId.new_id()})
+        stopped.pid = -1
+        stopped.flush()
+        self.assertEqual((stopped.queue.qsize(), AuditDocument.manager.count()), (0, 27))
+
+    def test_subtype_scope(self):
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            class ScopedDocument(doc.Doc):
+                int_val = doc.FieldNumeric()
+
+                class Meta:
+                    collection_name = 'test_scoped_document'
+
+            class ScopedSubDocument(ScopedDocument):
+                class Meta:
+                    collection_name = ':sub'
+
+            class ScopedSubSubDocument(ScopedSubDocument):
+                class Meta:
+                    collection_name = ':sub_sub'
+            registered = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(registered.count("[('_subtype', 1)]"), 1)     # once per collection
+
+        ScopedDocument.manager.delete()
+        for i, clz in enumerate([ScopedDocument, ScopedSubDocument, ScopedSubSubDocument]):
+            o = clz()
+            o.int_val = i
+            o.save()
+
+        self.assertTrue('_subtype_1' in ScopedDocument.manager.o.index_information())
+        self.assertEqual(ScopedDocument.manager.count(), 3)
+        self.assertEqual(ScopedSubDocument.manager.count(), 2)
+        self.assertEqual(ScopedSubSubDocument.manager.estimated_count(), 1)
+        self.assertEqual(map(type, ScopedSubDocument.manager.find().sort('int_val')),
+                         [ScopedSubDocument, ScopedSubSubDocument])
+        self.assertEqual(map(lambda o: o.int_val, ScopedSubSubDocument.manager.find({'int_val': {'$gte': 0}})), [2])
+        self.assertEqual(len(list(ScopedSubDocument.manager.aggregate([{'$match': {'int_val': {'$lt': 2}}}]))), 1)
+
+        ScopedSubDocument.manager.update({}, {'$inc': {'int_val': 10}})
+        self.assertEqual(sorted(map(lambda o: o.int_val, ScopedDocument.manager.find())), [0, 11, 12])
+        ScopedSubDocument.manager.delete()
+        self.assertEqual(map(type, ScopedDocument.manager.find()), [ScopedDocument])
+
+    def test_concurrent_registry(self):
+        errors = []
+        events = []
+        shared = doc.FieldDoc('simple_document')    # lazily resolved by every thread at once
+        start = threading.Event()
+
+        def worker(n):
+            start.wait()
+            try:
+                for i in range(10):
+                    name = 'test_concurrent_%s_%s' % (n, i)
+                    reference = doc.FieldDoc(name)
+                    clz = type(doc.Doc)('Concurrent%s_%s' % (n, i), (doc.Doc,), {
+                        'int_val': doc.FieldNumeric(none=False),
+                        'Meta': type('Meta', (object,), {'collection_name': name}),
+                    })
+                    sub = type(doc.Doc)('ConcurrentSub%s_%s' % (n, i), (clz,), {
+                        'str_val': doc.FieldString(),
+                        'Meta': type('Meta', (object,), {'collection_name': ':sub'}),
+                    })
+                    listener = lambda event: events.append(event)
+                    doc.Docs.add_listener(listener)
+                    self.assertTrue(shared.doc_clz() is SimpleDocument)
+                    self.assertTrue(reference.doc_clz() is clz)
+                    self.assertTrue(doc.Docs.factory_doc(name + ':sub') is sub)
+                    self.assertEqual(sub.manager.scope(), {'_subtype': 'sub'})
+                    o = sub()
+                    o.int_val = i
+                    o.str_val = str(n)
+                    self.assertEqual(o.document()['int_val'], i)
+                    self.assertEqual(o.document()['str_val'], str(n))
+                    doc.Docs.remove_listener(listener)
+            except Exception as e:
+                errors.append(e)
+
+        threads = map(lambda n: threading.Thread(target=worker, args=(n,)), range(8))
+        map(lambda t: t.start(), threads)
+        start.set()
+        map(lambda t: t.join(), threads)
+        self.assertEqual(errors, [])
+        self.assertEqual(doc.Docs.listeners, [])
+        for n in range(8):
+            for i in range(10):
+                name = 'test_concurrent_%s_%s' % (n, i)
+                self.assertEqual(doc.Docs.factory_doc(name).__name__, 'Concurrent%s_%s' % (n, i))
+                self.assertEqual(sorted(doc.Docs.subtypes[name].keys()), [None, 'sub'])
+
+    def test_insert_path(self):
+        class InsertDocument(doc.Doc):
+            int_val = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_insert_document'
+
+        InsertDocument.manager.delete()
+        a = InsertDocument()
+        self.assertTrue(a.is_new())
+        a.save()
+        self.assertFalse(a.is_new())
+        a.int_val = 1
+        a.save()
+        self.assertEqual(InsertDocument.manager.count(), 1)
+        self.assertFalse(InsertDocument(a.object_id).is_new())
+
+        # Pre-allocated ObjectId collides (e.g. forked workers), new ObjectId is allocated
+        b = InsertDocument()
+        b._injected_object_id = b.object_id = a.object_id
+        b.save()
+        self.assertNotEqual(b.object_id, a.object_id)
+        self.assertEqual(InsertDocument.manager.count(), 2)
+
+        # Explicitly assigned, or deserialized ObjectId is not re-allocated, its document is upserted
+        c = InsertDocument()
+        c.object_id = a.object_id
+        c.int_val = 2
+        c.save()
+        self.assertEqual((InsertDocument(a.object_id).int_val, InsertDocument.manager.count()), (2, 2))
+        e = InsertDocument()
+        e.deserialized({'_id': a.object_id, 'int_val': 3})
+        e.save()
+        self.assertEqual((InsertDocument(a.object_id).int_val, InsertDocument.manager.count()), (3, 2))
+        e = InsertDocument()
+        e.object_id = doc.FieldObjectId.new_id()
+        e.save()
+        self.assertEqual(InsertDocument.manager.count(), 3)
+        InsertDocument.manager.delete({'_id': e.object_id})
+
+        # Existing document is replaced, never upserted
+        InsertDocument.manager.delete({'_id': a.object_id})
+        self.assertRaises(err.DocumentValidationError, a.save)
+        self.assertEqual(InsertDocument.manager.count(), 1)
+
+        many = [InsertDocument() for i in range(3)]
+        many[1]._injected_object_id = many[1].object_id = b.object_id
+        ids = InsertDocument.manager.write_many(many)
+        self.assertEqual(ids, map(lambda o: o.object_id, many))
+        self.assertEqual(len(set(ids + [b.object_id])), 4)
+        self.assertEqual(InsertDocument.manager.count(), 4)
+        self.assertRaises(err.DeveloperFault, lambda: InsertDocument.manager.write_many(many))
+
+    def test_read_preference(self):
+        parse = conf.parse_read_preference
+        self.assertEqual(parse('secondaryPreferred', 'dc:east,use:reporting;dc:west', 90).document,
+                         {'mode': 'secondaryPreferred', 'tags': [{'dc': 'east', 'use': 'reporting'}, {'dc': 'west'}],
+                          'maxStalenessSeconds': 90})
+        self.assertEqual(parse({'mode': 'nearest'}).document, {'mode': 'nearest'})
+        self.assertRaises(err.DeveloperFault, lambda: parse('unknown'))
+        self.assertRaises(err.DeveloperFault, lambda: parse('primary', [{'dc': 'east'}]))
+        options = conf.connection_options({'read_concern': 'majority', 'write_concern': 'majority',
+                                           'write_concern_timeout_ms': '500', 'journal': 'true'})
+        self.assertEqual(options['read_concern'].level, 'majority')
+        self.assertEqual(options['write_concern'].document, {'w': 'majority', 'wtimeout': 500, 'j': True})
+
+        class ReportDocument(doc.Doc):
+            int_val = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_report_document'
+                read_preference = 'secondaryPreferred'
+
+        self.assertEqual(ReportDocument.manager.o.read_preference.mongos_mode, 'secondaryPreferred')
+        self.assertEqual(ReportDocument.manager.collection('primary').read_preference.mongos_mode, 'primary')
+        ReportDocument.manager.delete()
+        o = ReportDocument()
+        o.int_val = 1
+        o.save()
+        self.assertEqual(map(lambda d: d.int_val, ReportDocument.manager.find({}, read_preference='primary')), [1])
+        self.assertEqual(ReportDocument.manager.count(read_preference='primary'), 1)
+        self.assertEqual(len(list(ReportDocument.manager.aggregate([], read_preference='primaryPreferred'))), 1)
+
+    def test_update_fields(self):
+        class UpdateContentDocument(doc.FieldSpecAware):
+            int_val = doc.FieldNumeric(key='i')
+
+        class UpdateFieldsDocument(doc.Doc):
+            int_val = doc.FieldNumeric(key='n', none=False, default=0)
+            str_val = doc.FieldString(max_length=5)
+            content = doc.FieldNested(UpdateContentDocument)
+
+            class Meta:
+                collection_name = 'test_update_fields'
+
+        UpdateFieldsDocument.manager.delete()
+        a, b = UpdateFieldsDocument(), UpdateFieldsDocument()
+        a.content = UpdateContentDocument()
+        map(lambda o: o.save(), [a, b])
+
+        self.assertEqual(UpdateFieldsDocument.manager.update_fields({}, set={'str_val': 'abc', 'content.int_val': 3},
+                                                                    inc={'int_val': 2}), 2)
+        raw = UpdateFieldsDocument.manager.o.find_one({'_id': a.object_id})
+        self.assertEqual((raw['n'], raw['str_val'], raw['content']), (2, 'abc', {'i': 3}))
+
+        self.assertEqual(UpdateFieldsDocument.manager.update_fields(updates=[
+            ({'_id': a.object_id}, {'set': {'str_val': 'a'}}),
+            ({'_id': b.object_id}, {'inc': {'int_val': 5}, 'unset': ['str_val']}),
+        ]), 2)
+        self.assertEqual(UpdateFieldsDocument(a.object_id).str_val, 'a')
+        self.assertEqual(UpdateFieldsDocument(b.object_id).int_val, 7)
+        self.assertEqual(UpdateFieldsDocument(b.object_id).str_val, None)
+
+        update = UpdateFieldsDocument.manager.update_fields
+        self.assertRaises(err.FieldValidationError, lambda: update({}, set={'str_val': 'too long'}))
+        self.assertRaises(err.FieldValidationError, lambda: update({}, set={'int_val': 'x'}))
+        self.assertRaises(err.FieldValidationError, lambda: update({}, inc={'str_val': 1}))
+        self.assertRaises(err.FieldValidationError, lambda: update({}, unset=['int_val']))
+        self.assertRaises(err.DeveloperFault, lambda: update({}, set={'unknown': 1}))
+        self.assertRaises(err.DeveloperFault, lambda: update({}))
+        self.assertEqual(UpdateFieldsDocument(a.object_id).str_val, 'a')
+
+    def test_query(self):
+        class QueryContentDocument(doc.FieldSpecAware):
+            int_val = doc.FieldNumeric(key='i')
+
+        class QueryDocument(doc.Doc):
+            int_val = doc.FieldNumeric(key='n')
+            str_val = doc.FieldString()
+            content = doc.FieldNested(QueryContentDocument)
+            list_of_docs = doc.FieldList(doc.FieldDoc(SimpleDocument))
+
+            class Meta:
+                collection_name = 'test_query'
+
+        QueryDocument.manager.delete()
+        simple = SimpleDocument()
+        simple.save()
+        for i in range(5):
+            o = QueryDocument()
+            o.int_val = i
+            o.str_val = 'value %s' % i
+            o.content = QueryContentDocument()
+            o.content.int_val = i * 10
+            o.list_of_docs = [simple] if i % 2 == 0 else []
+            o.save()
+
+        q = QueryDocument.q
+        self.assertEqual((q.int_val > 2).to_condition(), {'n': {'$gt': 2}})
+        self.assertEqual(((q.int_val > 2) & q.list_of_docs.contains(simple)).to_condition(),
+                         {'n': {'$gt': 2}, 'list_of_docs': simple.object_id})
+        self.assertEqual(((q.int_val > 1) & (q.int_val < 3)).to_condition(),
+                         {'$and': [{'n': {'$gt': 1}}, {'n': {'$lt': 3}}]})
+        self.assertEqual(((q.object_id == str(simple.object_id)) | ~q.content.int_val.in_([1, 2])).to_condition(),
+                         {'$or': [{'_id': simple.object_id}, {'$nor': [{'content.i': {'$in': [1, 2]}}]}]})
+
+        find = lambda query: sorted(map(lambda o: o.int_val, QueryDocument.manager.find(query)))
+        self.assertEqual(find((q.int_val >= 2) & q.list_of_docs.contains(simple)), [2, 4])
+        self.assertEqual(find(q.content.int_val.in_([10, 30]) | (q.str_val == 'value 0')), [0, 1, 3])
+        self.assertEqual(find(~(q.int_val < 4)), [4])
+        self.assertEqual(QueryDocument.manager.count(q.list_of_docs.contains(simple)), 3)
+
+        # compiled shapes are shared, and re-bound with new parameters
+        by_range = ((q.int_val >= param('low')) & (q.str_val != param('str_val'))).compile()
+        self.assertTrue(((q.int_val >= 0) & (q.str_val != 'x')).compile().shape is
+                        ((q.int_val >= 5) & (q.str_val != 'y')).compile().shape)
+        self.assertEqual(by_range.params(), ['low', 'str_val'])
+        self.assertEqual(find(by_range.bind(low=3, str_val='value 4')), [3])
+        self.assertEqual(find(by_range.bind(low=0, str_val='value 0')), [1, 2, 3, 4])
+        QueryDocument.manager.update(q.int_val == 4, {'$set': {'str_val': 'updated'}})
+        self.assertEqual(QueryDocument.manager.count(q.str_val == 'updated'), 1)
+        QueryDocument.manager.delete(q.int_val > 2)
+        self.assertEqual(find({}), [0, 1, 2])
+
+        self.assertRaises(err.FieldValidationError, lambda: (q.int_val > 'x').to_condition())
+        self.assertRaises(err.FieldValidationError, lambda: q.list_of_docs.contains(QueryDocument()).to_condition())
+        self.assertRaises(err.FieldValidationError, lambda: by_range.bind(low='x', str_val='y'))
+        self.assertRaises(err.DeveloperFault, lambda: by_range.bind(low=1))
+        self.assertRaises(err.DeveloperFault, lambda: q.unknown == 1)
+        self.assertRaises(err.DeveloperFault, lambda: q.int_val.contains(1))
+
+    def test_changes(self):
+        class ChangesContentDocument(doc.FieldSpecAware):
+            int_val = doc.FieldNumeric(key='i')
+            str_val = doc.FieldString()
+
+        class ChangesDocument(doc.Doc):
+            int_val = doc.FieldNumeric(key='n')
+            str_val = doc.FieldString()
+            content = doc.FieldNested(ChangesContentDocument)
+            list_of_docs = doc.FieldList(doc.FieldDoc(SimpleDocument))
+            tuple_val = doc.FieldTuple(doc.FieldNumeric(), doc.FieldString())
+            dict_val = doc.FieldDict()
+
+            class Meta:
+                collection_name = 'test_changes'
+
+        ChangesDocument.manager.delete()
+        a, b, c = SimpleDocument(), SimpleDocument(), SimpleDocument()
+        map(lambda s: s.save(), [a, b, c])
+        o = ChangesDocument()
+        o.int_val = 1
+        o.content = ChangesContentDocument()
+        o.content.int_val = 2
+        o.list_of_docs = [a, b]
+        o.tuple_val = (3, 'x')
+        o.dict_val = {'k': {'v': 1}}
+        self.assertEqual(o.changes()['$set']['n'], 1)
+        o.save()
+        self.assertEqual(o.changes(), {})
+
+        o = ChangesDocument(o.object_id)
+        self.assertEqual(o.changes(), {})
+        o.int_val = 1
+        o.str_val = None
+        self.assertEqual(o.changes(), {})
+
+        o.content.int_val = 5
+        o.list_of_docs[1] = c
+        o.tuple_val = (3, 'y')
+        o.dict_val['k']['v'] = 2
+        o.dict_val['new'] = True
+        changes = o.changes()
+        self.assertEqual(changes, {'$set': {'content.i': 5, 'list_of_docs.1': c.object_id, 'tuple_val.1': 'y',
+                                            'dict_val.k.v': 2, 'dict_val.new': True}})
+        ChangesDocument.manager.update({'_id': o.object_id}, changes)
+        self.assertEqual(ChangesDocument.manager.o.find_one({'_id': o.object_id}), o.document())
+
+        o = ChangesDocument(o.object_id)
+        o.list_of_docs.append(a)
+        del o.dict_val['new']
+        o.content = None
+        self.assertEqual(o.changes(), {'$push': {'list_of_docs': {'$each': [a.object_id]}},
+                                       '$unset': {'dict_val.new': ''},
+                                       '$set': {'content.i': None}})
+        o.save()
+        self.assertEqual(o.changes(), {})
+        o.list_of_docs.pop(0)
+        self.assertEqual(o.changes(), {'$set': {'list_of_docs': [c.object_id, a.object_id]}})
+
+    def test_changes_nested_in_place(self):
+        class InPlaceContentDocument(doc.FieldSpecAware):
+            d = doc.FieldDict()
+
+        class InPlaceDocument(doc.Doc):
+            content = doc.FieldNested(InPlaceContentDocument)
+            contents = doc.FieldList(doc.FieldNested(InPlaceContentDocument))
+
+            class Meta:
+                collection_name = 'test_changes_in_place'
+
+        InPlaceDocument.manager.delete()
+        o = InPlaceDocument()
+        o.content = InPlaceContentDocument()
+        o.content.d = {'x': 1}
+        element = InPlaceContentDocument()
+        element.d = {'y': 1}
+        o.contents = [element]
+        o.save()
+
+        for r in [o, InPlaceDocument(o.object_id)]:
+            self.assertEqual(r.changes(), {})
+            r.content.d['x'] = 2
+            self.assertEqual(r.changes(), {'$set': {'content.d.x': 2}})
+            r.contents[0].d['y'] = 2
+            self.assertEqual(r.changes(), {'$set': {'content.d.x': 2, 'contents.0.d.y': 2}})
+            r.save()
+            self.assertEqual(r.changes(), {})
+            r.content.d['x'] = 1
+            r.contents[0].d['y'] = 1
+            r.save()
+        raw = InPlaceDocument.manager.o.find_one({'_id': o.object_id})
+        self.assertEqual((raw['content'], raw['contents']), ({'d': {'x': 1}}, [{'d': {'y': 1}}]))
+
+    def test_default_copy(self):
+        class DefaultsDocument(doc.Doc):
+            list_val = doc.FieldList(doc.FieldNumeric())
+            dict_val = doc.FieldDict(default={'k': 1})
+            nested_default = doc.FieldDict(default={'k': [1]})
+            str_val = doc.FieldString(default='x')
+
+            class Meta:
+                collection_name = 'test_defaults'
+
+        a, b = DefaultsDocument(), DefaultsDocument()
+        self.assertEqual((a.list_val, a.dict_val, a.str_val), ([], {'k': 1}, 'x'))
+        self.assertTrue(a.list_val is a.list_val and a.dict_val is a.dict_val)
+        self.assertEqual((type(a.list_val), type(a.dict_val)), (list, dict))
+
+        a.list_val.append(1)
+        a.list_val.append(2)
+        a.dict_val['k'] = 2
+        b.nested_default['k'].append(2)
+        self.assertEqual((a.list_val, a.dict_val), ([1, 2], {'k': 2}))
+        self.assertEqual((b.list_val, b.dict_val), ([], {'k': 1}))
+        self.assertEqual((a.nested_default, b.nested_default), ({'k': [1]}, {'k': [1, 2]}))
+        self.assertEqual(DefaultsDocument.dict_val.default, {'k': 1})
+
+        b.list_val = a.list_val
+        b.list_val += [3]
+        c = DefaultsDocument()
+        c.list_val = DefaultsDocument().list_val
+        c.list_val.append(4)
+        self.assertEqual((a.list_val, b.list_val, c.list_val), ([1, 2, 3], [1, 2, 3], [4]))
+        a.save()
+        self.assertEqual(DefaultsDocument(a.object_id).document(), a.document())
+
+        # defaults read before assignment do not overwrite assigned values
+        d = DefaultsDocument()
+        t = d.list_val
+        d.list_val = [1]
+        t.append(2)
+        self.assertEqual((d.list_val, t), ([1], [2]))
+        d = DefaultsDocument()
+        x, y = d.list_val, d.list_val
+        y.append(5)
+        self.assertEqual((x, d.list_val), ([5], [5]))
+
+    def test_compressed_field(self):
+        class CompressedDocument(doc.Doc):
+            body = doc.FieldCompressed(doc.FieldString(max_length=100000))
+            payload = doc.FieldCompressed(doc.FieldDict(), min_size=64)
+
+            class Meta:
+                collection_name = 'test_compressed'
+
+        CompressedDocument.manager.delete()
+        body = CompressedDocument.body
+        o = CompressedDocument()
+        o.body = u'lorem ipsum ' * 1000
+        o.payload = {'a': 1}
+        o.save()
+        raw = CompressedDocument.manager.o.find_one({'_id': o.object_id})
+        self.assertEqual(raw['body'].subtype, 0x80)
+        self.assertLess(len(raw['body']), 200)
+        self.assertEqual(raw['payload'], {'a': 1})      # smaller than min_size
+        o.document()
+        o.changes()
+        savings = body.savings()
+        self.assertEqual(savings['packed'], 1)      # counted on write only
+        self.assertGreater(savings['saved_bytes'], 11000)
+        self.assertEqual(CompressedDocument.payload.savings()['packed'], 0)
+
+        # decompressed on access only, untouched values are written back as stored
+        r = CompressedDocument(o.object_id)
+        self.assertEqual(r.changes(), {})
+        r.save()
+        self.assertEqual((body.savings()['packed'], body.savings()['unpacked']), (1, 0))
+        self.assertEqual(r.body, u'lorem ipsum ' * 1000)
+        self.assertEqual(body.savings()['unpacked'], 1)
+        self.assertEqual(r.changes(), {})
+        r.payload['b'] = 'x' * 100
+        self.assertEqual(r.changes().keys(), ['$set'])
+        r.save()
+        self.assertEqual(CompressedDocument(o.object_id).payload, {'a': 1, 'b': 'x' * 100})
+        self.assertEqual(CompressedDocument(o.object_id).serialized()['body'], u'lorem ipsum ' * 1000)
+
+        self.assertRaises(err.FieldValidationError, lambda: setattr(r, 'body', 'x' * 100001))
+        self.assertRaises(err.DeveloperFault, lambda: CompressedDocument.q.body == 'x')
+        self.assertRaises(err.DeveloperFault, lambda: doc.FieldCompressed(doc.FieldString(), codec='lz4'))
+
+    def test_file_field(self):
+        class FileDocument(doc.Doc):
+            name = doc.FieldString()
+            attachment = doc.FieldFile(bucket='test_attachments', chunk_size=1000)
+
+            class Meta:
+                collection_name = 'test_file_document'
+
+        bucket = FileDocument.manager.bucket('test_attachments')
+        FileDocument.manager.delete()
+        bucket.files.delete_many({})
+        bucket.chunks.delete_many({})
+        content = ''.join(map(lambda i: chr(i % 256), range(4500)))
+
+        source = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+        source.write(content)
+        source.close()
+        try:
+            a = FileDocument()
+            a.attachment = open(source.name, 'rb')
+            a.save()
+        finally:
+            os.remove(source.name)
+        self.assertEqual(bucket.chunks.count_documents({'files_id': a.attachment.file_id}), 5)
+        self.assertEqual(FileDocument.manager.o.find_one({'_id': a.object_id})['attachment'], a.attachment.file_id)
+
+        r = FileDocument(a.object_id)
+        self.assertEqual((r.attachment.length, r.attachment.filename), (4500, os.path.basename(source.name)))
+        self.assertEqual(r.attachment.read(), content)
+        self.assertEqual(map(len, r.attachment.open()), [1000, 1000, 1000, 1000, 500])
+        reader = r.attachment.open()
+        reader.seek(1990)
+        self.assertEqual(reader.read(20), content[1990:2010])
+        reader.seek(-10, os.SEEK_END)
+        self.assertEqual((reader.read(), reader.read()), (content[-10:], ''))
+
+        b = FileDocument()
+        with FileDocument.attachment.writer(b, 'b.txt') as w:
+            w.write('x' * 1500)
+            w.write(u'y')
+        b.save()
+        self.assertEqual(FileDocument(b.object_id).attachment.read(), 'x' * 1500 + 'y')
+
+        c = FileDocument()
+        c.attachment = 'small'
+        c.save()
+        try:
+            with FileDocument.attachment.writer(c) as w:
+                w.write('z' * 2500)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(FileDocument(c.object_id).attachment.read(), 'small')
+        self.assertEqual(bucket.files.count_documents({}), 3)
+        self.assertEqual(bucket.chunks.count_documents({}), 5 + 2 + 1)
+
+        # files are deleted along with their documents
+        FileDocument.manager.delete({'_id': {'$in': [a.object_id, c.object_id]}})
+        self.assertEqual(bucket.files.count_documents({}), 1)
+        self.assertEqual(bucket.chunks.count_documents({}), 2)
+        self.assertRaises(err.DeveloperFault, lambda: bucket.open_download_stream(a.attachment.file_id))
+
+        # content is uploaded on save, replaced and deleted files are kept while other documents refer them
+        d = FileDocument()
+        d.attachment = 'never saved'
+        self.assertEqual((d.attachment.file_id, bucket.files.count_documents({})), (None, 1))
+        d.attachment = b.attachment
+        d.save()
+        e = FileDocument(b.object_id)
+        e.attachment = 'replacing'
+        e.save()
+        self.assertEqual(bucket.files.count_documents({}), 2)
+        self.assertEqual(FileDocument(d.object_id).attachment.read(), 'x' * 1500 + 'y')
+        replaced = e.attachment.file_id
+        e.attachment = 'replacing again'
+        e.save()
+        self.assertEqual(bucket.find_file(replaced), None)
+        FileDocument.manager.delete({'_id': e.object_id})
+        self.assertEqual(bucket.files.count_documents({}), 1)
+
+    def test_embedded_reference(self):
+        class EmbeddedOwner(doc.Doc):
+            name = doc.FieldString()
+            code = doc.FieldString(key='c')
+            note = doc.FieldString()
+
+            class Meta:
+                collection_name = 'test_embedded_owner'
+
+        class EmbeddingTicket(doc.Doc):
+            owner = doc.FieldDoc(EmbeddedOwner, embed=['name', 'code'])
+            watchers = doc.FieldList(doc.FieldDoc('test_embedded_owner', embed=['name']))
+
+            class Meta:
+                collection_name = 'test_embedding_ticket'
+
+        EmbeddedOwner.manager.delete()
+        EmbeddingTicket.manager.delete()
+        owners = []
+        for name in ['a', 'b']:
+            o = EmbeddedOwner()
+            o.name, o.code, o.note = name, name.upper(), 'note'
+            o.save()
+            owners.append(o)
+        a, b = owners
+        t1, t2 = EmbeddingTicket(), EmbeddingTicket()
+        t1.owner, t1.watchers = a, [a, b]
+        t2.owner, t2.watchers = b.object_id, [b]
+        map(lambda t: t.save(), [t1, t2])
+
+        raw = EmbeddingTicket.manager.o.find_one({'_id': t2.object_id})
+        self.assertEqual(raw['owner'], {'_id': b.object_id, 'name': 'b', 'c': 'B'})
+        t = EmbeddingTicket(t1.object_id)
+        self.assertEqual((t.owner, t.owner.name, t.owner.c), (a.object_id, 'a', 'A'))
+        self.assertEqual(map(lambda w: w.name, t.watchers), ['a', 'b'])
+        self.assertEqual(t.populate('owner').owner.note, 'note')
+        t = next(EmbeddingTicket.manager.find({'_id': t1.object_id}).populate('watchers'))
+        self.assertEqual(map(lambda w: w.note, t.watchers), ['note', 'note'])
+        q = EmbeddingTicket.q
+        self.assertEqual(EmbeddingTicket.manager.count(q.owner == a), 1)
+        self.assertEqual(EmbeddingTicket.manager.count(q.watchers.contains(b)), 2)
+
+        events = []
+        doc.Docs.add_listener(events.append)
+        try:
+            b.name = 'renamed'
+            b.save()
+            a.note = 'not embedded'
+            a.save()
+        finally:
+            doc.Docs.remove_listener(events.append)
+        updates = filter(lambda e: e.operation == 'update', events)
+        # owner of t2, watchers of t1 and t2
+        self.assertEqual(map(lambda e: (e.collection_name, e.returned), updates), [('test_embedding_ticket', 3)])
+        t1, t2 = EmbeddingTicket(t1.object_id), EmbeddingTicket(t2.object_id)
+        self.assertEqual((t1.owner.name, map(lambda w: w.name, t1.watchers)), ('a', ['a', 'renamed']))
+        self.assertEqual((t2.owner.name, t2.owner.c, t2.watchers[0].name), ('renamed', 'B', 'renamed'))
+        self.assertRaises(err.DeveloperFault, lambda: doc.FieldDoc(EmbeddedOwner, embed=['unknown']).to_document(a))
+
+        # snapshots survive copies, bare ObjectIds are read once on assignment
+        import pickle
+        for c in [copy.deepcopy(t2), copy.copy(t2.owner), pickle.loads(pickle.dumps(t2.owner))]:
+            self.assertEqual(getattr(c, 'owner', c).name, 'renamed')
+        self.assertEqual(copy.deepcopy(t2).document(), t2.document())
+        t3 = EmbeddingTicket()
+        t3.owner, t3.watchers = a.object_id, [b.object_id]
+        self.assertEqual((t3.owner.name, t3.watchers[0].name), ('a', 'renamed'))
+        events = []
+        doc.Docs.add_listener(events.append)
+        try:
+            t3.document()
+            t3.save()
+        finally:
+            doc.Docs.remove_listener(events.append)
+        self.assertEqual(map(lambda e: e.operation, events), ['write'])
+
+    def test_timeseries_bucket(self):
+        class Reading(doc.Doc):
+            sensor = doc.FieldString(key='s', none=False)
+            ts = doc.FieldDateTime(none=False)
+            value = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_reading'
+                bucket = {'key': 'sensor', 'time_field': 'ts', 'max_items': 3, 'span': '1h'}
+
+        def reading(sensor, minutes, value):
+            r = Reading()
+            r.sensor, r.ts, r.value = sensor, t0 + timedelta(minutes=minutes), value
+            return r
+
+        Reading.manager.delete()
+        t0 = datetime(2026, 1, 1, 10, 0)
+        saved = [reading('a', 0, 1), reading('a', 10, 2), reading('a', 20, 3), reading('a', 30, 4), reading('b', 5, 10)]
+        map(lambda r: r.save(), saved)
+        Reading.manager.write_many([reading('a', 70, 5), reading('a', 80, 6), reading('b', 75, 20)])
+
+        # a: 10h (full), 10h, 11h; b: 10h, 11h
+        buckets = Reading.manager.o
+        self.assertEqual(buckets.count_documents({}), 5)
+        first = buckets.find_one({'s': 'a', 'start': t0, 'count': 3})
+        self.assertEqual((first['min'], first['max']), (t0, t0 + timedelta(minutes=20)))
+        self.assertNotIn('s', first['items'][0])
+
+        window = {'$gte': t0 + timedelta(minutes=15), '$lt': t0 + timedelta(minutes=75)}
+        found = Reading.manager.find({'s': 'a', 'ts': window})
+        self.assertEqual(map(lambda r: r.value, found), [3, 4, 5])
+        latest = Reading.manager.find().sort('ts', -1).limit(2)
+        self.assertEqual(map(lambda r: (r.sensor, r.value), latest), [('a', 6), ('b', 20)])
+        self.assertEqual(Reading.manager.count({'s': 'a'}), 6)
+        self.assertEqual(Reading.manager.count({'ts': {'$lt': t0 + timedelta(hours=1)}}), 5)
+        self.assertEqual(Reading.manager.count({'value': {'$gte': 5}}), 4)
+
+        r = Reading(saved[1].object_id)
+        self.assertEqual((r.sensor, r.ts, r.value), ('a', t0 + timedelta(minutes=10), 2))
+        r.value = 200
+        r.save()
+        self.assertEqual(Reading(r.object_id).value, 200)
+        self.assertEqual(buckets.count_documents({}), 5)
+        self.assertRaises(err.DeveloperFault, lambda: Reading.manager.replace_many([r.document()]))
+        self.assertRaises(err.DeveloperFault, lambda: Reading.manager.update({'s': 'a'}, {'$set': {'value': 0}}))
+        self.assertRaises(err.DeveloperFault, lambda: Reading.manager.update_fields(set={'value': 0}))
+        self.assertRaises(err.DeveloperFault, lambda: Reading.manager.paginate({}, sort=[('ts', 1)]))
+        self.assertRaises(err.DeveloperFault, lambda: list(Reading.manager.find({'value': {'$mod': [2, 0]}})))
+        self.assertEqual(Reading.manager.count({'$or': [{'value': {'$not': {'$lt': 200}}}, {'s': 'b'}]}), 3)
+
+        # moved to the bucket of its new span, then of its new key
+        r.ts += timedelta(hours=2)
+        r.save()
+        self.assertEqual(buckets.find_one({'s': 'a', 'start': t0})['count'], 2)
+        self.assertEqual(buckets.find_one({'s': 'a', 'start': t0 + timedelta(hours=2)})['count'], 1)
+        r.sensor = 'b'
+        r.save()
+        self.assertIsNone(buckets.find_one({'s': 'a', 'start': t0 + timedelta(hours=2)}))     # emptied, deleted
+        self.assertEqual((Reading(r.object_id).sensor, Reading(r.object_id).ts), ('b', t0 + timedelta(minutes=130)))
+        self.assertEqual(Reading.manager.count(), 8)
+        Reading.manager.delete({'ts': {'$gte': t0 + timedelta(hours=2)}})
+
+        # emptied buckets are deleted, others keep remaining readings
+        Reading.manager.delete({'ts': {'$lt': t0 + timedelta(minutes=25)}})
+        self.assertEqual(Reading.manager.count(), 4)
+        self.assertEqual(buckets.count_documents({}), 3)
+        rest = buckets.find_one({'s': 'a', 'start': t0})
+        self.assertEqual((rest['count'], rest['min'], rest['max']), (1,) + (t0 + timedelta(minutes=30),) * 2)
+
+    def test_result_cache(self):
+        class CachedDocument(doc.Doc):
+            name = doc.FieldString()
+            rank = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_cached_document'
+                result_cache = {'max_size': 3, 'store': 'raw'}
+
+        manager = CachedDocument.manager
+        manager.delete()
+        for rank in [1, 2, 3]:
+            o = CachedDocument()
+            o.name, o.rank = 'n%d' % rank, rank
+            o.save()
+
+        events = []
+        doc.Docs.add_listener(events.append)
+        try:
+            top = manager.find_cached({'rank': {'$gte': 1}}, sort=[('rank', -1)], limit=2)
+            top[0].name = 'changed, not cached'
+            ascending = manager.find_cached({'rank': {'$gte': 1}}, sort='rank', limit=2)
+            again = manager.find_cached({'rank': {'$gte': 1}}, sort=[('rank', -1)], limit=2)
+            counts = [manager.count({'rank': {'$gte': 2}}), manager.count({'rank': {'$gte': 2}})]
+        finally:
+            doc.Docs.remove_listener(events.append)
+        self.assertEqual(map(lambda o: (o.name, o.rank), again), [('n3', 3), ('n2', 2)])
+        self.assertEqual(map(lambda o: o.rank, ascending), [1, 2])
+        self.assertEqual(counts, [2, 2])
+        self.assertEqual(map(lambda e: e.operation, events), ['find', 'find', 'count'])
+        self.assertEqual(manager.result_cache.stats()['hits'], 2)
+
+        # any write of the collection invalidates cached results
+        o = CachedDocument()
+        o.name, o.rank = 'n4', 4
+        o.save()
+        top = manager.find_cached({'rank': {'$gte': 1}}, sort=[('rank', -1)], limit=2)
+        self.assertEqual(map(lambda o: o.rank, top), [4, 3])
+        manager.update({'rank': 4}, {'$set': {'rank': 0}})
+        self.assertEqual(manager.count({'rank': {'$gte': 2}}), 2)
+        stats = manager.result_cache.stats()
+        self.assertEqual((stats['hits'], stats['stale'], stats['size'], stats['max_size']), (2, 2, 3, 3))
+        manager.find_cached({'name': 'n1'})
+        self.assertEqual(manager.result_cache.stats()['evictions'], 1)
+        self.assertEqual(stats['hit_rate'], 2.0 / 7)
+
+        manager.result_cache = ResultCache(store='ids')
+        first = manager.find_cached({'rank': {'$lte': 2}}, sort='rank')
+        self.assertEqual(manager.find_cached({'rank': {'$lte': 2}}, sort='rank'), first)
+        self.assertEqual(map(lambda o: o.rank, first), [0, 1, 2])
+        self.assertEqual(manager.result_cache.entries.values()[0][2], map(lambda o: o.object_id, first))
+        self.assertRaises(err.DeveloperFault, lambda: ResultCache(store='documents'))
+
+        # writes of other processes (here raw collection) are seen once the result expires
+        manager.result_cache = ResultCache(ttl=0.05)
+        self.assertEqual(manager.count({'rank': {'$gte': 1}}), 3)
+        manager.o.update_many({'rank': 0}, {'$set': {'rank': 5}})
+        self.assertEqual(manager.count({'rank': {'$gte': 1}}), 3)
+        time.sleep(0.1)
+        self.assertEqual(manager.count({'rank': {'$gte': 1}}), 4)
+        self.assertRaises(err.DeveloperFault, lambda: ResultCache(ttl=0))
+
+
+class TestAggregation(unittest.TestCase):
+
+    def test_aggregate(self):
+        SimpleDocument.manager.delete({'str_val': 'aggregate_me'})
+        for i in [10, 20, 30]:
+            o = SimpleDocument()
+            o.int_val = i
+            o.str_val = 'aggregate_me'
+            o.save()
+
+        # Field names are translated through FieldSpec.key
+        self.assertEqual(Pipeline(SimpleDocument).match(object_id=o.object_id).stages[0], {'$match': {'_id': o.object_id}})
+
+        found = list(Pipeline(SimpleDocument)
+                     .match(str_val='aggregate_me', int_val={'$gte': 20})
+                     .sort(('int_val', pymongo.DESCENDING))
+                     .run(batch_size=1))
+        self.assertEqual(len(found), 2)
+        self.assertTrue(isinstance(found[0], SimpleDocument))
+        self.assertEqual(found[0].object_id, o.object_id)
+        self.assertEqual(map(lambda d: d.int_val, found), [30, 20])
+
+        grouped = list(Pipeline(SimpleDocument)
+                       .match(str_val='aggregate_me')
+                       .group(None, total={'$sum': '$int_val'})
+                       .run(inflate=False))
+        self.assertEqual(grouped[0]['total'], 60)
+
+        SimpleDocument.manager.delete({'str_val': 'aggregate_me'})
+
+
+class TestInstruments(unittest.TestCase):
+
+    def test_listeners(self):
+        events = []
+        aggregator = LatencyAggregator()
+        doc.Docs.add_listener(events.append)
+        doc.Docs.add_listener(aggregator)
+        try:
+            o = SimpleDocument()
+            o.str_val = 'instrument_me'
+            o.save()
+            found = [d for d in SimpleDocument.manager.find({'str_val': 'instrument_me'})]
+            SimpleDocument.manager.update({'str_val': 'instrument_me'}, {'$set': {'int_val': 3}})
+            SimpleDocument.manager.delete({'str_val': 'instrument_me'})
+        finally:
+            doc.Docs.remove_listener(events.append)
+            doc.Docs.remove_listener(aggregator)
+
+        self.assertEqual(map(lambda e: e.operation, events), ['write', 'find', 'update', 'delete'])
+        self.assertEqual(events[1].collection_name, 'simple_document')
+        self.assertEqual(events[1].returned, len(found))
+        self.assertEqual(events[1].shape, {'str_val': '?'})
+        self.assertTrue(events[1].inflate_time <= events[1].duration)
+        self.assertEqual(aggregator.dump()['simple_document']['find']['count'], 1)
+
+    def test_listener_reads(self):
+        SimpleDocument.manager.delete({'str_val': 'read_me'})
+        for i in range(3):
+            o = SimpleDocument()
+            o.str_val = 'read_me'
+            o.save()
+        events = []
+        doc.Docs.add_listener(events.append)
+        try:
+            self.assertEqual(SimpleDocument.manager.find({'str_val': 'read_me'})[0].str_val, 'read_me')
+            cursor = SimpleDocument.manager.find({'str_val': 'read_me'})
+            next(cursor)
+            cursor.close()
+            SimpleDocument.manager.load_raw(o.object_id)
+            SimpleDocument.manager.paginate({'str_val': 'read_me'}, limit=2)
+            list(SimpleDocument.manager.aggregate([{'$match': {'str_val': 'read_me'}}]))
+            SimpleDocument.manager.find({'str_val': 'never_iterated'}).close()
+            partial = SimpleDocument.manager.find({'str_val': 'read_me'})
+            next(partial)
+            del partial             # collected, listeners are not called by garbage collection
+        finally:
+            doc.Docs.remove_listener(events.append)
+        self.assertEqual(map(lambda e: (e.operation, e.returned), events),
+                         [('find', 1), ('find', 1), ('find', 1), ('find', 2), ('aggregate', 3)])
+        SimpleDocument.manager.delete({'str_val': 'read_me'})
+
+    def test_explain_sampler(self):
+        sampler = ExplainSampler(rate=1.0)
+        doc.Docs.add_listener(sampler)
+        try:
+            SimpleDocument.manager.count({'str_val': 'not_indexed'})
+            sampler.join()      # explained by background thread
+        finally:
+            doc.Docs.remove_listener(sampler)
+        self.assertEqual(len(sampler.flagged), 1)
+        self.assertEqual(sampler.flagged[0]['collection_name'], 'simple_document')
+        self.assertFalse(sampler.flagged[0]['declared_index'])
+
+
+class TestLazyModels(unittest.TestCase):
+
+    def test_lazy_loading(self):
+        conf.update_config('tests')
+        path = tempfile.mkdtemp()
+        with open(os.path.join(path, 'lazy_models_fixture.py'), 'w') as f:
+            f.write('\n'.join([
+                'from pymongo_document import documents as doc',
+                'class LazyDocument(doc.Doc):',
+                '    int_val = doc.FieldNumeric()',
+                '    class Meta:',
+                '        collection_name = "test_lazy_document"',
+                '        connection_name = "memory_pool"',
+                'class LazyConfiguredDocument(doc.Doc):',
+                '    class Meta:',
+                '        collection_name = "test_lazy_configured"',
+                '        connection_name = "memory_pool"',
+            ]))
+        with open(os.path.join(path, 'pymongo-connectors.ini'), 'w') as f:
+            f.write('[default]\nbackend = memory\n[models]\ntest_lazy_configured = lazy_models_fixture\n')
+        doc.Docs.declare('test_lazy_document', 'lazy_models_fixture:LazyDocument')
+
+        class LazyHolderDocument(doc.Doc):
+            lazy = doc.FieldDoc('test_lazy_document')
+
+            class Meta:
+                collection_name = 'test_lazy_holder'
+                connection_name = 'memory_pool'
+
+        sys.path.insert(0, path)
+        try:
+            self.assertFalse('test_lazy_document' in doc.Docs.installed)
+            lazy_class = LazyHolderDocument.lazy.doc_clz()
+            self.assertEqual(lazy_class.__name__, 'LazyDocument')
+            report = doc.Docs.lazy_loaded[-1]
+            self.assertEqual((report['collection_name'], report['models']),
+                             ('test_lazy_document', ['test_lazy_configured', 'test_lazy_document']))
+
+            o = lazy_class()
+            o.save()
+            self.assertEqual(doc.Docs.factory('test_lazy_document', o.object_id).object_id, o.object_id)
+
+            conf.update_config(path)
+            self.assertEqual(doc.Docs.model_path('test_lazy_configured'), 'lazy_models_fixture')
+            self.assertEqual(doc.Docs.model_path('test_lazy_unknown'), None)
+            self.assertRaises(err.DeveloperFault, lambda: doc.Docs.factory_doc('test_lazy_unknown'))
+            self.assertRaises(ValueError, lambda: doc.FieldDoc('test_lazy_unknown').doc_clz())
+        finally:
+            sys.path.remove(path)
+            conf.update_config('tests')
+        self.assertEqual(conf.Configuration.MODELS, {})
+
+
+class TestMemoryStorage(unittest.TestCase):
+
+    def test_collection(self):
+        c = storage.MemoryDatabase('test_memory')['items']
+        c.create_index([('code', pymongo.ASCENDING)], unique=True)
+        c.insert_many([
+            {'code': 'a', 'amount': 5, 'tags': ['x', 'y'], 'nested': {'v': 1}},
+            {'code': 'b', 'amount': 10, 'tags': ['y']},
+            {'code': 'c', 'amount': 15, 'tags': []},
+        ])
+        self.assertRaises(pymongo.errors.DuplicateKeyError, lambda: c.insert_one({'code': 'a'}))
+
+        self.assertEqual(map(lambda d: d['code'], c.find({'amount': {'$gte': 10}}).sort('amount', -1)), ['c', 'b'])
+        self.assertEqual(map(lambda d: d['code'], c.find({'tags': 'y'})), ['a', 'b'])
+        self.assertEqual(map(lambda d: d['code'], c.find({'$or': [{'code': 'c'}, {'nested.v': 1}]})), ['a', 'c'])
+        self.assertEqual(c.find_one({'code': {'$in': ['b']}})['amount'], 10)
+        self.assertEqual(c.find({'code': 'b'}).explain()['queryPlanner']['winningPlan']['inputStage']['stage'], 'IXSCAN')
+        self.assertEqual(sorted(c.distinct('tags')), ['x', 'y'])
+
+        self.assertEqual(c.update_many({'tags': 'y'}, {'$inc': {'amount': 1}, '$push': {'tags': 'z'}}).modified_count, 2)
+        self.assertEqual(c.find_one({'code': 'a'})['amount'], 6)
+        self.assertEqual(c.find_one({'code': 'a'})['tags'], ['x', 'y', 'z'])
+        self.assertEqual(c.delete_many({'amount': {'$lt': 12}}).deleted_count, 2)
+        self.assertEqual(c.count_documents({}), 1)
+
+    def test_document(self):
+        conf.update_config('tests')
+
+        class MemoryDocument(doc.Doc):
+            int_val = doc.FieldNumeric()
+            list_of_docs = doc.FieldList(doc.FieldDoc(SimpleDocument))
+
+            class Meta:
+                collection_name = 'test_memory_document'
+                connection_name = 'memory_pool'
+                indices = [([('int_val', pymongo.ASCENDING)], {})]
+
+        self.assertTrue(isinstance(MemoryDocument.manager.o, storage.MemoryCollection))
+        MemoryDocument.manager.delete()
+        for i in range(5):
+            o = MemoryDocument()
+            o.int_val = i
+            o.save()
+
+        found = MemoryDocument.manager.find({'int_val': {'$gt': 1}}).sort('int_val', pymongo.DESCENDING)
+        self.assertEqual(len(found), 3)
+        self.assertEqual(map(lambda d: d.int_val, found), [4, 3, 2])
+        self.assertEqual(found[0].int_val, 4)
+
+        r = MemoryDocument(o.object_id)
+        self.assertEqual(r.int_val, 4)
+        MemoryDocument.manager.update({'int_val': 4}, {'$set': {'int_val': 40}})
+        self.assertEqual(MemoryDocument(o.object_id).int_val, 40)
+        MemoryDocument.manager.delete({'int_val': {'$gte': 3}})
+        self.assertEqual(MemoryDocument.manager.count(), 3)
+
+
+class TestRouting(unittest.TestCase):
+
+    def test_tenant_router(self):
+        conf.update_config('tests')
+
+        class TenantDocument(doc.Doc):
+            tenant = doc.FieldString(none=False)
+            int_val = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_tenant_document'
+                connection_name = 'tenant_a'
+                router = TenantRouter('tenant', {'a': 'tenant_a', 'b': 'tenant_b'})
+                indices = [([('int_val', pymongo.ASCENDING)], {})]
+
+        manager = TenantDocument.manager
+        manager.delete()
+        objects = []
+        for i, tenant in enumerate('abab'):
+            o = TenantDocument()
+            o.tenant = tenant
+            o.int_val = i
+            o.save()
+            objects.append(o)
+
+        self.assertTrue('int_val_1' in manager.collection(connection_name='tenant_b').index_information())
+        self.assertEqual(manager.collection(connection_name='tenant_a').count_documents({}), 2)
+        self.assertEqual(manager.collection(connection_name='tenant_b').count_documents({'tenant': 'a'}), 0)
+        self.assertEqual(manager.count({'tenant': 'b'}), 2)
+        self.assertEqual(manager.count(), 4)
+        self.assertFalse(isinstance(manager.find({'tenant': {'$in': ['a']}}), ScatterCursor))
+
+        found = manager.find({'int_val': {'$gte': 1}}).sort('int_val', pymongo.DESCENDING).limit(2)
+        self.assertTrue(isinstance(found, ScatterCursor))
+        self.assertEqual(map(lambda o: o.int_val, found), [3, 2])
+        self.assertEqual(map(lambda o: o.int_val, manager.find().sort('int_val').skip(1).limit(2)), [1, 2])
+        self.assertEqual(len(manager.find()), 4)
+        self.assertEqual(manager.find().sort('int_val')[1].int_val, 1)
+
+        page, token = manager.paginate({}, sort=[('int_val', 1)], limit=3)
+        self.assertEqual(map(lambda o: o.int_val, page), [0, 1, 2])
+        page, token = manager.paginate({}, sort=[('int_val', 1)], after=token, limit=3)
+        self.assertEqual((map(lambda o: o.int_val, page), token), ([3], None))
+        routed = manager.aggregate([{'$match': {'tenant': 'b'}}, {'$sort': {'int_val': 1}}])
+        self.assertEqual(map(lambda o: o.int_val, routed), [1, 3])
+        self.assertRaises(err.DeveloperFault, lambda: manager.aggregate([{'$sort': {'int_val': 1}}]))
+
+        # load, save, update and delete are routed
+        o = TenantDocument(objects[1].object_id)
+        self.assertEqual(o.tenant, 'b')
+        o.int_val = 10
+        o.save()
+        self.assertEqual(manager.collection(connection_name='tenant_b').find_one({'_id': o.object_id})['int_val'], 10)
+        manager.update({'tenant': 'a'}, {'$inc': {'int_val': 100}})
+        self.assertEqual(sorted(map(lambda o: o.int_val, manager.find())), [3, 10, 100, 102])
+        self.assertEqual(manager.update_fields(set={'int_val': 0}), 4)
+        manager.delete({'tenant': 'b'})
+        self.assertEqual(manager.count(), 2)
+
+        o = TenantDocument()
+        o.tenant = 'unknown'
+        self.assertRaises(err.DeveloperFault, o.save)
+
+
+class TestTransfer(unittest.TestCase):
+
+    def test_export_import(self):
+        class TransferDocument(doc.Doc):
+            name = doc.FieldString()
+            score = doc.FieldNumeric(min_value=0, key='s')
+            created = doc.FieldDateTime()
+            tags = doc.FieldList(doc.FieldString())
+            simple = doc.FieldDoc(SimpleDocument)
+
+            class Meta:
+                collection_name = 'test_transfer'
+
+        manager = TransferDocument.manager
+        manager.delete()
+        simple = SimpleDocument()
+        simple.save()
+        created = datetime(2020, 1, 2, 3, 4, 5)
+        for i in range(25):
+            o = TransferDocument()
+            o.name, o.score, o.created, o.tags, o.simple = u'n\xe9 %d, "q"' % i, i, created, ['a', str(i)], simple
+            o.save()
+        expected = sorted(map(lambda o: o.document(), manager.find({})), key=lambda d: d['s'])
+
+        for format in transfer.FORMATS:
+            output = StringIO.StringIO()
+            report = transfer.export_documents(TransferDocument, output, format, batch_size=10)
+            self.assertEqual(report['rows'], 25)
+            manager.delete()
+            report = transfer.import_documents(TransferDocument, StringIO.StringIO(output.getvalue()), format,
+                                               batch_size=4, workers=3)
+            self.assertEqual(report['rows'], 25)
+            self.assertEqual(sorted(map(lambda o: o.document(), manager.find({})), key=lambda d: d['s']), expected)
+
+        # re-import replaces documents of the same _id
+        output = StringIO.StringIO()
+        transfer.export_documents(TransferDocument, output, cond=TransferDocument.q.score < 5)
+        self.assertEqual(len(output.getvalue().splitlines()), 5)
+        transfer.import_documents(TransferDocument, StringIO.StringIO(output.getvalue()))
+        self.assertEqual(manager.count(), 25)
+
+        # rows are validated by model's FieldSpecs, failure reports its line
+        lines = output.getvalue().splitlines()
+        lines[3] = lines[3].replace('"s": 3', '"s": -3')
+        self.assertRaisesRegexp(err.DocumentValidationError, '^line 4: ', transfer.import_documents, TransferDocument,
+                                StringIO.StringIO('\n'.join(lines)), workers=2)
+        self.assertRaisesRegexp(err.DeveloperFault, 'no field', transfer.import_documents, TransferDocument,
+                                StringIO.StringIO('_id,unknown\n'), 'csv')
+        self.assertEqual(TransferDocument(expected[3]['_id']).score, 3)
+
+        # command line, stdout carries exported rows only, success exits with 0
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            code = transfer.main(['export', 'test_transfer', '--query', '{"s": {"$lt": 2}}'])
+            exported = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(code, None)
+        self.assertEqual(map(lambda line: json.loads(line)['s'], exported.splitlines()), [0, 1])
+
+
+class TestWatcher(unittest.TestCase):
+
+    def test_watch(self):
+        conf.update_config('tests')
+
+        class WatchedDocument(doc.Doc):
+            int_val = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_watched_document'
+                connection_name = 'memory_pool'
+
+        class WatchedSubDocument(WatchedDocument):
+            str_val = doc.FieldString()
+
+            class Meta:
+                collection_name = ':sub'
+                connection_name = 'memory_pool'
+
+        WatchedDocument.manager.delete()
+        path = os.path.join(tempfile.mkdtemp(), 'tokens.json')
+        cache = DocCache(max_size=2)
+        changes = []
+        sub_changes = []
+        watcher = ChangeWatcher(cache, token_store=FileTokenStore(path))
+        watcher.register(WatchedDocument, lambda operation, object_id, raw: changes.append((operation, object_id)))
+        watcher.register(WatchedSubDocument, lambda operation, object_id, raw: sub_changes.append(operation))
+        self.assertEqual(watcher.poll(), 0)
+
+        o = WatchedDocument()
+        o.int_val = 1
+        o.save()
+        s = WatchedSubDocument()
+        s.str_val = 'x'
+        s.save()
+        self.assertTrue(cache.get(WatchedDocument, o.object_id) is cache.get(WatchedDocument, str(o.object_id)))
+        self.assertEqual(cache.hits, 1)
+
+        WatchedDocument.manager.update({'_id': o.object_id}, {'$set': {'int_val': 2}})
+        self.assertEqual(cache.get(WatchedDocument, o.object_id).int_val, 1)  # stale until change is processed
+        self.assertEqual(watcher.poll(), 3)
+        self.assertEqual(changes, [('insert', o.object_id), ('insert', s.object_id), ('update', o.object_id)])
+        self.assertEqual(sub_changes, ['insert'])
+        self.assertEqual(cache.get(WatchedDocument, o.object_id).int_val, 2)
+        watcher.stop()
+
+        # resume from persisted token, changes made while stopped are delivered
+        WatchedDocument.manager.delete({'_id': o.object_id})
+        changes = []
+        watcher = ChangeWatcher(cache, token_store=FileTokenStore(path))
+        watcher.register(WatchedDocument, lambda operation, object_id, raw: changes.append((operation, object_id)))
+        self.assertEqual(watcher.poll(), 1)
+        self.assertEqual(changes, [('delete', o.object_id)])
+        self.assertTrue(cache.get(WatchedDocument, o.object_id) is None)
+        watcher.stop()
+
+    def test_watch_survives_errors(self):
+        conf.update_config('tests')
+
+        class FollowedDocument(doc.Doc):
+            int_val = doc.FieldNumeric()
+
+            class Meta:
+                collection_name = 'test_followed_document'
+                connection_name = 'memory_pool'
+
+        def callback(operation, object_id, raw):
+            changes.append(object_id)
+            if len(changes) == 1:
+                raise ValueError('failing callback')
+
+        def wait_for(n):
+            deadline = time.time() + 5
+            while len(changes) < n and time.time() < deadline:
+                time.sleep(0.01)
+
+        changes = []
+        watcher = ChangeWatcher(retry_delay=0.01)
+        watcher.register(FollowedDocument, callback)
+        name = FollowedDocument.manager.o.full_name
+        watcher.start()
+        try:
+            ids = map(lambda i: FollowedDocument().save(), range(2))
+            wait_for(2)
+            stream = watcher.streams[name]
+            stream.close()              # e.g. network error, reopened from the last saved token
+            ids.append(FollowedDocument().save())
+            wait_for(3)
+        finally:
+            watcher.stop()
+        self.assertEqual(changes, ids)
+        self.assertEqual(watcher.errors, 1)
+        self.assertTrue(watcher.streams.get(name) is not stream)
+
 if __name__ == '__main__':
     unittest.main()